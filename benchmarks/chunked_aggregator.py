@@ -0,0 +1,79 @@
+"""Activation memory and time of the cell aggregator with and without chunked recomputation.
+
+Runs the cell-level MLP and gated attention pooling of :class:`multimil.module.MILClassifierTorch` on single bags of
+increasing size, once with the whole bag kept for backward and once with
+:func:`multimil.nn.chunked_attention_pool`. Reports the size of the tensors saved for the backward pass, which
+includes the input cells in both cases, and the best forward + backward time.
+
+Usage::
+
+    python benchmarks/chunked_aggregator.py --bag-sizes 1000 10000 100000 --chunk-size 1024 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from multimil.module import MILClassifierTorch
+
+
+def saved_megabytes(fn):
+    """Run ``fn`` and return the megabytes of distinct tensors saved for backward and the output."""
+    saved = {}
+
+    def pack(tensor):
+        saved[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    return sum(saved.values()) / 2**20, out
+
+
+def main():
+    """Print the memory saved for backward and the time of chunked and full-bag pooling."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bag-sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--z-dim", type=int, default=30)
+    parser.add_argument("--n-hidden", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    print(f"{'bag size':>9} {'mode':>8} {'saved MB':>9} {'ms':>9}")
+    for bag_size in args.bag_sizes:
+        x = torch.randn(bag_size, args.z_dim, device=args.device, requires_grad=True)
+        for chunk_size in [None, args.chunk_size]:
+            module = MILClassifierTorch(
+                z_dim=args.z_dim,
+                n_hidden_cell_aggregator=args.n_hidden,
+                num_classification_classes=[2],
+                sample_batch_size=bag_size,
+                aggregator_chunk_size=chunk_size,
+                class_idx=torch.tensor([0]),
+                ord_idx=torch.tensor([]),
+                reg_idx=torch.tensor([]),
+            ).to(args.device)
+
+            def step(module=module, x=x):
+                return module.inference(x)["predictions"][0].sum()
+
+            megabytes, _ = saved_megabytes(step)
+            times = []
+            for _ in range(args.repeats):
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                step().backward()
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                times.append(time.perf_counter() - start)
+            mode = "full" if chunk_size is None else "chunked"
+            print(f"{bag_size:>9} {mode:>8} {megabytes:>9.1f} {1000 * min(times):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Training steps per second with and without :func:`torch.compile`.
+
+Runs forward, backward and optimizer steps of the ``vae`` (:class:`multimil.module.MultiVAETorch`), ``mil``
+(:class:`multimil.module.MILClassifierTorch`) and ``vae_mil`` (:class:`multimil.module.MultiVAETorch_MIL`) modules on
+random minibatches whose samples, and thus bags, change between steps. The compiled module uses
+:func:`multimil.utils.compile_fn` as in ``train(compile=True)``, and the first steps that trigger compilation are not
+timed.
+
+Usage::
+
+    python benchmarks/compiled_training.py --modules vae mil vae_mil --batch-size 256 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from multimil.module import MILClassifierTorch, MultiVAETorch, MultiVAETorch_MIL
+from multimil.utils import compile_fn
+
+EMPTY = torch.tensor([], dtype=torch.long)
+MODALITY_LENGTHS = [1000, 200]
+
+
+def make_module(name):
+    """Build the module of the given model with the benchmark's covariates."""
+    vae_kwargs = {
+        "modality_lengths": MODALITY_LENGTHS,
+        "losses": ["nb", "bce"],
+        "cont_covariate_dims": [],
+        "cont_covs_idx": EMPTY,
+        "num_groups": 4,
+        "loss_coefs": {"integ": 1},
+    }
+    mil_kwargs = {
+        "num_classification_classes": [2],
+        "class_idx": torch.tensor([1]),
+        "ord_idx": EMPTY,
+        "reg_idx": EMPTY,
+        "sample_idx": 0,
+        "sample_batch_size": 64,
+    }
+    if name == "vae":
+        return MultiVAETorch(**vae_kwargs, cat_covariate_dims=[4], cat_covs_idx=torch.tensor([2]), integrate_on_idx=2)
+    if name == "mil":
+        return MILClassifierTorch(z_dim=16, **mil_kwargs)
+    return MultiVAETorch_MIL(
+        **vae_kwargs, **mil_kwargs, cat_covariate_dims=[4], cat_covs_idx=torch.tensor([2]), integrate_on_idx=2
+    )
+
+
+def make_batch(name, batch_size, device):
+    """Make a batch for the given model with consecutive cells of each sample."""
+    # cells of the same sample are consecutive as in the group dataloader, the number of bags changes between batches
+    samples = torch.sort(torch.randint(0, 6, (batch_size,))).values
+    cat_covs = torch.stack([samples, samples % 2, torch.randint(0, 4, (batch_size,))], dim=1).float()
+    n_features = 16 if name == "mil" else sum(MODALITY_LENGTHS)
+    x = torch.rand(batch_size, n_features)
+    if name != "mil":
+        x[:, : MODALITY_LENGTHS[0]] = torch.poisson(x[:, : MODALITY_LENGTHS[0]])
+        x[:, MODALITY_LENGTHS[0] :] = (x[:, MODALITY_LENGTHS[0] :] > 0.9).float()
+    tensors = {"X": x, "extra_categorical_covs": cat_covs, "size_factor": x[:, : MODALITY_LENGTHS[0]].sum(1, True) + 1}
+    return {key: value.to(device) for key, value in tensors.items()}
+
+
+def run(module, forward, batches, n_warmup):
+    """Train for all batches and return the steps per second after the warmup steps."""
+    optimizer = torch.optim.AdamW(module.parameters(), lr=1e-4)
+    for i, tensors in enumerate(batches):
+        if i == n_warmup:
+            start = time.perf_counter()
+        loss = forward(tensors, loss_kwargs={"kl_weight": 1.0})[2].loss
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    if tensors["X"].is_cuda:
+        torch.cuda.synchronize()
+    return (len(batches) - n_warmup) / (time.perf_counter() - start)
+
+
+def main():
+    """Print the training steps per second of each model in eager mode and compiled."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=["vae", "mil", "vae_mil"])
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--n-steps", type=int, default=50)
+    parser.add_argument("--n-warmup", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    print(f"{'module':>8} {'eager steps/s':>14} {'compiled steps/s':>17} {'speedup':>8}")
+    for name in args.modules:
+        torch.manual_seed(0)
+        batches = [make_batch(name, args.batch_size, args.device) for _ in range(args.n_warmup + args.n_steps)]
+        eager = make_module(name).to(args.device)
+        compiled = make_module(name).to(args.device)
+        compiled.load_state_dict(eager.state_dict())
+        eager_speed = run(eager, eager, batches, args.n_warmup)
+        compiled_speed = run(compiled, compile_fn(compiled.forward), batches, args.n_warmup)
+        print(f"{name:>8} {eager_speed:>14.1f} {compiled_speed:>17.1f} {compiled_speed / eager_speed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Time of the ``'mlp'`` embeddings of continuous covariates of :class:`multimil.module.MultiVAETorch`.
+
+Evaluates the embeddings of a batch of continuous covariates with ``cont_cov_type="mlp"``, once with one small MLP
+call per covariate and once with the MLPs of all covariates evaluated together with their parameters stacked, for each
+given number of covariates. Reports the best forward + backward time.
+
+Usage::
+
+    python benchmarks/cont_covariate_curves.py --n-covariates 1 4 12 --n-layers 1 2 --batch-size 256 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from multimil.module import MultiVAETorch
+
+
+def main():
+    """Print the time of the grouped and the looped continuous covariate curves."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-covariates", type=int, nargs="+", default=[1, 4, 12])
+    parser.add_argument("--n-layers", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--n-hidden", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    cuda = args.device.startswith("cuda")
+    print(f"{'layers':>6} {'covariates':>10} {'loop ms':>8} {'grouped ms':>11} {'speedup':>8}")
+    for n_layers in args.n_layers:
+        for n_covariates in args.n_covariates:
+            module = MultiVAETorch(
+                modality_lengths=[10],
+                losses=["mse"],
+                cat_covariate_dims=[],
+                cont_covariate_dims=[1] * n_covariates,
+                cat_covs_idx=torch.tensor([], dtype=torch.long),
+                cont_covs_idx=torch.arange(n_covariates),
+                cont_cov_type="mlp",
+                n_layers_cont_embed=n_layers,
+                n_hidden_cont_embed=args.n_hidden,
+            ).to(args.device)
+            covs = torch.rand(args.batch_size, n_covariates, device=args.device)
+            seconds = {}
+            for grouped in [False, True]:
+                module._group_cont_covariate_curves = grouped
+                times = []
+                for _ in range(args.repeats + 1):
+                    if cuda:
+                        torch.cuda.synchronize()
+                    start = time.perf_counter()
+                    module._compute_cont_cov_embeddings(covs).sum().backward()
+                    if cuda:
+                        torch.cuda.synchronize()
+                    times.append(time.perf_counter() - start)
+                # the first call warms up the allocator
+                seconds[grouped] = min(times[1:])
+            print(
+                f"{n_layers:>6} {n_covariates:>10} {1000 * seconds[False]:>8.2f} {1000 * seconds[True]:>11.2f} "
+                f"{seconds[False] / seconds[True]:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
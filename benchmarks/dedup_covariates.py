@@ -0,0 +1,112 @@
+"""Time of the covariate inputs and of a training step of :class:`multimil.module.MultiVAETorch` with deduplication.
+
+Conditions the encoders and decoders of a bimodal model (``nb`` and ``bce``) on categorical covariates and on a
+continuous covariate embedded by an MLP, all constant within bags of consecutive cells like the sample level covariates
+in the batches of the MIL models, once per cell and once with ``dedup_covariates=True``, for each given number of bags
+per batch. Reports the best forward + backward time of the covariate inputs of the first layers alone and of a whole
+forward + backward + AdamW step.
+
+Usage::
+
+    python benchmarks/dedup_covariates.py --n-bags 1 4 16 --batch-size 1024 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from multimil.module import MultiVAETorch
+
+
+def best_time(fn, repeats, cuda):
+    """Return the fastest of `repeats` calls of `fn` after a warmup call."""
+    times = []
+    for _ in range(repeats + 1):
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    # the first call warms up the allocator
+    return min(times[1:])
+
+
+def main():
+    """Print the time of the covariate inputs and of a training step, per cell and per bag, for each number of bags."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-features", type=int, nargs=2, default=[2000, 500])
+    parser.add_argument("--n-cat-covariates", type=int, default=3)
+    parser.add_argument("--n-bags", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    cuda = args.device.startswith("cuda")
+    n_rna, n_atac = args.n_features
+    x = torch.cat(
+        [
+            torch.poisson(torch.full((args.batch_size, n_rna), 0.5)),
+            (torch.rand(args.batch_size, n_atac) < 0.05).float(),
+        ],
+        dim=1,
+    ).to(args.device)
+
+    print(f"{'bags':>5} {'mode':>8} {'covs ms':>8} {'speedup':>8} {'step ms':>8} {'speedup':>8}")
+    for n_bags in args.n_bags:
+        bags = torch.arange(args.batch_size) * n_bags // args.batch_size
+        cat_covs = torch.randint(0, 8, (n_bags, args.n_cat_covariates)).float()
+        tensors = {
+            "X": x,
+            "extra_categorical_covs": cat_covs[bags].to(args.device),
+            "extra_continuous_covs": torch.rand(n_bags, 1)[bags].to(args.device),
+            "size_factor": x[:, :n_rna].sum(dim=1, keepdim=True).clamp(min=1),
+        }
+        per_cell_times = None
+        for dedup in [False, True]:
+            module = MultiVAETorch(
+                modality_lengths=args.n_features,
+                losses=["nb", "bce"],
+                cat_covariate_dims=[8] * args.n_cat_covariates,
+                cont_covariate_dims=[1],
+                cat_covs_idx=torch.arange(args.n_cat_covariates),
+                cont_covs_idx=torch.tensor([0]),
+                cont_cov_type="mlp",
+                condition_encoders=True,
+                condition_decoders=True,
+                dedup_covariates=dedup,
+            ).to(args.device)
+            optimizer = torch.optim.AdamW(module.parameters(), lr=1e-4)
+            first_layer = module.decoders[0].decoder.mlp.fc_layers[0]
+
+            def covs(module=module, first_layer=first_layer, tensors=tensors):
+                conditions = module._conditions(tensors["extra_categorical_covs"], tensors["extra_continuous_covs"])
+                if len(conditions) == 1:
+                    # the embeddings are concatenated to the input of the first layer
+                    weight = first_layer[0].weight
+                    conditions[0].matmul(weight[:, module.z_dim :].T).sum().backward()
+                else:
+                    module._first_layer_inputs(first_layer, module.z_dim, *conditions)[1].sum().backward()
+
+            def step(module=module, optimizer=optimizer, tensors=tensors):
+                loss = module(tensors)[2].loss
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            covs_seconds = best_time(covs, args.repeats, cuda)
+            step_seconds = best_time(step, args.repeats, cuda)
+            per_cell_times = per_cell_times or (covs_seconds, step_seconds)
+            mode = "dedup" if dedup else "per cell"
+            print(
+                f"{n_bags:>5} {mode:>8} {1000 * covs_seconds:>8.2f} {per_cell_times[0] / covs_seconds:>8.2f} "
+                f"{1000 * step_seconds:>8.1f} {per_cell_times[1] / step_seconds:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Allocations and allocated bytes of a forward + backward step of :class:`multimil.module.MultiVAETorch`.
+
+Counts the tensors allocated by the operators in one forward pass, loss and backward pass of a
+trimodal model on a mosaic batch, in which each cell has one or two of the modalities, for each MMD setting and with
+and without ``fuse_modalities``. Reports the number of allocations, the allocated megabytes and the best step time.
+
+Usage::
+
+    python benchmarks/forward_allocations.py --batch-size 256 --z-dim 30 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+from multimil.module import MultiVAETorch
+
+
+class CountAllocations(TorchDispatchMode):
+    """Count the output tensors of the dispatched operators that don't share the storage of an input."""
+
+    def __init__(self):
+        super().__init__()
+        self.n_allocations = 0
+        self.n_bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = {
+            t.untyped_storage().data_ptr()
+            for t in tree_flatten((args, kwargs))[0]
+            if isinstance(t, torch.Tensor) and t.layout == torch.strided
+        }
+        for t in tree_flatten(out)[0]:
+            if not isinstance(t, torch.Tensor) or t.layout != torch.strided:
+                continue
+            if t.untyped_storage().data_ptr() not in inputs:
+                self.n_allocations += 1
+                self.n_bytes += t.untyped_storage().nbytes()
+        return out
+
+
+def main():
+    """Print the allocations, allocated megabytes and time of a step for each MMD mode, with and without fusion."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-features", type=int, nargs=3, default=[2000, 5000, 200])
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--z-dim", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    cuda = args.device.startswith("cuda")
+    n_rna, n_atac, n_adt = args.n_features
+    x = torch.cat(
+        [
+            torch.poisson(torch.full((args.batch_size, n_rna), 0.5)),
+            (torch.rand(args.batch_size, n_atac) < 0.05).float(),
+            torch.rand(args.batch_size, n_adt),
+        ],
+        dim=1,
+    )
+    # every third cell misses one of the modalities
+    starts = [0, n_rna, n_rna + n_atac, n_rna + n_atac + n_adt]
+    missing = torch.arange(args.batch_size) % 3
+    for mod in range(3):
+        x[missing == mod, starts[mod] : starts[mod + 1]] = 0
+    tensors = {
+        "X": x.to(args.device),
+        "extra_categorical_covs": (torch.arange(args.batch_size) % 2).float().view(-1, 1).to(args.device),
+        "size_factor": x[:, :n_rna].sum(dim=1, keepdim=True).clamp(min=1).to(args.device),
+    }
+
+    print(f"{'mmd':>8} {'fused':>6} {'allocs':>7} {'MB':>8} {'ms':>8}")
+    for mmd in ["latent", "marginal", "both"]:
+        for fuse_modalities in [False, True]:
+            module = MultiVAETorch(
+                modality_lengths=args.n_features,
+                losses=["nb", "bce", "mse"],
+                cat_covariate_dims=[2],
+                cont_covariate_dims=[],
+                cat_covs_idx=torch.tensor([0]),
+                cont_covs_idx=torch.tensor([], dtype=torch.long),
+                z_dim=args.z_dim,
+                num_groups=2,
+                integrate_on_idx=0,
+                mmd=mmd,
+                loss_coefs={"integ": 1},
+                fuse_modalities=fuse_modalities,
+            ).to(args.device)
+
+            def step(module=module):
+                module(tensors)[2].loss.backward()
+
+            step()
+            with CountAllocations() as counter:
+                step()
+            n_allocations, megabytes = counter.n_allocations, counter.n_bytes / 2**20
+            times = []
+            for _ in range(args.repeats):
+                if cuda:
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                step()
+                if cuda:
+                    torch.cuda.synchronize()
+                times.append(time.perf_counter() - start)
+            print(f"{mmd:>8} {fuse_modalities!s:>6} {n_allocations:>7} {megabytes:>8.1f} {1000 * min(times):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""CPU inference time of the gated attention pooling in :class:`multimil.nn.Aggregator`.
+
+Compares the fused projection used without autograd to the separate ``attention_V``/``attention_U`` layers used
+in training, on bags of the given sizes.
+
+Usage::
+
+    python benchmarks/gated_attention.py --n-cells 10000 100000 1000000 --threads 1
+"""
+
+import argparse
+import time
+
+import torch
+
+from multimil.nn import Aggregator
+
+
+def best_time(fn, repeats):
+    """Return the fastest of `repeats` calls of `fn` after a warmup call."""
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    """Print the time of the fused and the unfused gated attention pooling for each number of cells."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-cells", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--bag-size", type=int, default=10_000)
+    parser.add_argument("--z-dim", type=int, default=30)
+    parser.add_argument("--attn-dim", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    aggregator = Aggregator(args.z_dim, scoring="gated_attn", attn_dim=args.attn_dim).eval()
+
+    def unfused(x):
+        A = aggregator.attention_weights(aggregator.attention_V(x) * aggregator.attention_U(x)).transpose(1, 2)
+        A = torch.softmax(A, dim=-1)
+        return torch.bmm(A, x).squeeze(dim=1), A
+
+    print(f"{'cells':>9} {'unfused ms':>11} {'fused ms':>9} {'speedup':>8} {'max diff':>9}")
+    for n_cells in args.n_cells:
+        bag_size = min(args.bag_size, n_cells)
+        x = torch.randn(n_cells // bag_size, bag_size, args.z_dim)
+        with torch.inference_mode():
+            reference, fused = unfused(x), aggregator(x)
+            diff = (reference[1] - fused[1]).abs().max().item()
+            t_unfused = best_time(lambda x=x: unfused(x), args.repeats)
+            t_fused = best_time(lambda x=x: aggregator(x), args.repeats)
+        print(
+            f"{n_cells:>9} {1000 * t_unfused:>11.2f} {1000 * t_fused:>9.2f} {t_unfused / t_fused:>7.2f}x {diff:>9.1e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
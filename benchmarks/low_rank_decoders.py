@@ -0,0 +1,81 @@
+"""Model size and training step time with low-rank decoder output layers.
+
+Trains :class:`multimil.module.MultiVAETorch` on one wide ``bce`` modality, e.g. ATAC peaks, with a full output layer
+and with factorized output layers at several ranks. Reports the number of parameters, which also sets the size of the
+optimizer state, for the whole module and for the decoder alone, and the best time of a forward + backward + AdamW
+step. The encoder's first layer and the elementwise loss over all features are not affected by the rank.
+
+Usage::
+
+    python benchmarks/low_rank_decoders.py --n-features 100000 --ranks 128 64 32 16 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from multimil.module import MultiVAETorch
+
+EMPTY = torch.tensor([], dtype=torch.long)
+
+
+def step_time(module, tensors, repeats):
+    """Return the fastest of `repeats` training steps of `module` on `tensors`."""
+    optimizer = torch.optim.AdamW(module.parameters(), lr=1e-4)
+    times = []
+    for _ in range(repeats):
+        if tensors["X"].is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        loss = module(tensors)[2].loss
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if tensors["X"].is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    """Print the parameters and the step time for each rank of the decoder output layer."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-features", type=int, default=100000)
+    parser.add_argument("--ranks", type=int, nargs="+", default=[128, 64, 32, 16])
+    parser.add_argument("--n-hidden", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    x = (torch.rand(args.batch_size, args.n_features) < 0.03).float()
+    tensors = {"X": x.to(args.device), "extra_categorical_covs": torch.zeros(args.batch_size, 1, device=args.device)}
+
+    print(f"{'rank':>5} {'parameters':>11} {'decoder':>11} {'step ms':>9} {'speedup':>8}")
+    full_time = None
+    for rank in [None] + args.ranks:
+        module = MultiVAETorch(
+            modality_lengths=[args.n_features],
+            losses=["bce"],
+            cat_covariate_dims=[1],
+            cont_covariate_dims=[],
+            cat_covs_idx=torch.tensor([0]),
+            cont_covs_idx=EMPTY,
+            n_hidden_encoders=[args.n_hidden],
+            n_hidden_decoders=[args.n_hidden],
+            decoder_ranks=[rank],
+        ).to(args.device)
+        n_parameters = sum(parameter.numel() for parameter in module.parameters())
+        n_decoder_parameters = sum(parameter.numel() for parameter in module.decoders[0].parameters())
+        seconds = step_time(module, tensors, args.repeats)
+        full_time = full_time or seconds
+        print(
+            f"{str(rank):>5} {n_parameters:>11,} {n_decoder_parameters:>11,} {1000 * seconds:>9.1f} "
+            f"{full_time / seconds:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Training and inference throughput with bfloat16 autocast.
+
+Times forward + backward passes of :class:`multimil.module.MultiVAETorch` and :class:`multimil.module.MILClassifierTorch`
+and the inference pass of :class:`multimil.module.MultiVAETorch`, in fp32 and with bfloat16 autocast as used by
+``mixed_precision=True``, and reports the relative difference of the losses.
+
+Usage::
+
+    python benchmarks/mixed_precision.py --batch-size 1024 --modality-lengths 4000 1000 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from multimil.module import MILClassifierTorch, MultiVAETorch
+
+EMPTY = torch.tensor([], dtype=torch.long)
+
+
+def timed(fn, repeats, device):
+    """Return the output of the last call of `fn` and the fastest of `repeats` calls."""
+    times = []
+    for _ in range(repeats):
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = fn()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return out, min(times)
+
+
+def compare(name, module, tensors, repeats, device):
+    """Print the fp32 and bf16 time and the relative output difference of training and inference."""
+
+    def train_step():
+        loss = module(tensors)[2].loss
+        loss.backward()
+        module.zero_grad(set_to_none=True)
+        return loss.detach()
+
+    def bf16(fn):
+        def wrapper():
+            with torch.autocast(device, dtype=torch.bfloat16):
+                return fn()
+
+        return wrapper
+
+    def inference():
+        with torch.inference_mode():
+            return module.inference(**module._get_inference_input(tensors))["z"]
+
+    rows = [("train", train_step)]
+    if isinstance(module, MultiVAETorch):
+        rows.append(("inference", inference))
+    for mode, fn in rows:
+        torch.manual_seed(0)
+        fp32_out, fp32_time = timed(fn, repeats, device)
+        torch.manual_seed(0)
+        bf16_out, bf16_time = timed(bf16(fn), repeats, device)
+        rel_diff = ((bf16_out.float() - fp32_out).norm() / fp32_out.norm()).item()
+        print(
+            f"{name:>5} {mode:>9} {1000 * fp32_time:>9.1f} {1000 * bf16_time:>9.1f} "
+            f"{fp32_time / bf16_time:>8.2f} {rel_diff:>9.2e}"
+        )
+
+
+def main():
+    """Print the fp32 and bf16 comparison of each module."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--modality-lengths", type=int, nargs="+", default=[4000, 1000])
+    parser.add_argument("--n-hidden", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    n_modality = len(args.modality_lengths)
+    n = args.batch_size
+    x = torch.rand(n, sum(args.modality_lengths))
+    x[:, : args.modality_lengths[0]] = torch.poisson(x[:, : args.modality_lengths[0]])
+    x[:, args.modality_lengths[0] :] = (x[:, args.modality_lengths[0] :] > 0.9).float()
+    samples = torch.sort(torch.randint(0, 8, (n,))).values
+    vae_tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.randint(0, 4, (n, 1)).float(),
+        "size_factor": x[:, : args.modality_lengths[0]].sum(dim=1, keepdim=True) + 1,
+    }
+    mil_tensors = {"X": torch.randn(n, 64), "extra_categorical_covs": torch.stack([samples, samples % 2], 1).float()}
+    vae_tensors = {key: value.to(args.device) for key, value in vae_tensors.items()}
+    mil_tensors = {key: value.to(args.device) for key, value in mil_tensors.items()}
+
+    vae = MultiVAETorch(
+        modality_lengths=args.modality_lengths,
+        losses=["nb"] + ["bce"] * (n_modality - 1),
+        cat_covariate_dims=[4],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=EMPTY,
+        num_groups=4,
+        integrate_on_idx=0,
+        loss_coefs={"integ": 1},
+        n_hidden_encoders=[args.n_hidden] * n_modality,
+        n_hidden_decoders=[args.n_hidden] * n_modality,
+        dropout=0.0,
+    ).to(args.device)
+    mil = MILClassifierTorch(
+        z_dim=64,
+        num_classification_classes=[2],
+        class_idx=torch.tensor([1]),
+        ord_idx=EMPTY,
+        reg_idx=EMPTY,
+        sample_idx=0,
+        sample_batch_size=128,
+        dropout=0.0,
+    ).to(args.device)
+
+    print(f"{'':>5} {'':>9} {'fp32 ms':>9} {'bf16 ms':>9} {'speedup':>8} {'rel. diff':>9}")
+    compare("vae", vae, vae_tensors, args.repeats, args.device)
+    compare("mil", mil, mil_tensors, args.repeats, args.device)
+
+
+if __name__ == "__main__":
+    main()
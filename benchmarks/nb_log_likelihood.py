@@ -0,0 +1,81 @@
+"""Time of the NB and ZINB log-likelihoods of scvi-tools and of :mod:`multimil.distributions` at several densities.
+
+Evaluates the log-likelihood of Poisson counts, summed over the features of each cell, with the elementwise functions
+that back the scvi-tools distributions and with :func:`multimil.distributions.nb_log_likelihood` and
+:func:`multimil.distributions.zinb_log_likelihood`, once on all entries and once with ``sparse=True``, which only
+evaluates the terms that vanish for zero counts on the nonzero entries. Reports the best forward + backward time for
+each Poisson rate and the resulting density.
+
+Usage::
+
+    python benchmarks/nb_log_likelihood.py --n-features 30000 --rates 0.05 0.2 0.5 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+from scvi.distributions._negative_binomial import log_nb_positive, log_zinb_positive
+
+from multimil.distributions import nb_log_likelihood, zinb_log_likelihood
+
+
+def best_time(fn, repeats, cuda):
+    """Return the fastest of `repeats` forward and backward passes of `fn` after a warmup call."""
+    times = []
+    for _ in range(repeats + 1):
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn().sum().backward()
+        if cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    # the first call warms up the allocator
+    return min(times[1:])
+
+
+def main():
+    """Print the time of the scvi-tools, dense and sparse likelihoods for each density."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-features", type=int, default=30000)
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.05, 0.2, 0.5])
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    cuda = args.device.startswith("cuda")
+    shape = (args.batch_size, args.n_features)
+    mu = torch.rand(shape, device=args.device, requires_grad=True)
+    theta = torch.rand(args.n_features, device=args.device, requires_grad=True)
+    zi_logits = torch.randn(shape, device=args.device, requires_grad=True)
+
+    print(f"{'density':>8} {'loss':>5} {'scvi ms':>8} {'dense ms':>9} {'speedup':>8} {'sparse ms':>10} {'speedup':>8}")
+    for rate in args.rates:
+        x = torch.poisson(torch.full(shape, rate, device=args.device))
+        density = (x > 0).float().mean().item()
+        for name, scvi_fn, fused_fn in [
+            (
+                "nb",
+                lambda x=x: log_nb_positive(x, mu, theta).sum(-1),
+                lambda sparse, x=x: nb_log_likelihood(x, mu, theta, sparse=sparse),
+            ),
+            (
+                "zinb",
+                lambda x=x: log_zinb_positive(x, mu, theta, zi_logits).sum(-1),
+                lambda sparse, x=x: zinb_log_likelihood(x, mu, theta, zi_logits, sparse=sparse),
+            ),
+        ]:
+            scvi_seconds = best_time(scvi_fn, args.repeats, cuda)
+            dense_seconds = best_time(lambda fused_fn=fused_fn: fused_fn(False), args.repeats, cuda)
+            sparse_seconds = best_time(lambda fused_fn=fused_fn: fused_fn(True), args.repeats, cuda)
+            print(
+                f"{density:>8.3f} {name:>5} {1000 * scvi_seconds:>8.1f} {1000 * dense_seconds:>9.1f} "
+                f"{scvi_seconds / dense_seconds:>8.2f} {1000 * sparse_seconds:>10.1f} {scvi_seconds / sparse_seconds:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
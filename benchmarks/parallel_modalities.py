@@ -0,0 +1,83 @@
+"""Training step time with the modality branches of :class:`multimil.module.MultiVAETorch` in sequence and in threads.
+
+Trains a trimodal model (``nb``, ``bce`` and ``mse`` modalities, e.g. RNA, ATAC and ADT) with the default sequential
+path and with ``parallel_modalities=True``, for each given number of intra-op threads. Reports the best forward +
+backward + AdamW step time. The parallel path splits the intra-op threads evenly between the modalities, so it only
+helps when a single modality doesn't keep all cores busy.
+
+Usage::
+
+    python benchmarks/parallel_modalities.py --n-features 20000 50000 200 --threads 4 16 --device cpu
+"""
+
+import argparse
+import time
+
+import torch
+
+from multimil.module import MultiVAETorch
+
+
+def main():
+    """Print the step time of sequential and parallel modalities for each number of threads."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-features", type=int, nargs=3, default=[20000, 50000, 200])
+    parser.add_argument("--threads", type=int, nargs="+", default=[torch.get_num_threads()])
+    parser.add_argument("--n-hidden", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    n_rna, n_atac, n_adt = args.n_features
+    x = torch.cat(
+        [
+            torch.poisson(torch.full((args.batch_size, n_rna), 0.5)),
+            (torch.rand(args.batch_size, n_atac) < 0.03).float(),
+            torch.randn(args.batch_size, n_adt),
+        ],
+        dim=1,
+    ).to(args.device)
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.zeros(args.batch_size, 1, device=args.device),
+        "size_factor": x[:, :n_rna].sum(dim=1, keepdim=True),
+    }
+
+    print(f"{'threads':>7} {'mode':>10} {'step ms':>9} {'speedup':>8}")
+    for n_threads in args.threads:
+        torch.set_num_threads(n_threads)
+        sequential_seconds = None
+        for parallel in [False, True]:
+            module = MultiVAETorch(
+                modality_lengths=args.n_features,
+                losses=["nb", "bce", "mse"],
+                cat_covariate_dims=[1],
+                cont_covariate_dims=[],
+                cat_covs_idx=torch.tensor([0]),
+                cont_covs_idx=torch.tensor([], dtype=torch.long),
+                n_hidden_encoders=[args.n_hidden] * 3,
+                n_hidden_decoders=[args.n_hidden] * 3,
+                parallel_modalities=parallel,
+            ).to(args.device)
+            optimizer = torch.optim.AdamW(module.parameters(), lr=1e-4)
+            times = []
+            for _ in range(args.repeats + 1):
+                start = time.perf_counter()
+                loss = module(tensors)[2].loss
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                times.append(time.perf_counter() - start)
+            # the first step warms up the allocator and the thread pools
+            seconds = min(times[1:])
+            sequential_seconds = sequential_seconds or seconds
+            mode = "parallel" if parallel else "sequential"
+            print(f"{n_threads:>7} {mode:>10} {1000 * seconds:>9.1f} {sequential_seconds / seconds:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Speed of the sampled reconstruction loss for wide count modalities.
+
+Times forward + backward passes of :class:`multimil.module.MultiVAETorch` with a single ``nb`` modality of sparse
+counts, with the full reconstruction loss and with ``n_negative_samples`` features drawn per minibatch, and reports
+the relative difference between the mean sampled and full losses and the fraction of decoded columns.
+
+Usage::
+
+    python benchmarks/sampled_reconstruction.py --n-features 20000 100000 --density 0.02 --n-negative-samples 256
+"""
+
+import argparse
+import time
+
+import torch
+
+from multimil.module import MultiVAETorch
+
+EMPTY = torch.tensor([], dtype=torch.long)
+
+
+def run(module, tensors, repeats):
+    """Return the fastest of `repeats` forward and backward passes and the loss of each pass."""
+    times, losses = [], []
+    for seed in range(repeats):
+        torch.manual_seed(seed)
+        start = time.perf_counter()
+        loss = module(tensors)[2].loss
+        loss.backward()
+        if tensors["X"].is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+        losses.append(loss.detach())
+        module.zero_grad(set_to_none=True)
+    return min(times), torch.stack(losses)
+
+
+def main():
+    """Print the step times and the loss difference of the full and the sampled loss for each number of features."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-features", type=int, nargs="+", default=[20000, 100000])
+    parser.add_argument("--density", type=float, default=0.02)
+    parser.add_argument("--n-negative-samples", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    print(f"{'features':>9} {'decoded':>8} {'full ms':>9} {'sampled ms':>11} {'speedup':>8} {'rel. diff':>10}")
+    for n_features in args.n_features:
+        torch.manual_seed(0)
+        # heavy-tailed feature means, a few features are detected in most cells and most features in few cells
+        rates = torch.exp(2 * torch.randn(1, n_features))
+        rates = rates * args.density * n_features / rates.sum()
+        x = torch.poisson(rates.expand(args.batch_size, -1))
+        tensors = {
+            "X": x.to(args.device),
+            "extra_categorical_covs": torch.zeros(args.batch_size, 1, device=args.device),
+            "size_factor": x.sum(dim=1, keepdim=True).to(args.device) + 1,
+        }
+        kwargs = {
+            "modality_lengths": [n_features],
+            "losses": ["nb"],
+            "cat_covariate_dims": [1],
+            "cont_covariate_dims": [],
+            "cat_covs_idx": torch.tensor([0]),
+            "cont_covs_idx": EMPTY,
+            "dropout": 0.0,
+        }
+        full = MultiVAETorch(**kwargs).to(args.device)
+        sampled = MultiVAETorch(**kwargs, n_negative_samples=args.n_negative_samples).to(args.device)
+        sampled.load_state_dict(full.state_dict())
+        full_time, full_loss = run(full, tensors, args.repeats)
+        sampled_time, sampled_loss = run(sampled, tensors, args.repeats)
+        rel_diff = ((sampled_loss.mean() - full_loss.mean()) / full_loss.mean()).item()
+        decoded = min(1.0, (x > 0).any(dim=0).float().mean().item() + args.n_negative_samples / n_features)
+        print(
+            f"{n_features:>9} {decoded:>8.1%} {1000 * full_time:>9.1f} {1000 * sampled_time:>11.1f} "
+            f"{full_time / sampled_time:>8.2f} {rel_diff:>10.2%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import copy
 import itertools
+from math import ceil
 import numpy as np
 import torch
 from scvi.data import AnnDataManager
@@ -10,6 +11,7 @@ from torch.utils.data import DataLoader, Sampler
 # https://github.com/YosefLab/scvi-tools/blob/ac0c3e04fcc2772fdcf7de4de819db3af9465b6b/scvi/dataloaders/_ann_dataloader.py#L15
 # Accessed on 4 November 2021
 
+
 class StratifiedSampler(Sampler):
     """Custom stratified sampler to sample the same number of observations from each group in each mini-batch.
 
@@ -31,6 +33,7 @@ class StratifiedSampler(Sampler):
     shuffle_classes : bool, optional
         If ``True``, shuffles classes before sampling, by default ``True``.
     """
+
     def __init__(
         self,
         indices: np.ndarray,
@@ -134,10 +137,12 @@ class StratifiedSampler(Sampler):
     def __len__(self):
         return self.length
 
+
 # Adjusted from scvi-tools
 # https://github.com/scverse/scvi-tools/blob/0b802762869c43c9f49e69fe62b1a5a9b5c4dae6/scvi/dataloaders/_ann_dataloader.py#L89
 # Accessed on 5 November 2022
 
+
 class GroupAnnDataLoader(DataLoader):
     """DataLoader for loading tensors from AnnData objects.
 
@@ -163,9 +168,12 @@ class GroupAnnDataLoader(DataLoader):
         Whether to drop the last incomplete batch, by default True.
     sampler : Sampler, optional
         Sampler to use, by default StratifiedSampler.
+    load_sparse_tensor : bool, optional
+        Whether to load sparse CSR or CSC arrays as sparse :class:`~torch.Tensor` with the same layout, by default False.
     **data_loader_kwargs
         Additional keyword arguments for DataLoader.
     """
+
     def __init__(
         self,
         adata_manager: AnnDataManager,
@@ -178,6 +186,7 @@ class GroupAnnDataLoader(DataLoader):
         data_and_attributes: dict | None = None,
         drop_last: bool | int = True,
         sampler: Sampler | None = StratifiedSampler,
+        load_sparse_tensor: bool = False,
         **data_loader_kwargs,
     ):
         if adata_manager.adata is None:
@@ -194,7 +203,9 @@ class GroupAnnDataLoader(DataLoader):
                 f"{group_column} required for model but not in categorical covariates. Must be one of {adata_manager.registry['setup_args']['categorical_covariate_keys']}."
             )
 
-        self.dataset = AnnTorchDataset(adata_manager, getitem_tensors=data_and_attributes)
+        self.dataset = AnnTorchDataset(
+            adata_manager, getitem_tensors=data_and_attributes, load_sparse_tensor=load_sparse_tensor
+        )
 
         if min_size_per_class is None:
             min_size_per_class = batch_size // 2
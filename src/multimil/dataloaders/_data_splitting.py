@@ -3,6 +3,9 @@ from scvi.dataloaders import DataSplitter
 from scvi.model._utils import parse_device_args
 from typing import Optional, Union
 
+from ._ann_dataloader import GroupAnnDataLoader
+
+
 class GroupDataSplitter(DataSplitter):
     """Creates data loaders ``train_set``, ``validation_set``, ``test_set``.
 
@@ -18,8 +21,12 @@ class GroupDataSplitter(DataSplitter):
         Proportion of cells to use as the train set, by default 0.9.
     validation_size : Optional[float], optional
         Proportion of cells to use as the validation set, by default None. If None, is set to 1 - ``train_size``.
+    drop_last : bool | int, optional
+        Whether to drop the last incomplete chunk of each group in the data loaders, passed to the
+        ``StratifiedSampler``, by default True.
     **kwargs
-        Keyword arguments for data loader. Data loader class is :class:`~mtg.dataloaders.GroupAnnDataLoader`.
+        Keyword arguments for :class:`~scvi.dataloaders.DataSplitter`, e.g. ``load_sparse_tensor``, and for the data
+        loader. Data loader class is :class:`~mtg.dataloaders.GroupAnnDataLoader`.
     """
 
     def __init__(
@@ -28,9 +35,11 @@ class GroupDataSplitter(DataSplitter):
         group_column: str,
         train_size: float = 0.9,
         validation_size: Optional[float] = None,
+        drop_last: bool | int = True,
         **kwargs,
     ):
         self.group_column = group_column
+        self.drop_last = drop_last
         super().__init__(adata_manager, train_size, validation_size, **kwargs)
 
     def _create_dataloader(self, indices, shuffle: bool):
@@ -41,7 +50,8 @@ class GroupDataSplitter(DataSplitter):
                 self.group_column,
                 indices=indices,
                 shuffle=shuffle,
-                drop_last=True,
+                drop_last=self.drop_last,
+                load_sparse_tensor=self.load_sparse_tensor,
                 pin_memory=self.pin_memory,
                 **self.data_loader_kwargs,
             )
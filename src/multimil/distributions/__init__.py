@@ -1,3 +1,4 @@
 from ._mmd import MMD
+from ._negative_binomial import nb_log_likelihood, zinb_log_likelihood
 
-__all__ = ["MMD"]
+__all__ = ["MMD", "nb_log_likelihood", "zinb_log_likelihood"]
@@ -1,5 +1,69 @@
 import torch
-from typing import Optional, List
+from typing import List, Literal, Optional
+
+from multimil.utils import autocast_fp32
+
+_DEFAULT_GAMMAS = [1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, 5, 10, 15, 20, 25, 30, 35, 100, 1e3, 1e4, 1e5, 1e6]
+
+
+def _block_kernel(x: torch.Tensor, y: torch.Tensor, gamma: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Multi-bandwidth Gaussian kernel between two blocks and its derivative w.r.t. the squared distance."""
+    D = torch.cdist(x, y).pow(2).unsqueeze(-1)
+    E = torch.exp(-D * gamma)
+    return E.mean(dim=-1), -(E * gamma).mean(dim=-1)
+
+
+def _tiles(n_x: int, n_y: int, block_size: int, symmetric: bool):
+    """Row and column slices of the tiles of a kernel matrix, only those on and above the diagonal if symmetric."""
+    for i in range(0, n_x, block_size):
+        for j in range(i if symmetric else 0, n_y, block_size):
+            yield slice(i, i + block_size), slice(j, j + block_size)
+
+
+class _TiledGaussianSetSums(torch.autograd.Function):
+    """Kernel sums between weighted sets of rows of ``x`` and ``y``, ``Wx.T @ K(x, y) @ Wy``, computed block by block.
+
+    Only one ``(block_size, block_size, n_gammas)`` tile of the kernel matrix is alive at a time, in forward as
+    well as in backward, where the tiles are recomputed instead of being saved. If ``y`` is ``None``, the sums are
+    between the sets of rows of ``x`` and, as the kernel is symmetric, only the tiles on and above the diagonal are
+    evaluated.
+    """
+
+    @staticmethod
+    def forward(ctx, x, x_weights, y, y_weights, gamma, block_size):
+        symmetric = y is None
+        if symmetric:
+            y, y_weights = x, x_weights
+        ctx.save_for_backward(x, x_weights, y, y_weights, gamma)
+        ctx.block_size = block_size
+        ctx.symmetric = symmetric
+        sums = x.new_zeros(x_weights.shape[1], y_weights.shape[1])
+        for i, j in _tiles(x.shape[0], y.shape[0], block_size, symmetric):
+            K, _ = _block_kernel(x[i], y[j], gamma)
+            block_sums = x_weights[i].T @ K @ y_weights[j]
+            sums += block_sums
+            if symmetric and i != j:
+                sums += block_sums.T
+        return sums
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, x_weights, y, y_weights, gamma = ctx.saved_tensors
+        symmetric = ctx.symmetric
+        # d/dx_a sum_st G_st S_st = 2 * sum_b M_ab (x_a - y_b) with M = (Wx G Wy^T) * k'(D), and likewise for y_b,
+        # both sides of the symmetric sums are x and take G + G^T on the tiles above the diagonal
+        grad = grad_output + grad_output.T if symmetric else grad_output
+        grad_x = torch.zeros_like(x)
+        grad_y = grad_x if symmetric else torch.zeros_like(y)
+        for i, j in _tiles(x.shape[0], y.shape[0], ctx.block_size, symmetric):
+            xi, yj = x[i], y[j]
+            _, dK = _block_kernel(xi, yj, gamma)
+            M = 2 * (x_weights[i] @ grad @ y_weights[j].T) * dK
+            grad_x[i] += M.sum(dim=1, keepdim=True) * xi - M @ yj
+            if not symmetric or i != j:
+                grad_y[j] += M.sum(dim=0).unsqueeze(-1) * yj - M.T @ xi
+        return grad_x, None, None if symmetric else grad_y, None, None, None
+
 
 class MMD(torch.nn.Module):
     """Maximum mean discrepancy.
@@ -10,11 +74,47 @@ class MMD(torch.nn.Module):
         Indicates if to use Gaussian kernel. One of
         * ``'gaussian'`` - use Gaussian kernel
         * ``'not gaussian'`` - do not use Gaussian kernel.
+    block_size : int
+        Number of rows and columns of the kernel matrix that are evaluated at once. Bounds the memory of the
+        Gaussian kernel to ``block_size * block_size * n_gammas`` elements independently of the batch size.
+    estimator : str
+        How to estimate the MMD with the Gaussian kernel. One of
+        * ``'exact'`` - quadratic-time estimate from the full kernel matrix
+        * ``'linear'`` - linear-time estimate from disjoint pairs of observations (Gretton et al., 2012)
+        * ``'rff'`` - random Fourier feature approximation of the kernel (Rahimi and Recht, 2007).
+    bandwidth : str
+        Bandwidths of the Gaussian kernel. One of
+        * ``'fixed'`` - 19 fixed gammas ranging from 1e-6 to 1e6
+        * ``'median'`` - median heuristic, ``gamma = 1 / (scale * median squared distance)`` for each of
+          ``bandwidth_scales``, recomputed on every call.
+    bandwidth_scales : tuple[float, ...]
+        Multipliers of the median squared distance when ``bandwidth='median'``.
+    n_features : int
+        Number of random Fourier features per bandwidth when ``estimator='rff'``.
     """
 
-    def __init__(self, kernel_type: str = "gaussian"):
+    def __init__(
+        self,
+        kernel_type: str = "gaussian",
+        block_size: int = 512,
+        estimator: Literal["exact", "linear", "rff"] = "exact",
+        bandwidth: Literal["fixed", "median"] = "fixed",
+        bandwidth_scales: tuple[float, ...] = (0.25, 0.5, 1.0, 2.0, 4.0),
+        n_features: int = 128,
+    ):
         super().__init__()
+        if estimator not in ["exact", "linear", "rff"]:
+            raise ValueError(
+                f'estimator should be one of ["exact", "linear", "rff"], but estimator={estimator} was passed.'
+            )
+        if bandwidth not in ["fixed", "median"]:
+            raise ValueError(f'bandwidth should be one of ["fixed", "median"], but bandwidth={bandwidth} was passed.')
         self.kernel_type = kernel_type
+        self.block_size = block_size
+        self.estimator = estimator
+        self.bandwidth = bandwidth
+        self.bandwidth_scales = bandwidth_scales
+        self.n_features = n_features
 
     def gaussian_kernel(
         self,
@@ -24,6 +124,8 @@ class MMD(torch.nn.Module):
     ) -> torch.Tensor:
         """Apply Gaussian kernel.
 
+        Materializes the full kernel matrix, use :meth:`gaussian_kernel_mean` when only its mean is needed.
+
         Parameters
         ----------
         x : torch.Tensor
@@ -38,26 +140,152 @@ class MMD(torch.nn.Module):
         torch.Tensor
             Gaussian kernel between ``x`` and ``y``.
         """
-
-        # Check if x and y have the same shape
-        if x.shape != y.shape:
-            raise ValueError(f"Input tensors x and y must have the same shape, but got {x.shape} and {y.shape}")
-
         if gamma is None:
-            gamma = [1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1,
-                     1, 5, 10, 15, 20, 25, 30, 35, 100,
-                     1e3, 1e4, 1e5, 1e6]
+            gamma = _DEFAULT_GAMMAS
 
         # Convert gamma to a torch.Tensor (ensure it's on the correct device)
         gamma = torch.as_tensor(gamma, device=x.device, dtype=x.dtype)
-        D = torch.cdist(x, y).pow(2).unsqueeze(-1)
+        K, _ = _block_kernel(x, y, gamma)
+        return K
 
-        # This computes the exponential for all gamma values in one operation and then averages over the gamma dimension.
-        gamma = gamma.view(1, 1, -1)
-        K = torch.exp(-D * gamma).mean(dim=-1)
+    def gaussian_kernel_mean(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        gamma: Optional[List[float]] = None,
+    ) -> torch.Tensor:
+        """Mean of the Gaussian kernel matrix between ``x`` and ``y``, accumulated block by block.
 
-        return K
+        Only the tiles between ``x`` and ``y`` are evaluated, not those within ``x`` or within ``y``.
 
+        Parameters
+        ----------
+        x : torch.Tensor
+            Tensor from the first distribution.
+        y : torch.Tensor
+            Tensor from the second distribution.
+        gamma : Optional[List[float]]
+            List of gamma parameters.
+
+        Returns
+        -------
+        torch.Tensor
+            Scalar tensor, equal to ``self.gaussian_kernel(x, y, gamma).mean()``.
+        """
+        x_weights, y_weights = x.new_ones(x.shape[0], 1), y.new_ones(y.shape[0], 1)
+        return self._gaussian_set_sums(x, x_weights, y, y_weights, gamma)[0, 0] / (x.shape[0] * y.shape[0])
+
+    def _gaussian_set_sums(
+        self,
+        x: torch.Tensor,
+        x_weights: torch.Tensor,
+        y: Optional[torch.Tensor] = None,
+        y_weights: Optional[torch.Tensor] = None,
+        gamma: Optional[List[float]] = None,
+    ) -> torch.Tensor:
+        if gamma is None:
+            gamma = _DEFAULT_GAMMAS
+        gamma = torch.as_tensor(gamma, device=x.device, dtype=x.dtype)
+        return _TiledGaussianSetSums.apply(x, x_weights, y, y_weights, gamma, self.block_size)
+
+    def _gammas(self, z: torch.Tensor) -> torch.Tensor:
+        if self.bandwidth == "fixed":
+            return torch.as_tensor(_DEFAULT_GAMMAS, device=z.device, dtype=z.dtype)
+        # median heuristic on at most ~1024 evenly spaced rows, treated as a constant
+        with torch.no_grad():
+            sub = z[:: max(1, z.shape[0] // 1024)]
+            median = torch.pdist(sub).pow(2).median().clamp(min=1e-8)
+            scales = torch.as_tensor(self.bandwidth_scales, device=z.device, dtype=z.dtype)
+            return 1.0 / (median * scales)
+
+    def _exact_mmd(self, z, weights, n, p, q, gamma):
+        sums = self._gaussian_set_sums(z, weights, gamma=gamma)
+        return sums[p, p] / n[p] ** 2 + sums[q, q] / n[q] ** 2 - 2 * sums[p, q] / (n[p] * n[q])
+
+    def _rff_mmd(self, z, weights, n, p, q, gamma):
+        # exp(-gamma * ||x - y||^2) = E[cos(w^T (x - y))] with w ~ N(0, 2 * gamma * I)
+        omega = torch.randn(z.shape[1], self.n_features, device=z.device, dtype=z.dtype)
+        omega = omega * (2 * gamma).sqrt().view(-1, 1, 1)
+        scale = (len(gamma) * self.n_features) ** -0.5
+        means = 0
+        for i in range(0, z.shape[0], self.block_size):
+            proj = torch.einsum("nd,gdf->ngf", z[i : i + self.block_size], omega).flatten(start_dim=1)
+            features = torch.cat([proj.cos(), proj.sin()], dim=-1) * scale
+            means = means + weights[i : i + self.block_size].T @ features
+        means = means / n.unsqueeze(-1)
+        return (means[p] - means[q]).pow(2).sum(dim=-1)
+
+    def _linear_mmd(self, z, weights, n, p, q, gamma):
+        # lay the rows of each set out side by side, (n_sets, max_set_size, z_dim)
+        sets = weights > 0
+        rank = torch.cumsum(sets, dim=0) - 1
+        rows, cols = sets.nonzero(as_tuple=True)
+        padded = z.new_zeros(sets.shape[1], int(n.max()), z.shape[1])
+        padded[cols, rank[rows, cols]] = z[rows]
+        position = torch.arange(padded.shape[1], device=z.device)
+
+        def paired_kernel(a, b):
+            return torch.exp(-(a - b).pow(2).sum(dim=-1, keepdim=True) * gamma).mean(dim=-1)
+
+        # within-set terms from disjoint consecutive pairs, cross-set terms from rows of the same rank
+        half = padded.shape[1] // 2
+        n_within = torch.div(n, 2, rounding_mode="floor")
+        within = paired_kernel(padded[:, 0 : 2 * half : 2], padded[:, 1 : 2 * half : 2])
+        within = (within * (position[:half] < n_within.unsqueeze(-1))).sum(dim=-1) / n_within.clamp(min=1)
+        n_cross = torch.minimum(n[p], n[q])
+        cross = paired_kernel(padded[p], padded[q])
+        cross = (cross * (position < n_cross.unsqueeze(-1))).sum(dim=-1) / n_cross
+        return within[p] + within[q] - 2 * cross
+
+    @autocast_fp32
+    def between_sets(self, z: torch.Tensor, sets: torch.Tensor, pairs: torch.Tensor) -> torch.Tensor:
+        """Sum of the MMDs between pairs of sets of rows of ``z``.
+
+        All pairs are read from a single pass over ``z``. Sets can have different sizes and are compared without
+        resampling. Pairs where one of the sets has less than two rows are skipped.
+
+        Parameters
+        ----------
+        z : torch.Tensor
+            Tensor with shape ``(n_obs, z_dim)``.
+        sets : torch.Tensor
+            Binary tensor with shape ``(n_obs, n_sets)`` indicating which rows belong to which set.
+        pairs : torch.Tensor
+            Integer tensor with shape ``(n_pairs, 2)`` with the indices of the sets to compare.
+
+        Returns
+        -------
+        torch.Tensor
+            Sum of the MMDs over ``pairs``.
+        """
+        weights = sets.to(z.dtype)
+        n = weights.sum(dim=0)
+        p, q = pairs[:, 0], pairs[:, 1]
+        valid = (n[p] > 1) & (n[q] > 1)
+        n = n.clamp(min=1)
+
+        if self.kernel_type == "gaussian":
+            gamma = self._gammas(z)
+            if self.estimator == "exact":
+                mmd = self._exact_mmd(z, weights, n, p, q, gamma)
+            elif self.estimator == "linear":
+                mmd = self._linear_mmd(z, weights, n, p, q, gamma)
+            else:
+                mmd = self._rff_mmd(z, weights, n, p, q, gamma)
+        else:
+            means = (weights.T @ z) / n.unsqueeze(-1)
+            second_moments = torch.einsum("is,id,ie->sde", weights, z, z)
+            covas = (second_moments - n.view(-1, 1, 1) * means.unsqueeze(-1) * means.unsqueeze(-2)) / (n - 1).clamp(
+                min=1
+            ).view(-1, 1, 1)
+
+            mean_diff = (means[p] - means[q]).pow(2).mean(dim=-1)
+            cova_diff = (covas[p] - covas[q]).pow(2).mean(dim=(-2, -1))
+            mmd = mean_diff + cova_diff
+
+        return torch.where(valid, mmd, torch.zeros_like(mmd)).sum()
+
+    @autocast_fp32
     def forward(self, x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
         """Forward computation.
 
@@ -71,41 +299,24 @@ class MMD(torch.nn.Module):
         Parameters
         ----------
         x : torch.Tensor
-            Tensor with shape ``(batch_size, z_dim)``.
+            Tensor with shape ``(batch_size_x, z_dim)``.
         y : torch.Tensor
-            Tensor with shape ``(batch_size, z_dim)``.
+            Tensor with shape ``(batch_size_y, z_dim)``.
 
         Returns
         -------
         torch.Tensor
             MMD between ``x`` and ``y``.
         """
-        # In case there is only one sample in a batch belonging to one of the groups, then skip the batch
-        if len(x) == 1 or len(y) == 1:
-            return torch.tensor(0.0)
-
-        # Resampling logic to ensure x and y have the same shape NEW (03.10.2024)
-        if x.shape[0] > y.shape[0]:
-            indices = torch.randperm(x.shape[0])[:y.shape[0]]
-            x = x[indices]
-        elif y.shape[0] > x.shape[0]:
-            indices = torch.randperm(y.shape[0])[:x.shape[0]]
-            y = y[indices]
-
-        if self.kernel_type == "gaussian":
-            Kxx = self.gaussian_kernel(x, x).mean()
-            Kyy = self.gaussian_kernel(y, y).mean()
-            Kxy = self.gaussian_kernel(x, y).mean()
-            return Kxx + Kyy - 2 * Kxy
-        else:
-            mean_x = x.mean(0, keepdim=True)
-            mean_y = y.mean(0, keepdim=True)
-            cent_x = x - mean_x
-            cent_y = y - mean_y
-            cova_x = (cent_x.t() @ cent_x) / (len(x) - 1)
-            cova_y = (cent_y.t() @ cent_y) / (len(y) - 1)
+        z, sets = _concat_sets(x, y)
+        pairs = torch.tensor([[0, 1]], device=z.device)
+        return self.between_sets(z, sets, pairs)
 
-            mean_diff = (mean_x - mean_y).pow(2).mean()
-            cova_diff = (cova_x - cova_y).pow(2).mean()
 
-            return mean_diff + cova_diff
+def _concat_sets(x: torch.Tensor, y: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Stack ``x`` and ``y`` and return the membership of the rows to the two sets."""
+    z = torch.cat([x, y])
+    sets = torch.zeros(z.shape[0], 2, dtype=torch.bool, device=z.device)
+    sets[: x.shape[0], 0] = True
+    sets[x.shape[0] :, 1] = True
+    return z, sets
@@ -0,0 +1,103 @@
+import torch
+from torch.nn import functional as F
+
+
+def _nonzero_terms(x, mu, theta, log_theta_mu, eps, sparse):
+    """Sum over the features of the terms of the negative binomial log-likelihood that vanish for zero counts.
+
+    Includes ``-lgamma(x + 1)``, which only depends on the data and is never part of the gradient path.
+    """
+    if not sparse:
+        terms = x * (torch.log(mu + eps) - log_theta_mu) + torch.lgamma(x + theta) - torch.lgamma(theta)
+        return torch.sum(terms - torch.lgamma(x + 1), dim=-1)
+    cells, features = x.nonzero(as_tuple=True)
+    counts, theta = x[cells, features], theta.expand_as(x)[cells, features]
+    terms = (
+        counts * (torch.log(mu[cells, features] + eps) - log_theta_mu[cells, features])
+        + torch.lgamma(counts + theta)
+        - torch.lgamma(theta)
+        - torch.lgamma(counts + 1)
+    )
+    return terms.new_zeros(x.shape[0]).index_add(0, cells, terms)
+
+
+def nb_log_likelihood(
+    x: torch.Tensor, mu: torch.Tensor, theta: torch.Tensor, eps: float = 1e-8, sparse: bool = False
+) -> torch.Tensor:
+    """Negative binomial log-likelihood of each cell, summed over the features.
+
+    Gives the same values as ``NegativeBinomial(mu, theta).log_prob(x).sum(-1)`` of scvi-tools. Only
+    ``log(theta + mu)`` and its product with ``theta``, a matrix-vector product for a dispersion shared by the cells,
+    are evaluated for every entry, the other terms, including the ``lgamma`` of the counts, vanish for zero counts and
+    are only evaluated for the nonzero entries of ``x`` if ``sparse``.
+
+    Parameters
+    ----------
+    x
+        Counts of shape ``(batch_size, n_features)``.
+    mu
+        Means of shape ``(batch_size, n_features)``.
+    theta
+        Inverse dispersion of shape ``(n_features,)`` or ``(1, n_features)`` if shared by the cells, or of shape
+        ``(batch_size, n_features)``.
+    eps
+        Numerical stability constant.
+    sparse
+        Whether to gather the nonzero entries of ``x`` for the terms that vanish for zero counts. Faster if at most
+        about a quarter of the counts are nonzero, but the number of gathered entries depends on the data, which
+        breaks compiled graphs into pieces.
+
+    Returns
+    -------
+    Log-likelihood of shape ``(batch_size,)``.
+    """
+    theta = theta.reshape(-1, x.shape[-1])
+    log_theta_mu = torch.log(theta + mu + eps)
+    if theta.shape[0] == 1:
+        log_prob = torch.sum(theta * torch.log(theta + eps)) - log_theta_mu @ theta[0]
+    else:
+        log_prob = torch.sum(theta * (torch.log(theta + eps) - log_theta_mu), dim=-1)
+    return log_prob + _nonzero_terms(x, mu, theta, log_theta_mu, eps, sparse)
+
+
+def zinb_log_likelihood(
+    x: torch.Tensor,
+    mu: torch.Tensor,
+    theta: torch.Tensor,
+    zi_logits: torch.Tensor,
+    eps: float = 1e-8,
+    sparse: bool = False,
+) -> torch.Tensor:
+    """Zero-inflated negative binomial log-likelihood of each cell, summed over the features.
+
+    Gives the same values as ``ZeroInflatedNegativeBinomial(mu, theta, zi_logits).log_prob(x).sum(-1)`` of
+    scvi-tools. The zero and nonzero cases are selected in a single pass over the entries and the terms that vanish
+    for zero counts are only evaluated for the nonzero entries of ``x`` if ``sparse``.
+
+    Parameters
+    ----------
+    x
+        Counts of shape ``(batch_size, n_features)``.
+    mu
+        Means of shape ``(batch_size, n_features)``.
+    theta
+        Inverse dispersion of shape ``(n_features,)`` or ``(1, n_features)`` if shared by the cells, or of shape
+        ``(batch_size, n_features)``.
+    zi_logits
+        Logits of the zero inflation of shape ``(batch_size, n_features)``.
+    eps
+        Numerical stability constant.
+    sparse
+        Whether to gather the nonzero entries of ``x`` for the terms that vanish for zero counts, see
+        :func:`nb_log_likelihood`.
+
+    Returns
+    -------
+    Log-likelihood of shape ``(batch_size,)``.
+    """
+    theta = theta.reshape(-1, x.shape[-1])
+    log_theta_mu = torch.log(theta + mu + eps)
+    # log-likelihood of the negative binomial at zero, shifted by the zero inflation
+    nb_zero = theta * (torch.log(theta + eps) - log_theta_mu) - zi_logits
+    log_prob = torch.sum(torch.where(x > 0, nb_zero, F.softplus(nb_zero)) - F.softplus(-zi_logits), dim=-1)
+    return log_prob + _nonzero_terms(x, mu, theta, log_theta_mu, eps, sparse)
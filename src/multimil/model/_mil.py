@@ -19,13 +19,16 @@ from scvi.train._callbacks import SaveBestState
 from multimil.dataloaders import GroupAnnDataLoader, GroupDataSplitter
 from multimil.module import MILClassifierTorch
 from multimil.utils import (
+    compile_fn,
+    compiled_forward,
     get_bag_info,
     get_predictions,
     plt_plot_losses,
-    prep_minibatch,
     save_predictions_in_adata,
     select_covariates,
     setup_ordinal_regression,
+    to_fp32,
+    whole_sample_outputs,
 )
 
 logger = logging.getLogger(__name__)
@@ -48,6 +51,10 @@ class MILClassifier(BaseModelClass, ArchesMixin):
         List of keys in `adata.obs` that correspond to the ordinal regression covariates.
     sample_batch_size
         Number of samples per bag, i.e. sample. Default is 128.
+    aggregator_chunk_size
+        If not `None`, the cell aggregator runs on chunks of this many cells in training and recomputes their
+        activations in the backward pass, so that its memory does not grow with `sample_batch_size`. Together with a
+        large `sample_batch_size` and `batch_size`, this allows training on whole samples. Default is None.
     normalization
         One of "layer" or "batch". Default is "layer".
     z_dim
@@ -96,6 +103,7 @@ class MILClassifier(BaseModelClass, ArchesMixin):
         regression=None,
         ordinal_regression=None,
         sample_batch_size=128,
+        aggregator_chunk_size=None,
         normalization="layer",
         z_dim=16,  # TODO do we need it? can't we get it from adata?
         dropout=0.2,
@@ -133,6 +141,8 @@ class MILClassifier(BaseModelClass, ArchesMixin):
                 f"Sample key = '{self.sample_key}' has to be one of the registered categorical covariates = {self.adata_manager.registry['setup_args']['categorical_covariate_keys']}"
             )
 
+        self.sample_idx = self.adata_manager.registry["setup_args"]["categorical_covariate_keys"].index(self.sample_key)
+
         if len(classification) + len(regression) + len(ordinal_regression) == 0:
             raise ValueError(
                 'At least one of "classification", "regression", "ordinal_regression" has to be specified.'
@@ -219,6 +229,8 @@ class MILClassifier(BaseModelClass, ArchesMixin):
             class_loss_coef=class_loss_coef,
             regression_loss_coef=regression_loss_coef,
             sample_batch_size=sample_batch_size,
+            sample_idx=self.sample_idx,
+            aggregator_chunk_size=aggregator_chunk_size,
             class_idx=self.class_idx,
             ord_idx=self.ord_idx,
             reg_idx=self.regression_idx,
@@ -249,6 +261,10 @@ class MILClassifier(BaseModelClass, ArchesMixin):
         early_stopping_mode: str | None = "max",
         save_checkpoint_every_n_epochs: int | None = None,
         path_to_checkpoints: str | None = None,
+        drop_last: bool | int = True,
+        compile: bool = False,
+        compile_kwargs: dict | None = None,
+        mixed_precision: bool = False,
         **kwargs,
     ):
         """Trains the model using amortized variational inference.
@@ -301,6 +317,15 @@ class MILClassifier(BaseModelClass, ArchesMixin):
             Save a checkpoint every n epochs.
         path_to_checkpoints
             Path to save checkpoints.
+        drop_last
+            Whether to drop the last cells of each sample that don't fill a bag. Bags can be smaller than
+            `sample_batch_size`, so with `False` all cells are used for training.
+        compile
+            Whether to compile the forward pass of the module with :func:`torch.compile` for training.
+        compile_kwargs
+            Keyword args for :func:`torch.compile`.
+        mixed_precision
+            Whether to train with bfloat16 autocast, i.e. Lightning's `"bf16-mixed"` precision.
         **kwargs
             Other keyword args for :class:`~scvi.train.Trainer`.
 
@@ -355,12 +380,16 @@ class MILClassifier(BaseModelClass, ArchesMixin):
                     f"`save_checkpoint_every_n_epochs` = {save_checkpoint_every_n_epochs} so `path_to_checkpoints` has to be not None but is {path_to_checkpoints}."
                 )
 
+        if mixed_precision:
+            kwargs["precision"] = "bf16-mixed"
+
         data_splitter = GroupDataSplitter(
             self.adata_manager,
             group_column=self.sample_key,
             train_size=train_size,
             validation_size=validation_size,
             batch_size=batch_size,
+            drop_last=drop_last,
         )
 
         training_plan = AdversarialTrainingPlan(self.module, **plan_kwargs)
@@ -377,7 +406,8 @@ class MILClassifier(BaseModelClass, ArchesMixin):
             enable_checkpointing=True,
             **kwargs,
         )
-        return runner()
+        with compiled_forward(self.module, compile, **(compile_kwargs or {})):
+            return runner()
 
     @classmethod
     def setup_anndata(
@@ -430,6 +460,10 @@ class MILClassifier(BaseModelClass, ArchesMixin):
         self,
         adata=None,
         batch_size=256,
+        compile=False,
+        compile_kwargs=None,
+        mixed_precision=False,
+        whole_sample=False,
     ):
         """Save the attention scores and predictions in the adata object.
 
@@ -439,6 +473,16 @@ class MILClassifier(BaseModelClass, ArchesMixin):
             AnnData object to run the model on. If `None`, the model's AnnData object is used.
         batch_size
             Minibatch size to use. Default is 256.
+        compile
+            Whether to compile the inference pass of the module with :func:`torch.compile`.
+        compile_kwargs
+            Keyword args for :func:`torch.compile`.
+        mixed_precision
+            Whether to run the inference with bfloat16 autocast.
+        whole_sample
+            Whether to pool the cells of each whole sample instead of bags of ``batch_size`` cells. The cells are
+            streamed in chunks of ``batch_size`` with an online softmax, so that the attention weights are normalized
+            over the whole sample and there is one prediction per sample in bounded memory. Each sample is one bag.
 
         """
         if not self.is_trained_:
@@ -469,38 +513,54 @@ class MILClassifier(BaseModelClass, ArchesMixin):
         ) = ({}, {}, {}, {}, {}, {})
 
         bag_counter = 0
-        cell_counter = 0
 
-        for tensors in scdl:
-            cont_key = REGISTRY_KEYS.CONT_COVS_KEY
-            cont_covs = tensors[cont_key] if cont_key in tensors.keys() else None
+        inference = compile_fn(self.module.inference, **(compile_kwargs or {})) if compile else self.module.inference
+        cont_key = REGISTRY_KEYS.CONT_COVS_KEY
+        cat_key = REGISTRY_KEYS.CAT_COVS_KEY
+
+        def minibatch_outputs():
+            for tensors in scdl:
+                cont_covs = tensors[cont_key] if cont_key in tensors.keys() else None
+                cat_covs = tensors[cat_key] if cat_key in tensors.keys() else None
 
-            cat_key = REGISTRY_KEYS.CAT_COVS_KEY
-            cat_covs = tensors[cat_key] if cat_key in tensors.keys() else None
+                inference_inputs = self.module._get_inference_input(tensors)
+                with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=mixed_precision):
+                    outputs = to_fp32(inference(**inference_inputs))
+                yield cat_covs, cont_covs, outputs
 
-            inference_inputs = self.module._get_inference_input(tensors)
-            outputs = self.module.inference(**inference_inputs)
+        if whole_sample:
+            n_samples = len(
+                self.adata_manager.get_state_registry("extra_categorical_covs")["mappings"][self.sample_key]
+            )
+            chunks = (
+                (tensors[REGISTRY_KEYS.X_KEY].to(self.device), tensors[cat_key], tensors.get(cont_key))
+                for tensors in scdl
+            )
+            with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=mixed_precision):
+                batches = [to_fp32(whole_sample_outputs(self.module, chunks, n_samples))]
+        else:
+            batches = minibatch_outputs()
+
+        for cat_covs, cont_covs, outputs in batches:
             pred = outputs["predictions"]
 
             # get attention for each cell in the bag
-            cell_attn = self.module.cell_level_aggregator[-1].A.squeeze(dim=1)
-            sample_size = cell_attn.shape[-1]
-            cell_attn = cell_attn.flatten()  # in inference always one patient per batch
-            cell_level_attn += [cell_attn.cpu()]
-            minibatch_size, n_samples_in_batch = prep_minibatch(cat_covs, self.module.sample_batch_size)
-            regression = select_covariates(cont_covs, self.regression_idx, n_samples_in_batch)
-            ordinal_regression = select_covariates(cat_covs, self.ord_idx, n_samples_in_batch)
-            classification = select_covariates(cat_covs, self.class_idx, n_samples_in_batch)
+            cell_level_attn += [outputs["attention"].cpu()]
+            bag_offsets = outputs["bag_offsets"].cpu()
+            bag_sizes = bag_offsets.diff()
+            regression = select_covariates(cont_covs, self.regression_idx, bag_offsets)
+            ordinal_regression = select_covariates(cat_covs, self.ord_idx, bag_offsets)
+            classification = select_covariates(cat_covs, self.class_idx, bag_offsets)
 
             # calculate accuracies of predictions
             bag_class_pred, bag_class_true, class_pred = get_predictions(
-                self.class_idx, pred, classification, sample_size, bag_class_pred, bag_class_true, class_pred
+                self.class_idx, pred, classification, bag_sizes, bag_class_pred, bag_class_true, class_pred
             )
             bag_ord_pred, bag_ord_true, ord_pred = get_predictions(
                 self.ord_idx,
                 pred,
                 ordinal_regression,
-                sample_size,
+                bag_sizes,
                 bag_ord_pred,
                 bag_ord_true,
                 ord_pred,
@@ -510,21 +570,15 @@ class MILClassifier(BaseModelClass, ArchesMixin):
                 self.regression_idx,
                 pred,
                 regression,
-                sample_size,
+                bag_sizes,
                 bag_reg_pred,
                 bag_reg_true,
                 reg_pred,
                 len(self.class_idx) + len(self.ord_idx),
             )
 
-            # TODO remove n_of_bags_in_batch after testing
-            n_of_bags_in_batch = pred[0].shape[0]
-            assert n_samples_in_batch == n_of_bags_in_batch
-
             # save bag info to be able to calculate bag predictions later
-            bags, cell_counter, bag_counter = get_bag_info(
-                bags, n_samples_in_batch, minibatch_size, cell_counter, bag_counter, self.module.sample_batch_size
-            )
+            bags, bag_counter = get_bag_info(bags, bag_sizes, bag_counter)
 
         cell_level = torch.cat(cell_level_attn).numpy()
         adata.obs["cell_attn"] = cell_level
@@ -615,7 +669,7 @@ class MILClassifier(BaseModelClass, ArchesMixin):
             raise ValueError("It appears you are loading a model from a different class.")
 
         if _SETUP_ARGS_KEY not in registry:
-            raise ValueError("Saved model does not contain original setup inputs. " "Cannot load the original setup.")
+            raise ValueError("Saved model does not contain original setup inputs. Cannot load the original setup.")
 
         cls.setup_anndata(
             adata,
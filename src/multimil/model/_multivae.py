@@ -18,7 +18,7 @@ from scvi.train._callbacks import SaveBestState
 
 from multimil.dataloaders import GroupDataSplitter
 from multimil.module import MultiVAETorch
-from multimil.utils import calculate_size_factor, plt_plot_losses
+from multimil.utils import calculate_size_factor, compile_fn, compiled_forward, plt_plot_losses, to_fp32
 
 logger = logging.getLogger(__name__)
 
@@ -64,8 +64,38 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         Number of nodes for each hidden layer in the encoders.
     n_hidden_decoders
         Number of nodes for each hidden layer in the decoders.
+    decoder_ranks
+        Rank of the factorized output layer of each decoder, i.e. n_hidden -> rank -> n_output. `None` for a modality
+        uses a full output layer. Low ranks reduce the size and step time of decoders of wide modalities, e.g. ATAC.
     mmd
         Which MMD loss to use.
+    mmd_estimator
+        How to estimate the MMD with the Gaussian kernel; one of `exact`, `linear` (linear-time) or `rff` (random
+        Fourier features). The last two scale to large batches.
+    mmd_bandwidth
+        Bandwidths of the Gaussian kernel; one of `fixed` (19 fixed bandwidths) or `median` (median heuristic).
+    fuse_modalities
+        Whether to evaluate structurally identical layers of the per-modality encoders and decoders with batched
+        matmuls. Uses the same parameters as the unfused networks, so saved models load either way.
+    n_negative_samples
+        Number of features sampled per minibatch to estimate the reconstruction loss of `nb` and `zinb` modalities in
+        training from the nonzero and the sampled zero features. If `None`, the loss is computed on all features.
+    parallel_modalities
+        Whether to run the encoders and decoders of the modalities concurrently in threads, in the forward and the
+        backward pass. Can speed up training on CPUs with many cores. Can't be combined with `fuse_modalities`.
+    fold_cat_covariates
+        Whether to evaluate the categorical covariates of the first encoder and decoder layers as lookups in tables of
+        the embeddings projected by these layers instead of concatenating the embeddings to the inputs. Gives the same
+        results with the same parameters.
+    dedup_covariates
+        Whether to evaluate the covariate embeddings and their contribution to the first encoder and decoder layers
+        once for each run of consecutive cells with equal covariates in a batch, e.g. once per bag, and share the
+        results between its cells. Gives the same results, except for batch normalization and dropout in the `'mlp'`
+        embeddings of continuous covariates.
+    sparse_counts
+        Whether the `nb` and `zinb` losses evaluate the terms that vanish for zero counts only for the nonzero counts.
+        Faster if at most about a quarter of the counts of these modalities are nonzero, but breaks compiled graphs into
+        pieces, see `train(compile=True)`.
     activation
         Activation function to use.
     initialization
@@ -94,7 +124,16 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         n_hidden_cont_embed: int = 32,  # TODO default to None?
         n_hidden_encoders: list[int] | None = None,
         n_hidden_decoders: list[int] | None = None,
+        decoder_ranks: list[int | None] | None = None,
         mmd: Literal["latent", "marginal", "both"] = "latent",
+        mmd_estimator: Literal["exact", "linear", "rff"] = "exact",
+        mmd_bandwidth: Literal["fixed", "median"] = "fixed",
+        fuse_modalities: bool = False,
+        n_negative_samples: int | None = None,
+        parallel_modalities: bool = False,
+        fold_cat_covariates: bool = False,
+        dedup_covariates: bool = False,
+        sparse_counts: bool = False,
         activation: str | None = "leaky_relu",  # TODO add which options are impelemted
         initialization: str | None = None,  # TODO add which options are impelemted
         ignore_covariates: list[str] | None = None,
@@ -161,6 +200,8 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         self.cat_covs_idx = torch.tensor(self.cat_covs_idx)
         self.cont_covs_idx = torch.tensor(self.cont_covs_idx)
 
+        self.sparse_counts = sparse_counts
+
         self.module = MultiVAETorch(
             modality_lengths=self.modality_lengths,
             condition_encoders=condition_encoders,
@@ -182,10 +223,19 @@ class MultiVAE(BaseModelClass, ArchesMixin):
             n_layers_decoders=n_layers_decoders,
             n_hidden_encoders=n_hidden_encoders,
             n_hidden_decoders=n_hidden_decoders,
+            decoder_ranks=decoder_ranks,
             cont_cov_type=cont_cov_type,
             n_layers_cont_embed=n_layers_cont_embed,
             n_hidden_cont_embed=n_hidden_cont_embed,
             mmd=mmd,
+            mmd_estimator=mmd_estimator,
+            mmd_bandwidth=mmd_bandwidth,
+            fuse_modalities=fuse_modalities,
+            n_negative_samples=n_negative_samples,
+            parallel_modalities=parallel_modalities,
+            fold_cat_covariates=fold_cat_covariates,
+            dedup_covariates=dedup_covariates,
+            sparse_counts=self.sparse_counts,
             activation=activation,
             initialization=initialization,
         )
@@ -193,7 +243,7 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         self.init_params_ = self._get_init_params(locals())
 
     @torch.inference_mode()
-    def impute(self, adata=None, batch_size=256):
+    def impute(self, adata=None, batch_size=256, mixed_precision=False):
         """Impute missing values in the adata object.
 
         Parameters
@@ -202,6 +252,8 @@ class MultiVAE(BaseModelClass, ArchesMixin):
             AnnData object to run the model on. If `None`, the model's AnnData object is used.
         batch_size
             Minibatch size to use. Default is 256.
+        mixed_precision
+            Whether to run the model with bfloat16 autocast.
         """
         if not self.is_trained_:
             raise RuntimeError("Please train the model first.")
@@ -213,10 +265,13 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         imputed = [[] for _ in range(len(self.modality_lengths))]
 
         for tensors in scdl:
-            inference_inputs = self.module._get_inference_input(tensors)
-            inference_outputs = self.module.inference(**inference_inputs)
-            generative_inputs = self.module._get_generative_input(tensors, inference_outputs)
-            outputs = self.module.generative(**generative_inputs)
+            with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=mixed_precision):
+                inference_inputs = self.module._get_inference_input(tensors)
+                inference_outputs = self.module.inference(**inference_inputs)
+                generative_inputs = self.module._get_generative_input(tensors, inference_outputs)
+                # decode all modalities for all cells, including the missing ones
+                generative_inputs["masks"] = None
+                outputs = to_fp32(self.module.generative(**generative_inputs))
             for i, output in enumerate(outputs["rs"]):
                 imputed[i] += [output.cpu()]
         for i in range(len(imputed)):
@@ -224,7 +279,15 @@ class MultiVAE(BaseModelClass, ArchesMixin):
             adata.obsm[f"imputed_modality_{i}"] = imputed[i]
 
     @torch.inference_mode()
-    def get_model_output(self, adata=None, batch_size=256):
+    def get_model_output(
+        self,
+        adata=None,
+        batch_size=256,
+        compile=False,
+        compile_kwargs=None,
+        mixed_precision=False,
+        load_sparse_tensor=False,
+    ):
         """Save the latent representation in the adata object.
 
         Parameters
@@ -233,21 +296,31 @@ class MultiVAE(BaseModelClass, ArchesMixin):
             AnnData object to run the model on. If `None`, the model's AnnData object is used.
         batch_size
             Minibatch size to use. Default is 256.
+        compile
+            Whether to compile the inference pass of the module with :func:`torch.compile`.
+        compile_kwargs
+            Keyword args for :func:`torch.compile`.
+        mixed_precision
+            Whether to run the inference with bfloat16 autocast.
+        load_sparse_tensor
+            Whether to load sparse ``X`` as sparse tensors, so that the first encoder layers are sparse-dense matmuls.
         """
         if not self.is_trained_:
             raise RuntimeError("Please train the model first.")
 
         adata = self._validate_anndata(adata)
 
-        scdl = self._make_data_loader(adata=adata, batch_size=batch_size)
+        scdl = self._make_data_loader(adata=adata, batch_size=batch_size, load_sparse_tensor=load_sparse_tensor)
 
         latent = []
+        inference = compile_fn(self.module.inference, **(compile_kwargs or {})) if compile else self.module.inference
         for tensors in scdl:
             inference_inputs = self.module._get_inference_input(tensors)
-            outputs = self.module.inference(**inference_inputs)
+            with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=mixed_precision):
+                outputs = to_fp32(inference(**inference_inputs))
             z = outputs["z"]
             latent += [z.cpu()]
-            #gc.collect()
+            # gc.collect()
 
         adata.obsm["X_multiMIL"] = torch.cat(latent).numpy()
 
@@ -271,6 +344,10 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         plan_kwargs: dict | None = None,
         save_checkpoint_every_n_epochs: int | None = None,
         path_to_checkpoints: str | None = None,
+        compile: bool = False,
+        compile_kwargs: dict | None = None,
+        mixed_precision: bool = False,
+        load_sparse_tensor: bool = False,
         **kwargs,
     ):
         """Train the model using amortized variational inference.
@@ -319,6 +396,16 @@ class MultiVAE(BaseModelClass, ArchesMixin):
             Save a checkpoint every n epochs. If `None`, no checkpoints are saved.
         path_to_checkpoints
             Path to save checkpoints. Required if `save_checkpoint_every_n_epochs` is not `None`.
+        compile
+            Whether to compile the forward pass of the module with :func:`torch.compile` for training.
+        compile_kwargs
+            Keyword args for :func:`torch.compile`.
+        mixed_precision
+            Whether to train with bfloat16 autocast, i.e. Lightning's `"bf16-mixed"` precision. Likelihoods, the
+            product of experts and the MMD are computed in fp32.
+        load_sparse_tensor
+            Whether to load sparse ``X`` as sparse tensors. The first encoder layers are then sparse-dense matmuls
+            whose cost scales with the number of nonzeros, and the batch is only densified for the reconstruction loss.
         kwargs
             Additional keyword arguments for :class:`~scvi.train.TrainRunner`.
 
@@ -364,6 +451,9 @@ class MultiVAE(BaseModelClass, ArchesMixin):
                     f"`save_checkpoint_every_n_epochs` = {save_checkpoint_every_n_epochs} so `path_to_checkpoints` has to be not None but is {path_to_checkpoints}."
                 )
 
+        if mixed_precision:
+            kwargs["precision"] = "bf16-mixed"
+
         if self.group_column is not None:
             data_splitter = GroupDataSplitter(
                 self.adata_manager,
@@ -371,6 +461,7 @@ class MultiVAE(BaseModelClass, ArchesMixin):
                 train_size=train_size,
                 validation_size=validation_size,
                 batch_size=batch_size,
+                load_sparse_tensor=load_sparse_tensor,
             )
         else:
             data_splitter = DataSplitter(
@@ -378,6 +469,7 @@ class MultiVAE(BaseModelClass, ArchesMixin):
                 train_size=train_size,
                 validation_size=validation_size,
                 batch_size=batch_size,
+                load_sparse_tensor=load_sparse_tensor,
             )
         training_plan = AdversarialTrainingPlan(self.module, **plan_kwargs)
         runner = TrainRunner(
@@ -392,8 +484,9 @@ class MultiVAE(BaseModelClass, ArchesMixin):
             enable_checkpointing=True,
             **kwargs,
         )
-        #gc.collect()
-        return runner()
+        # gc.collect()
+        with compiled_forward(self.module, compile, **(compile_kwargs or {})):
+            return runner()
 
     @classmethod
     def setup_anndata(
@@ -505,7 +598,7 @@ class MultiVAE(BaseModelClass, ArchesMixin):
             raise ValueError("It appears you are loading a model from a different class.")
 
         if _SETUP_ARGS_KEY not in registry:
-            raise ValueError("Saved model does not contain original setup inputs. " "Cannot load the original setup.")
+            raise ValueError("Saved model does not contain original setup inputs. Cannot load the original setup.")
 
         if ignore_covariates is None:
             ignore_covariates = []
@@ -537,6 +630,16 @@ class MultiVAE(BaseModelClass, ArchesMixin):
 
         model.to_device(device)
 
+        # the new categories of each covariate are inserted after its old ones in the packed embedding table
+        model.module._pack_cat_covariate_embeddings(load_state_dict, "")
+        if len(model.module.cat_covariate_dims) > 0:
+            old_cat_covariate_dims = [
+                dim - n_new for dim, n_new in zip(model.module.cat_covariate_dims, num_of_cat_to_add, strict=True)
+            ]
+            load_state_dict["cat_covariate_embedding.weight"] = model.module._extend_cat_covariate_embedding(
+                load_state_dict["cat_covariate_embedding.weight"], old_cat_covariate_dims
+            )
+
         new_state_dict = model.module.state_dict()
         for key, load_ten in load_state_dict.items():  # load_state_dict = old
             new_ten = new_state_dict[key]
@@ -560,9 +663,8 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         if freeze is True:
             for _, par in model.module.named_parameters():
                 par.requires_grad = False
-            for i, embed in enumerate(model.module.cat_covariate_embeddings):
-                if num_of_cat_to_add[i] > 0: # unfreeze the ones where categories were added
-                    embed.weight.requires_grad = True
+            # unfreeze the ones where categories were added
+            model.module._train_cat_covariate_embeddings([n_new > 0 for n_new in num_of_cat_to_add])
             if model.module.integrate_on_idx is not None:
                 model.module.theta.requires_grad = True
 
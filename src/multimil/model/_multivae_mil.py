@@ -21,13 +21,16 @@ from multimil.model import MILClassifier, MultiVAE
 from multimil.module import MultiVAETorch_MIL
 from multimil.utils import (
     calculate_size_factor,
+    compile_fn,
+    compiled_forward,
     get_bag_info,
     get_predictions,
     plt_plot_losses,
-    prep_minibatch,
     save_predictions_in_adata,
     select_covariates,
     setup_ordinal_regression,
+    to_fp32,
+    whole_sample_outputs,
 )
 
 logger = logging.getLogger(__name__)
@@ -50,6 +53,10 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         List of keys for the ordinal covariates used for ordinal regression.
     sample_batch_size
         Bag batch size for training the model.
+    aggregator_chunk_size
+        If not `None`, the cell aggregator runs on chunks of this many cells in training and recomputes their
+        activations in the backward pass, so that its memory does not grow with `sample_batch_size`. Together with a
+        large `sample_batch_size` and `batch_size`, this allows training on whole samples.
     integrate_on
         Key for the covariate used for integration.
     condition_encoders
@@ -66,6 +73,8 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         Number of hidden units in the encoders.
     n_hidden_decoders
         Number of hidden units in the decoders.
+    decoder_ranks
+        Rank of the factorized output layer of each decoder. `None` for a modality uses a full output layer.
     z_dim
         Dimensionality of the latent space.
     losses
@@ -110,6 +119,31 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         How to calucate the embeddings for the continuous covariates.
     mmd
         Type of maximum mean discrepancy.
+    mmd_estimator
+        How to estimate the MMD with the Gaussian kernel; one of `exact`, `linear` or `rff`.
+    mmd_bandwidth
+        Bandwidths of the Gaussian kernel; one of `fixed` or `median`.
+    fuse_modalities
+        Whether to evaluate structurally identical layers of the per-modality encoders and decoders with batched
+        matmuls.
+    n_negative_samples
+        Number of features sampled per minibatch to estimate the reconstruction loss of `nb` and `zinb` modalities in
+        training from the nonzero and the sampled zero features. If `None`, the loss is computed on all features.
+    parallel_modalities
+        Whether to run the encoders and decoders of the modalities concurrently in threads, in the forward and the
+        backward pass. Can speed up training on CPUs with many cores. Can't be combined with `fuse_modalities`.
+    fold_cat_covariates
+        Whether to evaluate the categorical covariates of the first encoder and decoder layers as lookups in tables of
+        the embeddings projected by these layers instead of concatenating the embeddings to the inputs. Gives the same
+        results with the same parameters.
+    dedup_covariates
+        Whether to evaluate the covariate embeddings and their contribution to the first encoder and decoder layers
+        once for each run of consecutive cells with equal covariates in a batch, e.g. once per bag, and share the
+        results between its cells. Gives the same results, except for batch normalization and dropout in the `'mlp'`
+        embeddings of continuous covariates.
+    sparse_counts
+        Whether the `nb` and `zinb` losses evaluate the terms that vanish for zero counts only for the nonzero counts.
+        Faster if at most about a quarter of the counts of these modalities are nonzero.
     sample_in_vae
         Whether to include the sample key in the VAE as a covariate.
     activation
@@ -128,6 +162,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         regression=None,
         ordinal_regression=None,
         sample_batch_size=128,
+        aggregator_chunk_size=None,
         integrate_on=None,
         condition_encoders=False,
         condition_decoders=True,
@@ -136,6 +171,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         n_layers_decoders=None,
         n_hidden_encoders=None,
         n_hidden_decoders=None,
+        decoder_ranks=None,
         z_dim=30,
         losses=None,
         dropout=0.2,
@@ -158,6 +194,14 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         regression_loss_coef=1.0,
         cont_cov_type="logsigm",
         mmd="latent",
+        mmd_estimator="exact",
+        mmd_bandwidth="fixed",
+        fuse_modalities=False,
+        n_negative_samples=None,
+        parallel_modalities=False,
+        fold_cat_covariates=False,
+        dedup_covariates=False,
+        sparse_counts=False,
         sample_in_vae=True,
         activation="leaky_relu",  # or tanh
         initialization="kaiming",  # xavier (tanh) or kaiming (leaky_relu)
@@ -206,7 +250,16 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             n_hidden_cont_embed=n_hidden_cont_embed,
             n_hidden_encoders=n_hidden_encoders,
             n_hidden_decoders=n_hidden_decoders,
+            decoder_ranks=decoder_ranks,
             mmd=mmd,
+            mmd_estimator=mmd_estimator,
+            mmd_bandwidth=mmd_bandwidth,
+            fuse_modalities=fuse_modalities,
+            n_negative_samples=n_negative_samples,
+            parallel_modalities=parallel_modalities,
+            fold_cat_covariates=fold_cat_covariates,
+            dedup_covariates=dedup_covariates,
+            sparse_counts=sparse_counts,
             activation=activation,
             initialization=initialization,
             ignore_covariates=ignore_covariates_vae,
@@ -293,6 +346,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             n_layers_cont_embed=n_layers_cont_embed,
             n_hidden_encoders=n_hidden_encoders,
             n_hidden_decoders=n_hidden_decoders,
+            decoder_ranks=decoder_ranks,
             n_hidden_cont_embed=n_hidden_cont_embed,
             cat_covariate_dims=self.multivae.cat_covariate_dims,
             cont_covariate_dims=self.multivae.cont_covariate_dims,
@@ -300,6 +354,14 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             cont_covs_idx=self.multivae.cont_covs_idx,
             cont_cov_type=cont_cov_type,
             mmd=mmd,
+            mmd_estimator=mmd_estimator,
+            mmd_bandwidth=mmd_bandwidth,
+            fuse_modalities=fuse_modalities,
+            n_negative_samples=n_negative_samples,
+            parallel_modalities=parallel_modalities,
+            fold_cat_covariates=fold_cat_covariates,
+            dedup_covariates=dedup_covariates,
+            sparse_counts=self.multivae.sparse_counts,
             # mil
             num_classification_classes=self.mil.num_classification_classes,
             scoring=scoring,
@@ -315,6 +377,8 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             class_loss_coef=class_loss_coef,
             regression_loss_coef=regression_loss_coef,
             sample_batch_size=sample_batch_size,
+            sample_idx=self.mil.sample_idx,
+            aggregator_chunk_size=aggregator_chunk_size,
             class_idx=self.mil.class_idx,
             ord_idx=self.mil.ord_idx,
             reg_idx=self.mil.regression_idx,
@@ -345,6 +409,11 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         early_stopping_mode: str | None = "max",
         save_checkpoint_every_n_epochs: int | None = None,
         path_to_checkpoints: str | None = None,
+        drop_last: bool | int = True,
+        compile: bool = False,
+        compile_kwargs: dict | None = None,
+        mixed_precision: bool = False,
+        load_sparse_tensor: bool = False,
         **kwargs,
     ):
         """Trains the model.
@@ -397,6 +466,19 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             Save a checkpoint every n epochs.
         path_to_checkpoints
             Path to save checkpoints.
+        drop_last
+            Whether to drop the last cells of each sample that don't fill a bag. Bags can be smaller than
+            `sample_batch_size`, so with `False` all cells are used for training.
+        compile
+            Whether to compile the forward pass of the module with :func:`torch.compile` for training.
+        compile_kwargs
+            Keyword args for :func:`torch.compile`.
+        mixed_precision
+            Whether to train with bfloat16 autocast, i.e. Lightning's `"bf16-mixed"` precision. Likelihoods, the
+            product of experts and the MMD are computed in fp32.
+        load_sparse_tensor
+            Whether to load sparse ``X`` as sparse tensors. The first encoder layers are then sparse-dense matmuls
+            whose cost scales with the number of nonzeros, and the batch is only densified for the reconstruction loss.
         **kwargs
             Other keyword args for :class:`~scvi.train.Trainer`.
 
@@ -450,14 +532,17 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
                     f"`save_checkpoint_every_n_epochs` = {save_checkpoint_every_n_epochs} so `path_to_checkpoints` has to be not None but is {path_to_checkpoints}."
                 )
 
+        if mixed_precision:
+            kwargs["precision"] = "bf16-mixed"
+
         data_splitter = GroupDataSplitter(
             self.adata_manager,
             group_column=self.mil.sample_key,
             train_size=train_size,
             validation_size=validation_size,
             batch_size=batch_size,
-            accelerator=accelerator,
-            device=device,
+            drop_last=drop_last,
+            load_sparse_tensor=load_sparse_tensor,
         )
         training_plan = AdversarialTrainingPlan(self.module, **plan_kwargs)
         runner = TrainRunner(
@@ -466,7 +551,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             data_splitter=data_splitter,
             max_epochs=max_epochs,
             accelerator=accelerator,
-            device=device,
+            devices=device,
             early_stopping=early_stopping,
             check_val_every_n_epoch=check_val_every_n_epoch,
             early_stopping_monitor=early_stopping_monitor,
@@ -475,7 +560,8 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             enable_checkpointing=True,
             **kwargs,
         )
-        return runner()
+        with compiled_forward(self.module, compile, **(compile_kwargs or {})):
+            return runner()
 
     @classmethod
     def setup_anndata(
@@ -537,6 +623,11 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         self,
         adata=None,
         batch_size=256,
+        compile=False,
+        compile_kwargs=None,
+        mixed_precision=False,
+        load_sparse_tensor=False,
+        whole_sample=False,
     ):
         """Save the latent representation, attention scores and predictions in the adata object.
 
@@ -546,6 +637,18 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             AnnData object to run the model on. If `None`, the model's AnnData object is used.
         batch_size
             Minibatch size to use. Default is 256.
+        compile
+            Whether to compile the inference pass of the module with :func:`torch.compile`.
+        compile_kwargs
+            Keyword args for :func:`torch.compile`.
+        mixed_precision
+            Whether to run the inference with bfloat16 autocast.
+        load_sparse_tensor
+            Whether to load sparse ``X`` as sparse tensors, so that the first encoder layers are sparse-dense matmuls.
+        whole_sample
+            Whether to pool the cells of each whole sample instead of bags of ``batch_size`` cells. The cells are
+            streamed in chunks of ``batch_size`` with an online softmax, so that the attention weights are normalized
+            over the whole sample and there is one prediction per sample in bounded memory. Each sample is one bag.
 
         """
         if not self.is_trained_:
@@ -562,6 +665,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             shuffle_classes=False,
             group_column=self.mil.sample_key,
             drop_last=False,
+            load_sparse_tensor=load_sparse_tensor,
         )
 
         latent, cell_level_attn, bags = [], [], []
@@ -576,40 +680,59 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         ) = ({}, {}, {}, {}, {}, {})
 
         bag_counter = 0
-        cell_counter = 0
-
-        for tensors in scdl:
-            cont_key = REGISTRY_KEYS.CONT_COVS_KEY
-            cont_covs = tensors[cont_key] if cont_key in tensors.keys() else None
 
-            cat_key = REGISTRY_KEYS.CAT_COVS_KEY
-            cat_covs = tensors[cat_key] if cat_key in tensors.keys() else None
+        # the latent representation of whole samples is computed chunk by chunk before the pooling
+        module = self.module.vae_module if whole_sample else self.module
+        inference = compile_fn(module.inference, **(compile_kwargs or {})) if compile else module.inference
+        cont_key = REGISTRY_KEYS.CONT_COVS_KEY
+        cat_key = REGISTRY_KEYS.CAT_COVS_KEY
+
+        def minibatch_outputs():
+            for tensors in scdl:
+                cont_covs = tensors[cont_key] if cont_key in tensors.keys() else None
+                cat_covs = tensors[cat_key] if cat_key in tensors.keys() else None
+
+                inference_inputs = self.module._get_inference_input(tensors)
+                with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=mixed_precision):
+                    outputs = to_fp32(inference(**inference_inputs))
+                latent.append(outputs["z"].cpu())
+                yield cat_covs, cont_covs, outputs
+
+        def latent_chunks():
+            for tensors in scdl:
+                inference_inputs = self.module._get_inference_input(tensors)
+                z = to_fp32(inference(**inference_inputs))["z"]
+                latent.append(z.cpu())
+                yield z, inference_inputs["cat_covs"], inference_inputs["cont_covs"]
+
+        if whole_sample:
+            n_samples = len(
+                self.adata_manager.get_state_registry("extra_categorical_covs")["mappings"][self.mil.sample_key]
+            )
+            with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=mixed_precision):
+                batches = [to_fp32(whole_sample_outputs(self.module.mil_module, latent_chunks(), n_samples))]
+        else:
+            batches = minibatch_outputs()
 
-            inference_inputs = self.module._get_inference_input(tensors)
-            outputs = self.module.inference(**inference_inputs)
-            z = outputs["z"]
+        for cat_covs, cont_covs, outputs in batches:
             pred = outputs["predictions"]
 
-            latent += [z.cpu()]
-
-            cell_attn = self.module.mil_module.cell_level_aggregator[-1].A.squeeze(dim=1)
-            sample_size = cell_attn.shape[-1]
-            cell_attn = cell_attn.flatten()  # in inference always one patient per batch
-            cell_level_attn += [cell_attn.cpu()]
-
-            minibatch_size, n_samples_in_batch = prep_minibatch(cat_covs, self.module.mil_module.sample_batch_size)
-            regression = select_covariates(cont_covs, self.mil.regression_idx, n_samples_in_batch)
-            ordinal_regression = select_covariates(cat_covs, self.mil.ord_idx, n_samples_in_batch)
-            classification = select_covariates(cat_covs, self.mil.class_idx, n_samples_in_batch)
+            # get attention for each cell in the bag
+            cell_level_attn += [outputs["attention"].cpu()]
+            bag_offsets = outputs["bag_offsets"].cpu()
+            bag_sizes = bag_offsets.diff()
+            regression = select_covariates(cont_covs, self.mil.regression_idx, bag_offsets)
+            ordinal_regression = select_covariates(cat_covs, self.mil.ord_idx, bag_offsets)
+            classification = select_covariates(cat_covs, self.mil.class_idx, bag_offsets)
 
             bag_class_pred, bag_class_true, class_pred = get_predictions(
-                self.mil.class_idx, pred, classification, sample_size, bag_class_pred, bag_class_true, class_pred
+                self.mil.class_idx, pred, classification, bag_sizes, bag_class_pred, bag_class_true, class_pred
             )
             bag_ord_pred, bag_ord_true, ord_pred = get_predictions(
                 self.mil.ord_idx,
                 pred,
                 ordinal_regression,
-                sample_size,
+                bag_sizes,
                 bag_ord_pred,
                 bag_ord_true,
                 ord_pred,
@@ -619,21 +742,14 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
                 self.mil.regression_idx,
                 pred,
                 regression,
-                sample_size,
+                bag_sizes,
                 bag_reg_pred,
                 bag_reg_true,
                 reg_pred,
                 len(self.mil.class_idx) + len(self.mil.ord_idx),
             )
 
-            bags, cell_counter, bag_counter = get_bag_info(
-                bags,
-                n_samples_in_batch,
-                minibatch_size,
-                cell_counter,
-                bag_counter,
-                self.module.mil_module.sample_batch_size,
-            )
+            bags, bag_counter = get_bag_info(bags, bag_sizes, bag_counter)
 
         latent = torch.cat(latent).numpy()
         cell_level = torch.cat(cell_level_attn).numpy()
@@ -706,7 +822,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
     @classmethod
     def load_query_data(
         cls,
-        adata: AnnData, #ad.AnnData ???
+        adata: AnnData,  # ad.AnnData ???
         reference_model: BaseModelClass,
         accelerator: str = "auto",
         device: Union[int, str] = "auto",
@@ -750,7 +866,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             raise ValueError("It appears you are loading a model from a different class.")
 
         if _SETUP_ARGS_KEY not in registry:
-            raise ValueError("Saved model does not contain original setup inputs. " "Cannot load the original setup.")
+            raise ValueError("Saved model does not contain original setup inputs. Cannot load the original setup.")
 
         cls.setup_anndata(
             adata,
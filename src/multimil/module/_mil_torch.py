@@ -4,8 +4,9 @@ from scvi.module.base import BaseModuleClass, LossOutput, auto_move_data
 from torch import nn
 from torch.nn import functional as F
 
-from multimil.nn import MLP, Aggregator
-from multimil.utils import prep_minibatch, select_covariates
+from multimil.nn import MLP, Aggregator, chunked_attention_pool
+from multimil.utils import select_covariates
+
 
 class MILClassifierTorch(BaseModuleClass):
     """MultiMIL's MIL classification module.
@@ -45,7 +46,15 @@ class MILClassifierTorch(BaseModuleClass):
     regression_loss_coef
         Regression loss coefficient.
     sample_batch_size
-        Sample batch size.
+        Maximum number of cells in a bag. Cells of one sample that come one after the other in a minibatch are split
+        into bags of at most this size.
+    sample_idx
+        Index of the sample covariate in the categorical covariates. If `None`, the minibatch is split into bags of
+        `sample_batch_size` cells regardless of the sample.
+    aggregator_chunk_size
+        If not `None`, the cell aggregator runs on chunks of this many cells in training and recomputes their
+        activations in the backward pass, see :func:`~multimil.nn.chunked_attention_pool`. The memory for activations
+        then does not grow with `sample_batch_size`, which allows training on much larger bags, e.g. whole samples.
     class_idx
         Which indices in cat covariates to do classification on.
     ord_idx
@@ -79,6 +88,8 @@ class MILClassifierTorch(BaseModuleClass):
         class_loss_coef=1.0,
         regression_loss_coef=1.0,
         sample_batch_size=128,
+        sample_idx=None,
+        aggregator_chunk_size=None,
         class_idx=None,  # which indices in cat covariates to do classification on, i.e. exclude from inference; this is a torch tensor
         ord_idx=None,  # which indices in cat covariates to do ordinal regression on and also exclude from inference; this is a torch tensor
         reg_idx=None,  # which indices in cont covariates to do regression on and also exclude from inference; this is a torch tensor
@@ -102,6 +113,8 @@ class MILClassifierTorch(BaseModuleClass):
         self.class_loss_coef = class_loss_coef
         self.regression_loss_coef = regression_loss_coef
         self.sample_batch_size = sample_batch_size
+        self.sample_idx = sample_idx
+        self.aggregator_chunk_size = aggregator_chunk_size
         self.anneal_class_loss = anneal_class_loss
         self.num_classification_classes = num_classification_classes
         self.class_idx = class_idx
@@ -189,50 +202,120 @@ class MILClassifierTorch(BaseModuleClass):
 
     def _get_inference_input(self, tensors):
         x = tensors[REGISTRY_KEYS.X_KEY]
-        return {"x": x}
+
+        cat_key = REGISTRY_KEYS.CAT_COVS_KEY
+        cat_covs = tensors[cat_key] if cat_key in tensors.keys() else None
+
+        return {"x": x, "cat_covs": cat_covs}
 
     def _get_generative_input(self, tensors, inference_outputs):
         z = inference_outputs["z"]
         return {"z": z}
 
+    def _bag_offsets(self, z, cat_covs=None) -> torch.Tensor:
+        """Index of the first cell of each bag followed by the number of cells.
+
+        A bag is a run of consecutive cells of the same sample of at most ``sample_batch_size`` cells.
+        """
+        n_cells = z.shape[0]
+        position = torch.arange(n_cells, device=z.device)
+        run_start = position == 0
+        if self.sample_idx is not None and cat_covs is not None:
+            samples = cat_covs[:, self.sample_idx]
+            run_start[1:] = samples[1:] != samples[:-1]
+        first_in_run = torch.cummax(torch.where(run_start, position, 0), dim=0).values
+        bag_start = run_start | ((position - first_in_run) % self.sample_batch_size == 0)
+        return torch.cat([position[bag_start], position.new_tensor([n_cells])])
+
     @auto_move_data
-    def inference(self, x) -> dict[str, torch.Tensor | list[torch.Tensor]]:
+    def inference(self, x, cat_covs=None) -> dict[str, torch.Tensor | list[torch.Tensor]]:
         """Forward pass for inference.
 
         Parameters
         ----------
         x
             Input.
+        cat_covs
+            Categorical covariates, used to split the minibatch into bags of the same sample.
 
         Returns
         -------
-        Predictions.
+        Predictions for each bag, cell-level attention weights and offsets of the bags in the minibatch.
         """
         z = x
         inference_outputs = {"z": z}
 
         # MIL part
-        batch_size = x.shape[0]
+        bag_offsets = self._bag_offsets(z, cat_covs)
+        if self.aggregator_chunk_size is not None and torch.is_grad_enabled():
+            zs_attn, attention = chunked_attention_pool(
+                z, bag_offsets, *self.cell_level_aggregator, self.aggregator_chunk_size
+            )
+        else:
+            zs = self.cell_level_aggregator[0](z)  # batch_size x z_dim
+            zs_attn, attention = self.cell_level_aggregator[-1](zs, bag_offsets)  # num of bags x z_dim, batch_size
 
-        idx = list(range(self.sample_batch_size, batch_size, self.sample_batch_size))
-        if (
-            batch_size % self.sample_batch_size != 0
-        ):  # can only happen during inference for last batches for each sample
-            idx = []
-        zs = torch.tensor_split(z, idx, dim=0)
-        zs = torch.stack(zs, dim=0)  # num of bags x batch_size x z_dim
-        zs_attn = self.cell_level_aggregator(zs)  # num of bags x cond_dim
+        predictions = self._predict(zs_attn)
+
+        inference_outputs.update(
+            {"predictions": predictions, "attention": attention, "bag_offsets": bag_offsets}
+        )  # predictions are a list as they can have different number of classes
+        return inference_outputs  # z, predictions, attention, bag_offsets
 
+    def _predict(self, zs_attn):
         predictions = []
         if len(self.class_idx) > 0:
             predictions.extend([classifier(zs_attn) for classifier in self.classifiers])
         if len(self.ord_idx) + len(self.reg_idx) > 0:
             predictions.extend([regressor(zs_attn) for regressor in self.regressors])
+        return predictions
 
-        inference_outputs.update(
-            {"predictions": predictions}
-        )  # predictions are a list as they can have different number of classes
-        return inference_outputs  # z, mu, logvar, predictions
+    def stream_samples(
+        self, z: torch.Tensor, samples: torch.Tensor, n_samples: int, state: tuple[torch.Tensor, ...] | None = None
+    ) -> tuple[torch.Tensor | None, tuple[torch.Tensor, ...]]:
+        """Update the attention pooling of whole samples with a chunk of cells.
+
+        Parameters
+        ----------
+        z
+            Latent embeddings of the cells in the chunk.
+        samples
+            Sample of each cell in ``range(n_samples)``.
+        n_samples
+            Total number of samples.
+        state
+            State returned for the previous chunk, ``None`` for the first chunk.
+
+        Returns
+        -------
+        Unnormalized attention scores of the cells and the updated state, see :meth:`~multimil.nn.Aggregator.stream`.
+        """
+        zs = self.cell_level_aggregator[0](z)
+        return self.cell_level_aggregator[-1].stream(zs, samples, n_samples, state)
+
+    def sample_predictions(
+        self,
+        state: tuple[torch.Tensor, ...],
+        scores: torch.Tensor | None = None,
+        samples: torch.Tensor | None = None,
+    ) -> tuple[list[torch.Tensor], torch.Tensor | None]:
+        """Predictions for whole samples streamed with :meth:`stream_samples`.
+
+        Parameters
+        ----------
+        state
+            State returned by :meth:`stream_samples` for the last chunk.
+        scores
+            Unnormalized attention scores of all cells returned by :meth:`stream_samples`.
+        samples
+            Sample of each cell in ``scores``.
+
+        Returns
+        -------
+        Predictions of shape ``(n_samples, ...)`` and cell-level attention weights normalized over whole samples.
+        """
+        zs_attn, attention = self.cell_level_aggregator[-1].stream_result(state, scores, samples)
+        return self._predict(zs_attn), attention
 
     @auto_move_data
     def generative(self, z) -> torch.Tensor:
@@ -258,10 +341,10 @@ class MILClassifierTorch(BaseModuleClass):
         cat_covs = tensors[cat_key] if cat_key in tensors.keys() else None
 
         # MIL classification loss
-        minibatch_size, n_samples_in_batch = prep_minibatch(cat_covs, self.sample_batch_size)
-        regression = select_covariates(cont_covs, self.reg_idx.to(self.device), n_samples_in_batch)
-        ordinal_regression = select_covariates(cat_covs, self.ord_idx.to(self.device), n_samples_in_batch)
-        classification = select_covariates(cat_covs, self.class_idx.to(self.device), n_samples_in_batch)
+        bag_offsets = inference_outputs["bag_offsets"]
+        regression = select_covariates(cont_covs, self.reg_idx, bag_offsets)
+        ordinal_regression = select_covariates(cat_covs, self.ord_idx, bag_offsets)
+        classification = select_covariates(cat_covs, self.class_idx, bag_offsets)
 
         predictions = inference_outputs["predictions"]  # list, first from classifiers, then from regressors
 
@@ -312,10 +395,11 @@ class MILClassifierTorch(BaseModuleClass):
         }
 
         if len(accuracies) > 0:
-            accuracy = torch.sum(torch.tensor(accuracies)) / len(accuracies)
+            accuracy = torch.stack(accuracies).mean()
             extra_metrics["accuracy"] = accuracy
 
         # don't need in this model but have to return
+        minibatch_size = inference_outputs["z"].shape[0]
         recon_loss = torch.zeros(minibatch_size)
         kl_loss = torch.zeros(minibatch_size)
 
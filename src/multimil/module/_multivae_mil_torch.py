@@ -3,6 +3,7 @@ from scvi import REGISTRY_KEYS
 from scvi.module.base import BaseModuleClass, LossOutput, auto_move_data
 from multimil.module import MILClassifierTorch, MultiVAETorch
 
+
 class MultiVAETorch_MIL(BaseModuleClass):
     """MultiMIL's end-to-end multimodal integration and MIL classification modules.
 
@@ -40,6 +41,8 @@ class MultiVAETorch_MIL(BaseModuleClass):
         Number of hidden units in the encoders.
     n_hidden_decoders
         Number of hidden units in the decoders.
+    decoder_ranks
+        Rank of the factorized output layers of each decoder, ``None`` for a full output layer.
     num_classification_classes
         Number of classes for each of the classification task.
     scoring
@@ -81,7 +84,12 @@ class MultiVAETorch_MIL(BaseModuleClass):
     regression_loss_coef
         Coefficient for the regression loss.
     sample_batch_size
-        Bag size.
+        Maximum bag size.
+    sample_idx
+        Index of the sample covariate in the categorical covariates.
+    aggregator_chunk_size
+        Number of cells per chunk of the cell aggregator in training, whose activations are recomputed in the backward
+        pass. If `None`, bags are aggregated at once.
     class_idx
         Which indices in cat covariates to do classification on.
     ord_idx
@@ -90,6 +98,24 @@ class MultiVAETorch_MIL(BaseModuleClass):
         Which indices in cont covariates to do regression on.
     mmd
         Type of MMD loss to use.
+    mmd_estimator
+        How to estimate the MMD with the Gaussian kernel.
+    mmd_bandwidth
+        Bandwidths of the Gaussian kernel.
+    fuse_modalities
+        Whether to evaluate structurally identical layers of the per-modality networks with batched matmuls.
+    n_negative_samples
+        Number of features sampled per minibatch to estimate the reconstruction loss of ``'nb'`` and ``'zinb'``
+        modalities in training, see :class:`~multimil.module.MultiVAETorch`.
+    parallel_modalities
+        Whether to run the encoders and decoders of the modalities concurrently in threads.
+    fold_cat_covariates
+        Whether to evaluate the categorical covariates of the first layers as lookups of projected embeddings.
+    dedup_covariates
+        Whether to evaluate the covariates once for each run of consecutive cells with equal covariates in a batch.
+    sparse_counts
+        Whether the ``'nb'`` and ``'zinb'`` losses evaluate the terms that vanish for zero counts only for the nonzero
+        counts.
     activation
         Activation function to use.
     initialization
@@ -116,6 +142,7 @@ class MultiVAETorch_MIL(BaseModuleClass):
         n_layers_decoders=None,
         n_hidden_encoders=None,
         n_hidden_decoders=None,
+        decoder_ranks=None,
         num_classification_classes=None,  # number of classes for each of the classification task
         scoring="gated_attn",
         attn_dim=16,
@@ -137,10 +164,20 @@ class MultiVAETorch_MIL(BaseModuleClass):
         class_loss_coef=1.0,
         regression_loss_coef=1.0,
         sample_batch_size=128,
+        sample_idx=None,
+        aggregator_chunk_size=None,
         class_idx=None,  # which indices in cat covariates to do classification on, i.e. exclude from inference
         ord_idx=None,  # which indices in cat covariates to do ordinal regression on and also exclude from inference
         reg_idx=None,  # which indices in cont covariates to do regression on and also exclude from inference
         mmd="latent",
+        mmd_estimator="exact",
+        mmd_bandwidth="fixed",
+        fuse_modalities=False,
+        n_negative_samples=None,
+        parallel_modalities=False,
+        fold_cat_covariates=False,
+        dedup_covariates=False,
+        sparse_counts=False,
         activation="leaky_relu",
         initialization=None,
         anneal_class_loss=False,
@@ -170,8 +207,17 @@ class MultiVAETorch_MIL(BaseModuleClass):
             n_layers_cont_embed=n_layers_cont_embed,
             n_hidden_encoders=n_hidden_encoders,
             n_hidden_decoders=n_hidden_decoders,
+            decoder_ranks=decoder_ranks,
             n_hidden_cont_embed=n_hidden_cont_embed,
             mmd=mmd,
+            mmd_estimator=mmd_estimator,
+            mmd_bandwidth=mmd_bandwidth,
+            fuse_modalities=fuse_modalities,
+            n_negative_samples=n_negative_samples,
+            parallel_modalities=parallel_modalities,
+            fold_cat_covariates=fold_cat_covariates,
+            dedup_covariates=dedup_covariates,
+            sparse_counts=sparse_counts,
             activation=activation,
             initialization=initialization,
         )
@@ -189,6 +235,8 @@ class MultiVAETorch_MIL(BaseModuleClass):
             class_loss_coef=class_loss_coef,
             regression_loss_coef=regression_loss_coef,
             sample_batch_size=sample_batch_size,
+            sample_idx=sample_idx,
+            aggregator_chunk_size=aggregator_chunk_size,
             anneal_class_loss=anneal_class_loss,
             num_classification_classes=num_classification_classes,
             class_idx=class_idx,
@@ -221,7 +269,7 @@ class MultiVAETorch_MIL(BaseModuleClass):
         cat_key = REGISTRY_KEYS.CAT_COVS_KEY
         cat_covs = tensors[cat_key] if cat_key in tensors.keys() else None
 
-        return {"z": z, "cat_covs": cat_covs, "cont_covs": cont_covs}
+        return {"z": z, "cat_covs": cat_covs, "cont_covs": cont_covs, "masks": inference_outputs["masks"]}
 
     @auto_move_data
     def inference(self, x, cat_covs, cont_covs) -> dict[str, torch.Tensor | list[torch.Tensor]]:
@@ -238,19 +286,19 @@ class MultiVAETorch_MIL(BaseModuleClass):
 
         Returns
         -------
-        Joint representations, marginal representations, joint mu's and logvar's and predictions.
+        Joint representations, marginal representations, joint mu's and logvar's, predictions and attention weights.
         """
         # VAE part
         inference_outputs = self.vae_module.inference(x, cat_covs, cont_covs)
         z = inference_outputs["z"]
 
         # MIL part
-        mil_inference_outputs = self.mil_module.inference(z)
+        mil_inference_outputs = self.mil_module.inference(z, cat_covs)
         inference_outputs.update(mil_inference_outputs)
-        return inference_outputs  # z, mu, logvar, z_marginal, predictions
+        return inference_outputs  # z, mu, logvar, z_marginal, masks, predictions, attention
 
     @auto_move_data
-    def generative(self, z, cat_covs, cont_covs) -> dict[str, torch.Tensor]:
+    def generative(self, z, cat_covs, cont_covs, masks=None) -> dict[str, torch.Tensor]:
         """Compute necessary inference quantities.
 
         Parameters
@@ -261,12 +309,14 @@ class MultiVAETorch_MIL(BaseModuleClass):
             Categorical covariates to condition on.
         cont_covs
             Continuous covariates to condition on.
+        masks
+            Modality masks, if passed each modality is only decoded for the cells that have it.
 
         Returns
         -------
         Reconstructed values for each modality.
         """
-        return self.vae_module.generative(z, cat_covs, cont_covs)
+        return self.vae_module.generative(z, cat_covs, cont_covs, masks)
 
     def loss(self, tensors, inference_outputs, generative_outputs, kl_weight: float = 1.0):
         """Calculate the (modality) reconstruction loss, Kullback divergences and integration loss.
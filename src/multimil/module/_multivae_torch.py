@@ -1,16 +1,24 @@
 import warnings
+from functools import partial
 from typing import Literal
 
 import torch
 from scvi import REGISTRY_KEYS
-from scvi.distributions import NegativeBinomial, ZeroInflatedNegativeBinomial
 from scvi.module.base import BaseModuleClass, LossOutput, auto_move_data
 from torch import nn
-from torch.distributions import Normal
-from torch.distributions import kl_divergence as kl
 
-from multimil.distributions import MMD
-from multimil.nn import MLP, Decoder, GeneralizedSigmoid
+from multimil.distributions import MMD, nb_log_likelihood, zinb_log_likelihood
+from multimil.nn import (
+    MLP,
+    Decoder,
+    GeneralizedSigmoid,
+    can_group_fc_layers,
+    fc_layer,
+    grouped_fc_layer,
+    shared_input_fc_layer,
+)
+from multimil.utils import autocast_fp32, parallel_branches
+
 
 class MultiVAETorch(BaseModuleClass):
     """MultiMIL's multimodal integration module.
@@ -70,11 +78,52 @@ class MultiVAETorch(BaseModuleClass):
         Number of nodes in hidden layers in encoders.
     n_hidden_decoders
         Number of nodes in hidden layers in decoders.
+    decoder_ranks
+        Rank of the factorized output layers of each decoder, ``None`` for a full output layer.
     mmd
         How to calculate MMD loss. One of the following
         * ``'latent'`` - only on the latent representations
         * ``'marginal'`` - only on the marginal representations
         * ``both`` - the sum of the two above.
+    mmd_estimator
+        How to estimate the MMD with the Gaussian kernel. One of the following:
+        * ``'exact'`` - quadratic-time estimate
+        * ``'linear'`` - linear-time estimate
+        * ``'rff'`` - random Fourier feature approximation.
+    mmd_bandwidth
+        Bandwidths of the Gaussian kernel. One of the following:
+        * ``'fixed'`` - fixed set of 19 bandwidths
+        * ``'median'`` - median heuristic at a few scales.
+    fuse_modalities
+        Whether to evaluate the per-modality networks together where their shapes allow it, i.e. the ``mus`` and
+        ``logvars`` heads, the hidden layers of the encoders and the hidden layers of the decoders are each evaluated
+        with one batched matmul. Uses the same parameters as the unfused networks, but layers with batch
+        normalization are not fused.
+    n_negative_samples
+        Number of features drawn per minibatch to estimate the reconstruction loss of ``'nb'`` and ``'zinb'``
+        modalities in training. The loss is evaluated on all nonzero features and the drawn zeros, reweighted to
+        stand in for all zeros, and only the corresponding columns of the output layer are computed. The softmax
+        normalizer of the means is estimated from the same columns, so the loss is a noisy and biased estimate. If
+        ``None``, all features are used.
+    parallel_modalities
+        Whether to run the encoders and decoders of the modalities concurrently in threads, in the forward and the
+        backward pass, each with an equal share of the intra-op threads. Meant for CPUs with many cores, on which the
+        matmuls of a single modality don't use all cores. Can't be combined with ``fuse_modalities``.
+    fold_cat_covariates
+        Whether to evaluate the categorical covariates of the first encoder and decoder layers as lookups in tables of
+        the embeddings multiplied by their columns of the layers, instead of concatenating the embeddings to the
+        inputs. The tables are recomputed from the parameters in each forward pass, so the results are the same and
+        saved models load either way.
+    dedup_covariates
+        Whether to evaluate the covariate embeddings and the covariate columns of the first encoder and decoder layers
+        once for each run of consecutive cells with equal covariates in a batch, e.g. once per bag in the batches of
+        the MIL models, and gather the results for the cells. Gives the same results, except that batch normalization
+        and dropout in the ``'mlp'`` embeddings of the continuous covariates act on the runs instead of the cells. Only
+        saves time if the runs are long, i.e. not for shuffled cells with cell level covariates.
+    sparse_counts
+        Whether the ``'nb'`` and ``'zinb'`` losses evaluate the terms that vanish for zero counts only for the nonzero
+        counts, see :func:`multimil.distributions.nb_log_likelihood`. Faster for sparse counts, but the number of
+        nonzero counts of a batch is data dependent, which breaks compiled graphs into pieces.
     """
 
     def __init__(
@@ -102,7 +151,16 @@ class MultiVAETorch(BaseModuleClass):
         n_hidden_cont_embed: int = 16,
         n_hidden_encoders=None,
         n_hidden_decoders=None,
+        decoder_ranks=None,
         mmd="latent",
+        mmd_estimator: Literal["exact", "linear", "rff"] = "exact",
+        mmd_bandwidth: Literal["fixed", "median"] = "fixed",
+        fuse_modalities: bool = False,
+        n_negative_samples: int | None = None,
+        parallel_modalities: bool = False,
+        fold_cat_covariates: bool = False,
+        dedup_covariates: bool = False,
+        sparse_counts: bool = False,
         activation="leaky_relu",
         initialization=None,
     ):
@@ -113,10 +171,19 @@ class MultiVAETorch(BaseModuleClass):
         self.condition_decoders = condition_decoders
         self.n_modality = len(self.input_dims)
         self.kernel_type = kernel_type
+        self.num_groups = num_groups
         self.integrate_on_idx = integrate_on_idx
         self.n_cont_cov = len(cont_covariate_dims)
         self.cont_cov_type = cont_cov_type
         self.mmd = mmd
+        self.mmd_estimator = mmd_estimator
+        self.mmd_bandwidth = mmd_bandwidth
+        self.fuse_modalities = fuse_modalities
+        self.n_negative_samples = n_negative_samples
+        self.parallel_modalities = parallel_modalities
+        self.fold_cat_covariates = fold_cat_covariates
+        self.dedup_covariates = dedup_covariates
+        self.sparse_counts = sparse_counts
         self.normalization = normalization
         self.z_dim = z_dim
         self.dropout = dropout
@@ -128,8 +195,11 @@ class MultiVAETorch(BaseModuleClass):
         self.n_hidden_cont_embed = n_hidden_cont_embed
         self.n_hidden_encoders = n_hidden_encoders
         self.n_hidden_decoders = n_hidden_decoders
-        self.cat_covs_idx = cat_covs_idx
-        self.cont_covs_idx = cont_covs_idx
+        self.decoder_ranks = decoder_ranks
+        self.cat_covariate_dims = list(cat_covariate_dims)
+        # columns of the selected covariates, buffers so that they move to the device of the module once
+        self.register_buffer("cat_covs_idx", torch.as_tensor(cat_covs_idx, dtype=torch.long), persistent=False)
+        self.register_buffer("cont_covs_idx", torch.as_tensor(cont_covs_idx, dtype=torch.long), persistent=False)
 
         if activation == "leaky_relu":
             self.activation = nn.LeakyReLU
@@ -155,6 +225,8 @@ class MultiVAETorch(BaseModuleClass):
             raise ValueError("cat_covariate_dims = None was passed.")
         if cont_covariate_dims is None:
             raise ValueError("cont_covariate_dims = None was passed.")
+        if fuse_modalities and parallel_modalities:
+            raise ValueError("fuse_modalities and parallel_modalities can't both be True.")
 
         # TODO: add warning that using these
         if self.n_layers_encoders is None:
@@ -165,6 +237,8 @@ class MultiVAETorch(BaseModuleClass):
             self.n_hidden_encoders = [128] * self.n_modality
         if self.n_hidden_decoders is None:
             self.n_hidden_decoders = [128] * self.n_modality
+        if self.decoder_ranks is None:
+            self.decoder_ranks = [None] * self.n_modality
 
         self.loss_coefs = {
             "recon": 1,
@@ -214,16 +288,47 @@ class MultiVAETorch(BaseModuleClass):
                 normalization=normalization,
                 activation=self.activation,
                 loss=loss,
+                rank=rank,
             )
-            for x_dim, loss, n_layers, n_hidden in zip(
-                self.input_dims, self.losses, self.n_layers_decoders, self.n_hidden_decoders, strict=False
+            for x_dim, loss, n_layers, n_hidden, rank in zip(
+                self.input_dims,
+                self.losses,
+                self.n_layers_decoders,
+                self.n_hidden_decoders,
+                self.decoder_ranks,
+                strict=False,
             )
         ]
 
         self.mus = [nn.Linear(z_dim, z_dim) for _ in self.input_dims]
         self.logvars = [nn.Linear(z_dim, z_dim) for _ in self.input_dims]
 
-        self.cat_covariate_embeddings = [nn.Embedding(dim, cond_dim) for dim in cat_covariate_dims]
+        # layers that are evaluated for all modalities at once when fusing, the first encoder layers have different
+        # inputs and are always evaluated per modality
+        encoder_layers = [enc.mlp.fc_layers for enc in self.encoders]
+        decoder_layers = [dec.decoder.mlp.fc_layers for dec in self.decoders]
+        encoders_aligned = len({len(layers) for layers in encoder_layers}) == 1
+        decoders_aligned = len({len(layers) for layers in decoder_layers}) == 1
+        self._fuse_encoders = (
+            fuse_modalities
+            and encoders_aligned
+            and all(can_group_fc_layers(list(layers)) for layers in list(zip(*encoder_layers, strict=True))[1:])
+        )
+        self._fuse_decoders = (
+            fuse_modalities
+            and decoders_aligned
+            and all(can_group_fc_layers(list(layers)) for layers in zip(*decoder_layers, strict=True))
+        )
+
+        # the embeddings of all categorical covariates packed into one table, with the rows of covariate i starting
+        # at cat_covariate_offsets[i]
+        self.cat_covariate_embedding = nn.Embedding(sum(cat_covariate_dims), cond_dim)
+        self._register_load_state_dict_pre_hook(self._pack_cat_covariate_embeddings)
+        # rows of the packed table that are trained while the others are frozen, see _train_cat_covariate_embeddings
+        self.register_parameter("trained_cat_covariate_embedding", None)
+        self.register_buffer("trained_cat_covariate_rows", None, persistent=False)
+        self._register_state_dict_hook(self._merge_trained_cat_covariate_embedding)
+        self._register_load_state_dict_pre_hook(self._split_trained_cat_covariate_embedding)
         if self.n_cont_cov > 0:
             self.cont_covariate_embeddings = nn.Embedding(self.n_cont_cov, cond_dim)
             if self.cont_cov_type == "mlp":
@@ -251,6 +356,14 @@ class MultiVAETorch(BaseModuleClass):
                     dim=self.n_cont_cov,
                     nonlin=self.cont_cov_type,
                 )
+        # the curves of all continuous covariates are evaluated together with stacked parameters, unless the hidden
+        # layers of their MLPs use batch normalization
+        self._group_cont_covariate_curves = self.n_cont_cov > 0 and self.cont_cov_type == "mlp"
+        if self._group_cont_covariate_curves and self.n_layers_cont_embed > 1:
+            curve_layers = [curve[0].mlp.fc_layers for curve in self.cont_covariate_curves]
+            self._group_cont_covariate_curves = all(
+                can_group_fc_layers(list(layers)) for layers in zip(*curve_layers, strict=True)
+            )
 
         # register sub-modules
         for i, (enc, dec, mu, logvar) in enumerate(
@@ -261,8 +374,27 @@ class MultiVAETorch(BaseModuleClass):
             self.add_module(f"mu_{i}", mu)
             self.add_module(f"logvar_{i}", logvar)
 
-        for i, emb in enumerate(self.cat_covariate_embeddings):
-            self.add_module(f"cat_covariate_embedding_{i}", emb)
+        # first row of each categorical covariate in the packed embedding table and in the folded tables
+        self.register_buffer(
+            "cat_covariate_offsets", torch.tensor([0, *cat_covariate_dims[:-1]]).cumsum(0), persistent=False
+        )
+
+        # integration loss, all pairs of groups are compared in one pass over the batch
+        self.mmd_loss = MMD(kernel_type=self.kernel_type, estimator=mmd_estimator, bandwidth=mmd_bandwidth)
+        self.register_buffer("integ_pairs", torch.combinations(torch.arange(num_groups), r=2), persistent=False)
+        # sets of the marginal term: marginals i and j of the cells with both modalities for each pair of modalities,
+        # followed by the groups within each modality
+        modality_pairs = torch.combinations(torch.arange(self.n_modality), r=2)
+        n_pair_sets = 2 * len(modality_pairs)
+        group_offsets = n_pair_sets + num_groups * torch.arange(self.n_modality).view(-1, 1, 1)
+        self.register_buffer("modality_pairs", modality_pairs, persistent=False)
+        self.register_buffer(
+            "marginal_pairs",
+            torch.cat(
+                [torch.arange(n_pair_sets).view(-1, 2), (self.integ_pairs.unsqueeze(0) + group_offsets).view(-1, 2)]
+            ),
+            persistent=False,
+        )
 
         if initialization is not None:
             if initialization == "xavier":
@@ -290,29 +422,195 @@ class MultiVAETorch(BaseModuleClass):
         eps = torch.randn_like(std)
         return mu + eps * std
 
-    def _bottleneck(self, z, i):
-        mu = self.mus[i](z)
-        logvar = self.logvars[i](z)
-        z = self._reparameterize(mu, logvar)
-        return z, mu, logvar
-
-    def _x_to_h(self, x, i):
-        return self.encoders[i](x)
+    def _fused_bottleneck(self, h):
+        # one batched matmul for the mu and logvar heads of all modalities, h is (n_modality, batch_size, z_dim)
+        weight = torch.stack(
+            [torch.cat([mu.weight, logvar.weight]) for mu, logvar in zip(self.mus, self.logvars, strict=True)]
+        )
+        bias = torch.stack(
+            [torch.cat([mu.bias, logvar.bias]) for mu, logvar in zip(self.mus, self.logvars, strict=True)]
+        )
+        mu, logvar = torch.baddbmm(bias.unsqueeze(1), h, weight.transpose(1, 2)).transpose(0, 1).chunk(2, dim=-1)
+        return mu, logvar
+
+    def _fused_x_to_h(self, xs, *conditions):
+        layers = [enc.mlp.fc_layers for enc in self.encoders]
+        h = torch.stack(
+            [
+                fc_layer(x, modality_layers[0], *self._first_layer_inputs(modality_layers[0], x_dim, *conditions))
+                for modality_layers, x, x_dim in zip(layers, xs, self.input_dims, strict=True)
+            ]
+        )
+        for i in range(1, len(layers[0])):
+            h = grouped_fc_layer(h, [modality_layers[i] for modality_layers in layers])
+        return h
+
+    def _fused_decoder_hidden(self, z, *conditions):
+        layers = [dec.decoder.mlp.fc_layers for dec in self.decoders]
+        if len(conditions) == 0:
+            h = shared_input_fc_layer(z, [modality_layers[0] for modality_layers in layers])
+        else:
+            # the covariate columns of the first layers differ between the decoders
+            h = torch.stack(
+                [
+                    fc_layer(z, layer[0], *self._first_layer_inputs(layer[0], self.z_dim, *conditions))
+                    for layer in layers
+                ]
+            )
+        for i in range(1, len(layers[0])):
+            h = grouped_fc_layer(h, [modality_layers[i] for modality_layers in layers])
+        return h
+
+    def _samples_features(self, i):
+        # the output layer of these modalities is only evaluated in the loss, for the features it needs
+        return self.training and self.n_negative_samples is not None and self.losses[i] in ["nb", "zinb"]
+
+    def _x_to_h(self, x, i, *conditions):
+        first_layer = self.encoders[i].mlp.fc_layers[0]
+        return self.encoders[i](x, *self._first_layer_inputs(first_layer, self.input_dims[i], *conditions))
+
+    def _z_to_h(self, z, i, *conditions):
+        first_layer = self.decoders[i].decoder.mlp.fc_layers[0]
+        return self.decoders[i].decoder(z, *self._first_layer_inputs(first_layer, self.z_dim, *conditions))
+
+    def _first_layer_inputs(self, layer, start, covs=None, cat_idx=None, inverse=None):
+        # covariates concatenated to the input of the first layer after its start columns, and the offset added to its
+        # output, see _conditions
+        offset = self._folded_offset(layer, start, cat_idx)
+        if inverse is None:
+            return covs, offset
+        # the covariate columns are evaluated once for each distinct combination of covariates
+        if covs.numel() > 0:
+            weight = layer[0].weight
+            covs_offset = covs @ weight[:, weight.shape[1] - covs.shape[-1] :].T
+            offset = covs_offset if offset is None else offset + covs_offset
+        return None, None if offset is None else offset[inverse]
+
+    def _folded_offset(self, layer, start, cat_idx):
+        # output of the categorical covariate columns of the first linear layer, which follow the start columns of
+        # the input, as one lookup in the embeddings projected by these columns
+        if cat_idx is None or cat_idx.numel() == 0:
+            return None
+        columns = layer[0].weight[:, start : start + self.cond_dim * len(self.cat_covariate_dims)]
+        embeddings = self._cat_covariate_table().split(self.cat_covariate_dims)
+        table = torch.cat(
+            [emb @ weight.T for emb, weight in zip(embeddings, columns.split(self.cond_dim, dim=1), strict=True)]
+        )
+        return nn.functional.embedding_bag(cat_idx, table, mode="sum")
 
-    def _h_to_x(self, h, i):
-        x = self.decoders[i](h)
-        return x
+    def _conditions(self, cat_covs, cont_covs):
+        """Covariate inputs of the first encoder and decoder layers.
 
+        Returns ``(covs,)`` with the embeddings of each cell that are concatenated to the inputs, ``(covs, cat_idx)``
+        with ``fold_cat_covariates``, where ``covs`` only holds the continuous embeddings and ``cat_idx`` are the rows
+        of the categorical covariates in the folded tables, and ``(covs, cat_idx, inverse)`` with
+        ``dedup_covariates``, where ``covs`` and ``cat_idx`` are given for each run of consecutive cells with equal
+        covariates in the batch and ``inverse`` is the run of each cell.
+        """
+        cat_covs = self._selected_cat_covariates(cat_covs)
+        cont_covs = self._selected_cont_covariates(cont_covs)
+        inverse = None
+        if self.dedup_covariates and (cat_covs is not None or cont_covs is not None):
+            cat_covs, cont_covs, inverse = self._unique_covariates(cat_covs, cont_covs)
+        cont_embedds = self._embed_cont_covariates(cont_covs)
+        if self.fold_cat_covariates and cat_covs is not None:
+            conditions = (cont_embedds, self._cat_covariate_rows(cat_covs))
+        else:
+            conditions = (torch.cat([self._embed_cat_covariates(cat_covs), cont_embedds], dim=-1),)
+        if inverse is None:
+            return conditions
+        cat_idx = conditions[1] if len(conditions) == 2 else torch.tensor([], dtype=torch.long, device=self.device)
+        return conditions[0], cat_idx, inverse
+
+    def _unique_covariates(self, cat_covs, cont_covs):
+        # the combinations of covariates of the runs of consecutive cells with equal covariates in the batch, e.g. one
+        # for each bag if all covariates are constant within bags, and the run of each cell, cheaper than sorting
+        covs = torch.cat([t for t in [cat_covs, cont_covs] if t is not None], dim=-1)
+        starts = torch.ones(covs.shape[0], dtype=torch.bool, device=covs.device)
+        starts[1:] = (covs[1:] != covs[:-1]).any(dim=-1)
+        unique, inverse = covs[starts], starts.cumsum(0) - 1
+        n_cat = 0 if cat_covs is None else cat_covs.shape[-1]
+        cat_covs = None if cat_covs is None else unique[:, :n_cat]
+        cont_covs = None if cont_covs is None else unique[:, n_cat:]
+        return cat_covs, cont_covs, inverse
+
+    def _encoder_branch(self, i, rows, x, *conditions):
+        # mu and logvar of modality i for the cells in rows, or for all cells if rows is None
+        if rows is not None:
+            x = x.to_sparse_coo().index_select(0, rows).to_sparse_csr() if x.layout != torch.strided else x[rows]
+            conditions = _select_condition_rows(conditions, rows)
+        h = self._x_to_h(x, i, *conditions)
+        return self.mus[i](h), self.logvars[i](h)
+
+    def _present_rows(self, masks):
+        # indices of the cells that have each modality, None if all of them do
+        n_present = masks.sum(dim=0).tolist()
+        rows = []
+        for mod, n in enumerate(n_present):
+            # batch norm can't be trained on a single cell, and no cell would leave nan running statistics
+            too_few = self.normalization == "batch" and self.training and n < 2
+            rows.append(None if n == masks.shape[0] or too_few else masks[:, mod].nonzero().squeeze(1))
+        return rows
+
+    def _scatter_rows(self, values, rows, n_cells):
+        # zeros for the cells without the modality, they are masked out of the product of experts and the losses
+        if rows is None:
+            return values
+        return values.new_zeros(n_cells, values.shape[-1]).index_copy(0, rows, values)
+
+    def _decoder_branch(self, i, rows, z, *conditions):
+        if rows is not None:
+            z, conditions = z[rows], _select_condition_rows(conditions, rows)
+        h = self._z_to_h(z, i, *conditions)
+        if self._samples_features(i):
+            return (h,)
+        r = self.decoders[i].from_hidden(h)
+        return (h, *r) if isinstance(r, tuple) else (h, r)
+
+    def _split_sparse(self, x):
+        # CSR column blocks of the modalities and the modality masks of a sparse batch, with the same masks as
+        # x.sum(dim=1) > 0 on the dense blocks
+        x = x.to_sparse_coo().coalesce()
+        rows, cols = x.indices()
+        ends = torch.tensor(self.input_dims, device=x.device).cumsum(0)
+        modality = torch.bucketize(cols, ends, right=True)
+        sums = torch.zeros(x.shape[0], len(self.input_dims), dtype=x.dtype, device=x.device)
+        masks = sums.index_put_((rows, modality), x.values(), accumulate=True) > 0
+        starts = [0, *ends[:-1].tolist()]
+        xs = [x.narrow_copy(1, start, dim).to_sparse_csr() for start, dim in zip(starts, self.input_dims, strict=True)]
+        return xs, masks
+
+    @autocast_fp32
     def _product_of_experts(self, mus, logvars, masks):
-        vars = torch.exp(logvars)
-        masks = masks.unsqueeze(-1).repeat(1, 1, vars.shape[-1])
-        mus_joint = torch.sum(mus * masks / vars, dim=1)
-        logvars_joint = torch.ones_like(mus_joint)  # batch size
-        logvars_joint += torch.sum(masks / vars, dim=1)
-        logvars_joint = 1.0 / logvars_joint  # inverse
-        mus_joint *= logvars_joint
-        logvars_joint = torch.log(logvars_joint)
-        return mus_joint, logvars_joint
+        # precision-weighted mean of the present experts and the standard normal prior, the masks broadcast over the
+        # latent dimensions
+        precisions = torch.exp(-logvars) * masks.unsqueeze(-1)
+        precision_joint = torch.sum(precisions, dim=1).add_(1.0)
+        mus_joint = torch.sum(mus * precisions, dim=1).div_(precision_joint)
+        return mus_joint, -torch.log(precision_joint)
+
+    @autocast_fp32
+    def _accumulate_experts(self, out, rows, masks):
+        # product of experts from the (mu, logvar) of each modality on its rows, accumulated in place instead of
+        # scattering and stacking the experts of all modalities
+        n_cells = masks.shape[0]
+        precision_joint = out[0][0].new_ones(n_cells, self.z_dim)  # standard normal prior
+        weighted_mus = out[0][0].new_zeros(n_cells, self.z_dim)
+        for mod, (mu, logvar) in enumerate(out):
+            precision = torch.exp(-logvar)
+            if rows[mod] is None:
+                precision = precision * masks[:, mod].unsqueeze(-1)
+                precision_joint.add_(precision)
+                weighted_mus.addcmul_(mu, precision)
+            else:
+                precision_joint.index_add_(0, rows[mod], precision)
+                weighted_mus.index_add_(0, rows[mod], mu * precision)
+        return weighted_mus.div_(precision_joint), -torch.log(precision_joint)
+
+    @property
+    def _uses_marginals(self):
+        # the marginal representations are only sampled for the integration loss on them
+        return self.mmd in ["marginal", "both"] and self.loss_coefs["integ"] != 0
 
     def _get_inference_input(self, tensors):
         x = tensors[REGISTRY_KEYS.X_KEY]
@@ -334,7 +632,7 @@ class MultiVAETorch(BaseModuleClass):
         cat_key = REGISTRY_KEYS.CAT_COVS_KEY
         cat_covs = tensors[cat_key] if cat_key in tensors.keys() else None
 
-        return {"z": z, "cat_covs": cat_covs, "cont_covs": cont_covs}
+        return {"z": z, "cat_covs": cat_covs, "cont_covs": cont_covs, "masks": inference_outputs["masks"]}
 
     @auto_move_data
     def inference(
@@ -359,10 +657,16 @@ class MultiVAETorch(BaseModuleClass):
 
         Returns
         -------
-        Joint representations, marginal representations, joint mu's and logvar's.
+        Joint representations, marginal representations, joint mu's and logvar's, and the modality masks of shape
+        ``(batch_size, n_modality)``. The marginal representations are only sampled if the integration loss uses them,
+        i.e. with ``mmd='marginal'`` or ``mmd='both'``, and are ``None`` otherwise.
         """
         # split x into modality xs
-        if torch.is_tensor(x):
+        if torch.is_tensor(x) and x.layout != torch.strided:
+            # sparse batch, the first encoder layers are sparse-dense matmuls over the nonzeros
+            xs, sparse_masks = self._split_sparse(x)
+            masks = sparse_masks if masks is None else masks
+        elif torch.is_tensor(x):
             xs = torch.split(
                 x, self.input_dims, dim=-1
             )  # list of tensors of len = n_mod, each tensor is of shape batch_size x mod_input_dim
@@ -375,37 +679,54 @@ class MultiVAETorch(BaseModuleClass):
             masks = torch.stack(masks, dim=1)
 
         # if we want to condition encoders, i.e. concat covariates to the input
+        shared = ()
         if self.condition_encoders is True:
-            cat_embedds = self._select_cat_covariates(cat_covs)
-            cont_embedds = self._select_cont_covariates(cont_covs)
+            # concatenated to the input of each modality along the feature axis by the first encoder layer
+            shared = self._conditions(cat_covs, cont_covs)
 
-            # concatenate input with categorical and continuous covariates
-            xs = [
-                torch.cat([x, cat_embedds, cont_embedds], dim=-1) for x in xs
-            ]  # concat input to each modality x along the feature axis
-
-        # TODO don't forward if mask is 0 for that dataset for that modality
         # hs = hidden state that we get after the encoder but before calculating mu and logvar for each modality
-        hs = [self._x_to_h(x, mod) for mod, x in enumerate(xs)]
-        # out = [zs_marginal, mus, logvars] and len(zs_marginal) = len(mus) = len(logvars) = number of modalities
-        out = [self._bottleneck(h, mod) for mod, h in enumerate(hs)]
-        # split out into zs_marginal, mus and logvars TODO check if easier to use split
-        zs_marginal = [mod_out[0] for mod_out in out]
-        z_marginal = torch.stack(zs_marginal, dim=1)
-        mus = [mod_out[1] for mod_out in out]
-        mu = torch.stack(mus, dim=1)
-        logvars = [mod_out[2] for mod_out in out]
-        logvar = torch.stack(logvars, dim=1)
-        mu_joint, logvar_joint = self._product_of_experts(mu, logvar, masks)
+        if self.fuse_modalities:
+            # the batched matmuls need the same cells for all modalities, so the encoders see all cells
+            if self._fuse_encoders:
+                h = self._fused_x_to_h(xs, *shared)
+            else:
+                h = torch.stack([self._x_to_h(x, mod, *shared) for mod, x in enumerate(xs)])
+            mu, logvar = self._fused_bottleneck(h)
+            mu_joint, logvar_joint = self._product_of_experts(mu, logvar, masks)
+            z_marginal = self._reparameterize(mu, logvar) if self._uses_marginals else None
+        else:
+            # the encoders only see the cells that have the modality
+            rows = self._present_rows(masks)
+            if self.parallel_modalities:
+                branches = [partial(self._encoder_branch, mod, rows[mod]) for mod in range(self.n_modality)]
+                out = parallel_branches(branches, xs, shared)
+            else:
+                out = [self._encoder_branch(mod, rows[mod], x, *shared) for mod, x in enumerate(xs)]
+            # out = [(mu, logvar)] * number of modalities, on the rows of the cells that have the modality
+            mu_joint, logvar_joint = self._accumulate_experts(out, rows, masks)
+            z_marginal = None
+            if self._uses_marginals:
+                # sampled in the order of the modalities, in the caller's thread with parallel_modalities
+                n_cells = masks.shape[0]
+                zs_marginal = [
+                    self._scatter_rows(self._reparameterize(mu, logvar), rows[mod], n_cells)
+                    for mod, (mu, logvar) in enumerate(out)
+                ]
+                # stacked by modality, the integration loss takes the marginals in this order
+                z_marginal = torch.stack(zs_marginal).transpose(0, 1)
         z = self._reparameterize(mu_joint, logvar_joint)
         # drop mus and logvars according to masks for kl calculation
         # TODO here or in loss calculation? check
         # return mus+mus_joint
-        return {"z": z, "mu": mu_joint, "logvar": logvar_joint, "z_marginal": z_marginal}
+        return {"z": z, "mu": mu_joint, "logvar": logvar_joint, "z_marginal": z_marginal, "masks": masks}
 
     @auto_move_data
     def generative(
-        self, z: torch.Tensor, cat_covs: torch.Tensor | None = None, cont_covs: torch.Tensor | None = None
+        self,
+        z: torch.Tensor,
+        cat_covs: torch.Tensor | None = None,
+        cont_covs: torch.Tensor | None = None,
+        masks: torch.Tensor | None = None,
     ) -> dict[str, list[torch.Tensor]]:
         """Compute necessary inference quantities.
 
@@ -417,46 +738,151 @@ class MultiVAETorch(BaseModuleClass):
             Categorical covariates to condition on.
         cont_covs
             Continuous covariates to condition on.
+        masks
+            Modality masks of shape ``(batch_size, n_modality)``. If passed, each modality is only decoded for the cells
+            that have it. If ``None``, all modalities are decoded for all cells, e.g. to impute missing modalities.
 
         Returns
         -------
-        Reconstructed values for each modality.
+        Reconstructed values and hidden states of the decoders for each modality, and the indices of the decoded cells
+        of each modality, ``None`` if all cells were decoded. In training with ``n_negative_samples``, the
+        reconstructed values of ``'nb'`` and ``'zinb'`` modalities are ``None`` and their output layers are evaluated
+        in the loss.
         """
-        z = z.unsqueeze(1).repeat(1, self.n_modality, 1)
-        zs = torch.split(z, 1, dim=1)
-
+        # all decoders share the same input
+        shared = (z,)
         if self.condition_decoders is True:
-            cat_embedds = self._select_cat_covariates(cat_covs)
-            cont_embedds = self._select_cont_covariates(cont_covs)
-
-            zs = [
-                torch.cat([z.squeeze(1), cat_embedds, cont_embedds], dim=-1) for z in zs
-            ]  # concat embedding to each modality x along the feature axis
-
-        rs = [self._h_to_x(z, mod) for mod, z in enumerate(zs)]
-        return {"rs": rs}
-
-    def _select_cat_covariates(self, cat_covs):
-        if len(self.cat_covs_idx) > 0:
-            cat_covs = torch.index_select(cat_covs, 1, self.cat_covs_idx.to(self.device))
-            cat_embedds = [
-                cat_covariate_embedding(covariate.long())
-                for cat_covariate_embedding, covariate in zip(self.cat_covariate_embeddings, cat_covs.T, strict=False)
-            ]
+            conditions = self._conditions(cat_covs, cont_covs)
+            shared = (torch.cat([z, conditions[0]], dim=-1),) if len(conditions) == 1 else (z, *conditions)
+
+        # the fused decoders need the same cells for all modalities, so they decode all cells
+        if masks is None or self._fuse_decoders:
+            rows = [None] * self.n_modality
         else:
-            cat_embedds = []
+            rows = self._present_rows(masks)
+
+        if self.parallel_modalities:
+            branches = [partial(self._decoder_branch, mod, rows[mod]) for mod in range(self.n_modality)]
+            out = parallel_branches(branches, shared=shared)
+            hs = [mod_out[0] for mod_out in out]
+            rs = [
+                None if self._samples_features(mod) else mod_out[1:] if self.losses[mod] == "zinb" else mod_out[1]
+                for mod, mod_out in enumerate(out)
+            ]
+            return {"rs": rs, "hs": hs, "rows": rows}
 
-        if len(cat_embedds) > 0:
-            cat_embedds = torch.cat(cat_embedds, dim=-1)  # TODO check if concatenation is needed
+        if self._fuse_decoders:
+            hs = list(self._fused_decoder_hidden(*shared))
+        else:
+            hs = []
+            for mod in range(self.n_modality):
+                z, *conditions = shared
+                if rows[mod] is not None:
+                    z, conditions = z[rows[mod]], _select_condition_rows(conditions, rows[mod])
+                hs.append(self._z_to_h(z, mod, *conditions))
+        rs = [
+            None if self._samples_features(mod) else dec.from_hidden(h)
+            for mod, (dec, h) in enumerate(zip(self.decoders, hs, strict=True))
+        ]
+        return {"rs": rs, "hs": hs, "rows": rows}
+
+    def _selected_cat_covariates(self, cat_covs):
+        if len(self.cat_covs_idx) == 0:
+            return None
+        return torch.index_select(cat_covs, 1, self.cat_covs_idx)
+
+    def _selected_cont_covariates(self, cont_covs):
+        if len(self.cont_covs_idx) == 0:
+            return None
+        cont_covs = torch.index_select(cont_covs, 1, self.cont_covs_idx)
+        if cont_covs.shape[-1] != self.n_cont_cov:  # get rid of size_factors
+            cont_covs = cont_covs[:, 0 : self.n_cont_cov]
+        return cont_covs
+
+    def _cat_covariate_rows(self, cat_covs):
+        # rows of the categories of each cell in the packed embedding table
+        return cat_covs.long() + self.cat_covariate_offsets
+
+    def _embed_cat_covariates(self, cat_covs):
+        if cat_covs is not None:
+            # a single lookup gives the embeddings of all covariates, flattened into their concatenation
+            rows = self._cat_covariate_rows(cat_covs)
+            cat_embedds = nn.functional.embedding(rows, self._cat_covariate_table()).flatten(start_dim=1)
         else:
             cat_embedds = torch.Tensor().to(self.device)
         return cat_embedds
 
-    def _select_cont_covariates(self, cont_covs):
-        if len(self.cont_covs_idx) > 0:
-            cont_covs = torch.index_select(cont_covs, 1, self.cont_covs_idx.to(self.device))
-            if cont_covs.shape[-1] != self.n_cont_cov:  # get rid of size_factors
-                cont_covs = cont_covs[:, 0 : self.n_cont_cov]
+    def _pack_cat_covariate_embeddings(self, state_dict, prefix, *args):
+        # state dicts from before the embeddings were packed have one embedding per categorical covariate
+        keys = [f"{prefix}cat_covariate_embedding_{i}.weight" for i in range(len(self.cat_covariate_dims))]
+        if len(keys) > 0 and all(key in state_dict for key in keys):
+            state_dict[f"{prefix}cat_covariate_embedding.weight"] = torch.cat([state_dict.pop(key) for key in keys])
+
+    def _extend_cat_covariate_embedding(self, weight, cat_covariate_dims):
+        """Extend a packed embedding table to the categories of this module.
+
+        Parameters
+        ----------
+        weight
+            Packed embedding table with ``cat_covariate_dims`` categories per covariate.
+        cat_covariate_dims
+            Number of categories of each covariate in ``weight``, at most those of this module.
+
+        Returns
+        -------
+        Packed embedding table of this module, with the rows of ``weight`` for the first categories of each covariate
+        and the rows of this module for the others.
+        """
+        extended = self.cat_covariate_embedding.weight.detach().clone()
+        for old, start, dim in zip(
+            weight.split(cat_covariate_dims), self.cat_covariate_offsets.tolist(), cat_covariate_dims, strict=True
+        ):
+            extended[start : start + dim] = old
+        return extended
+
+    def _cat_covariate_table(self):
+        # packed embedding table, with the rows of the trained covariates from their own parameter if others are frozen
+        weight = self.cat_covariate_embedding.weight
+        if self.trained_cat_covariate_embedding is None:
+            return weight
+        return weight.index_copy(0, self.trained_cat_covariate_rows, self.trained_cat_covariate_embedding)
+
+    def _train_cat_covariate_embeddings(self, trainable):
+        """Train only the embeddings of some categorical covariates, e.g. those with new categories.
+
+        If only some covariates are trained, the packed table is frozen and the rows of the trained covariates are
+        moved to the ``trained_cat_covariate_embedding`` parameter, so that the optimizer never updates the other rows,
+        not even by weight decay. State dicts still hold the merged table.
+
+        Parameters
+        ----------
+        trainable
+            Whether the embeddings of each categorical covariate are trained.
+        """
+        weight = self.cat_covariate_embedding.weight
+        trainable_rows = torch.repeat_interleave(torch.as_tensor(trainable), torch.as_tensor(self.cat_covariate_dims))
+        weight.requires_grad = trainable_rows.numel() > 0 and bool(trainable_rows.all())
+        if weight.requires_grad or not trainable_rows.any():
+            return
+        self.trained_cat_covariate_rows = trainable_rows.nonzero().squeeze(1).to(weight.device)
+        self.trained_cat_covariate_embedding = nn.Parameter(weight[self.trained_cat_covariate_rows].detach().clone())
+
+    def _merge_trained_cat_covariate_embedding(self, module, state_dict, prefix, local_metadata):
+        # the trained rows are saved in the packed table, so that the state dict loads without them
+        trained = state_dict.pop(f"{prefix}trained_cat_covariate_embedding", None)
+        if trained is not None:
+            key = f"{prefix}cat_covariate_embedding.weight"
+            state_dict[key] = state_dict[key].index_copy(0, self.trained_cat_covariate_rows, trained)
+
+    def _split_trained_cat_covariate_embedding(self, state_dict, prefix, *args):
+        # the trained rows of a merged packed table are loaded into their own parameter
+        key = f"{prefix}cat_covariate_embedding.weight"
+        if self.trained_cat_covariate_embedding is not None and key in state_dict:
+            rows = self.trained_cat_covariate_rows.to(state_dict[key].device)
+            state_dict[f"{prefix}trained_cat_covariate_embedding"] = state_dict[key][rows]
+
+    def _embed_cont_covariates(self, cont_covs):
+        if cont_covs is not None:
             cont_embedds = self._compute_cont_cov_embeddings(cont_covs)
         else:
             cont_embedds = torch.Tensor().to(self.device)
@@ -464,6 +890,8 @@ class MultiVAETorch(BaseModuleClass):
 
     def _calculate_loss(self, tensors, inference_outputs, generative_outputs, kl_weight: float = 1.0):
         x = tensors[REGISTRY_KEYS.X_KEY]
+        if x.layout != torch.strided:
+            x = x.to_dense()
         if self.integrate_on_idx is not None:
             integrate_on = tensors.get(REGISTRY_KEYS.CAT_COVS_KEY)[:, self.integrate_on_idx]
         else:
@@ -472,52 +900,27 @@ class MultiVAETorch(BaseModuleClass):
         size_factor = tensors.get(REGISTRY_KEYS.SIZE_FACTOR_KEY, None)
 
         rs = generative_outputs["rs"]
+        hs = generative_outputs["hs"]
         mu = inference_outputs["mu"]
         logvar = inference_outputs["logvar"]
         z = inference_outputs["z"]
         z_marginal = inference_outputs["z_marginal"]  # batch_size x n_modalities x latent_dim
+        masks = inference_outputs["masks"]  # batch_size x n_modalities
 
         xs = torch.split(
             x, self.input_dims, dim=-1
         )  # list of tensors of len = n_mod, each tensor is of shape batch_size x mod_input_dim
-        masks = [x.sum(dim=1) > 0 for x in xs]  # [batch_size] * num_modalities
 
         recon_loss, modality_recon_losses = self._calc_recon_loss(
-            xs, rs, self.losses, integrate_on, size_factor, self.loss_coefs, masks
+            xs, rs, hs, self.losses, integrate_on, size_factor, self.loss_coefs, masks, generative_outputs.get("rows")
         )
-        kl_loss = kl_weight * kl(Normal(mu, torch.sqrt(torch.exp(logvar))), Normal(0, 1)).sum(dim=1)
+        # closed form of kl(Normal(mu, exp(logvar / 2)), Normal(0, 1)), the distribution dispatch can't be compiled
+        kl_loss = kl_weight * 0.5 * (mu.pow(2) + logvar.exp() - logvar - 1).sum(dim=1)
 
         if self.loss_coefs["integ"] == 0:
             integ_loss = torch.tensor(0.0).to(self.device)
         else:
-            integ_loss = torch.tensor(0.0).to(self.device)
-            if self.mmd == "latent" or self.mmd == "both":
-                integ_loss += self._calc_integ_loss(z, integrate_on).to(self.device)
-            if self.mmd == "marginal" or self.mmd == "both":
-                for i in range(len(masks)):
-                    for j in range(i + 1, len(masks)):
-                        idx_where_to_calc_mmd = torch.eq(
-                            masks[i] == masks[j],
-                            torch.eq(masks[i], torch.ones_like(masks[i])),
-                        )
-                        if idx_where_to_calc_mmd.any():  # if need to calc mmd for a group between modalities
-                            marginal_i = z_marginal[:, i, :][idx_where_to_calc_mmd]
-                            marginal_j = z_marginal[:, j, :][idx_where_to_calc_mmd]
-                            marginals = torch.cat([marginal_i, marginal_j])
-                            modalities = torch.cat(
-                                [
-                                    torch.Tensor([i] * marginal_i.shape[0]),
-                                    torch.Tensor([j] * marginal_j.shape[0]),
-                                ]
-                            ).to(self.device)
-
-                            integ_loss += self._calc_integ_loss(marginals, modalities).to(self.device)
-
-                for i in range(len(masks)):
-                    marginal_i = z_marginal[:, i, :]
-                    marginal_i = marginal_i[masks[i]]
-                    group_marginal = integrate_on[masks[i]]
-                    integ_loss += self._calc_integ_loss(marginal_i, group_marginal).to(self.device)
+            integ_loss = self._calc_integ_loss(z, z_marginal, integrate_on, masks)
 
         loss = torch.mean(
             self.loss_coefs["recon"] * recon_loss
@@ -572,56 +975,206 @@ class MultiVAETorch(BaseModuleClass):
             extra_metrics=extra_metrics,
         )
 
-    def _calc_recon_loss(self, xs, rs, losses, group, size_factor, loss_coefs, masks):
+    @autocast_fp32
+    def _calc_recon_loss(self, xs, rs, hs, losses, group, size_factor, loss_coefs, masks, rows=None):
         loss = []
+        rows = [None] * len(xs) if rows is None else rows
+        # dispersion of each group of shape (num_groups, n_features), once per step for all cells and modalities
+        dispersion = None if self.theta is None else torch.exp(self.theta.T)
         for i, (x, r, loss_type) in enumerate(zip(xs, rs, losses, strict=False)):
-            if len(r) != 2 and len(r.shape) == 3:
-                r = r.squeeze()
-            if loss_type == "mse":
-                mse_loss = loss_coefs[str(i)] * torch.sum(nn.MSELoss(reduction="none")(r, x), dim=-1)
-                loss.append(mse_loss)
-            elif loss_type == "nb":
-                dec_mean = r
-                size_factor_view = size_factor.expand(dec_mean.size(0), dec_mean.size(1))
-                dec_mean = dec_mean * size_factor_view
-                dispersion = self.theta.T[group.squeeze().long()]
-                dispersion = torch.exp(dispersion)
-                nb_loss = torch.sum(NegativeBinomial(mu=dec_mean, theta=dispersion).log_prob(x), dim=-1)
-                nb_loss = loss_coefs[str(i)] * nb_loss
-                loss.append(-nb_loss)
-            elif loss_type == "zinb":
-                dec_mean, dec_dropout = r
-                dec_mean = dec_mean.squeeze()
-                dec_dropout = dec_dropout.squeeze()
-                size_factor_view = size_factor.unsqueeze(1).expand(dec_mean.size(0), dec_mean.size(1))
-                dec_mean = dec_mean * size_factor_view
-                dispersion = self.theta.T[group.squeeze().long()]
-                dispersion = torch.exp(dispersion)
-                zinb_loss = torch.sum(
-                    ZeroInflatedNegativeBinomial(mu=dec_mean, theta=dispersion, zi_logits=dec_dropout).log_prob(x),
-                    dim=-1,
+            if rows[i] is None:
+                loss.append(
+                    self._modality_recon_loss(i, x, r, hs[i], loss_type, group, size_factor, dispersion, loss_coefs)
                 )
-                zinb_loss = loss_coefs[str(i)] * zinb_loss
-                loss.append(-zinb_loss)
-            elif loss_type == "bce":
-                bce_loss = loss_coefs[str(i)] * torch.sum(torch.nn.BCELoss(reduction="none")(r, x), dim=-1)
-                loss.append(bce_loss)
-
-        return (
-            torch.sum(torch.stack(loss, dim=-1) * torch.stack(masks, dim=-1), dim=1),
-            torch.sum(torch.stack(loss, dim=-1) * torch.stack(masks, dim=-1), dim=0),
+                continue
+            # the modality was only decoded for the cells that have it, the other cells get a zero loss
+            modality_loss = self._modality_recon_loss(
+                i,
+                x[rows[i]],
+                r,
+                hs[i],
+                loss_type,
+                group[rows[i]],
+                None if size_factor is None else size_factor[rows[i]],
+                dispersion,
+                loss_coefs,
+            )
+            loss.append(modality_loss.new_zeros(x.shape[0]).index_copy(0, rows[i], modality_loss))
+
+        loss = torch.stack(loss, dim=-1) * masks
+        return torch.sum(loss, dim=1), torch.sum(loss, dim=0)
+
+    def _modality_recon_loss(self, i, x, r, h, loss_type, group, size_factor, dispersion, loss_coefs):
+        if r is None:
+            return -loss_coefs[str(i)] * self._sampled_log_prob(x, h, self.decoders[i], group, size_factor, dispersion)
+        # merge a singleton sample axis into the cells, keeping the cell axis of batches with a single cell
+        if isinstance(r, torch.Tensor) and r.dim() == 3:
+            r = r.flatten(0, 1)
+        if loss_type == "mse":
+            return loss_coefs[str(i)] * torch.sum(nn.MSELoss(reduction="none")(r, x), dim=-1)
+        elif loss_type == "nb":
+            dec_mean = r
+            size_factor_view = size_factor.expand(dec_mean.size(0), dec_mean.size(1))
+            dec_mean = dec_mean * size_factor_view
+            nb_loss = self._grouped_log_prob(nb_log_likelihood, x, dec_mean, dispersion, group)
+            return -loss_coefs[str(i)] * nb_loss
+        elif loss_type == "zinb":
+            dec_mean, dec_dropout = r
+            if dec_mean.dim() == 3:
+                dec_mean, dec_dropout = dec_mean.flatten(0, 1), dec_dropout.flatten(0, 1)
+            size_factor_view = size_factor.expand(dec_mean.size(0), dec_mean.size(1))
+            dec_mean = dec_mean * size_factor_view
+            zinb_loss = self._grouped_log_prob(zinb_log_likelihood, x, dec_mean, dispersion, group, dec_dropout)
+            return -loss_coefs[str(i)] * zinb_loss
+        elif loss_type == "bce":
+            return loss_coefs[str(i)] * torch.sum(torch.nn.BCELoss(reduction="none")(r, x), dim=-1)
+
+    def _grouped_log_prob(self, log_likelihood, x, mu, dispersion, group, *params):
+        """Evaluate the ``'nb'`` or ``'zinb'`` log-likelihood of each cell with the dispersion of its group.
+
+        The cells are evaluated group by group against a single row of ``dispersion`` that is broadcast over the
+        cells, so that no dispersion matrix of shape ``(batch_size, n_features)`` is built and the terms that only
+        depend on the dispersion are evaluated once per group. The split into groups needs the group sizes on the
+        host, so compiled graphs gather the dispersion of each cell instead.
+
+        Parameters
+        ----------
+        log_likelihood
+            Log-likelihood of each cell given ``mu``, a dispersion shared by the cells or given per cell, ``params``
+            and ``sparse``, e.g. :func:`multimil.distributions.nb_log_likelihood`.
+        x
+            Counts of shape ``(batch_size, n_features)``.
+        mu
+            Means of shape ``(batch_size, n_features)``.
+        dispersion
+            Dispersion of each group of shape ``(num_groups, n_features)``.
+        group
+            Group of each cell of shape ``(batch_size,)`` or ``(batch_size, 1)``.
+        params
+            Further parameters of shape ``(batch_size, n_features)``, e.g. the dropout logits of ``'zinb'``.
+
+        Returns
+        -------
+        Log-likelihood of shape ``(batch_size,)``.
+        """
+        if dispersion.shape[0] == 1:
+            return log_likelihood(x, mu, dispersion, *params, sparse=self.sparse_counts)
+        group = group.view(-1).long()
+        if torch.compiler.is_compiling():
+            return log_likelihood(x, mu, dispersion[group], *params, sparse=self.sparse_counts)
+        # sorted by group, so that the cells of each group are a slice
+        order = torch.argsort(group, stable=True)
+        counts = torch.bincount(group, minlength=dispersion.shape[0]).tolist()
+        cells = zip(*(t[order].split(counts) for t in [x, mu, *params]), strict=True)
+        sorted_log_prob = torch.cat(
+            [
+                log_likelihood(x_group, mu_group, dispersion[g], *params_group, sparse=self.sparse_counts)
+                for g, (x_group, mu_group, *params_group) in enumerate(cells)
+            ]
         )
+        return sorted_log_prob.new_zeros(x.shape[0]).index_copy(0, order, sorted_log_prob)
+
+    def _sampled_log_prob(self, x, h, decoder, group, size_factor, dispersion):
+        """Estimate the ``'nb'`` or ``'zinb'`` log-likelihood of each cell from its nonzero and a sample of its zero features.
 
-    def _calc_integ_loss(self, z, group):
-        loss = torch.tensor(0.0).to(self.device)
-        unique = torch.unique(group)
-        if len(unique) > 1:
-            zs = [z[group == i] for i in unique]
-            for i in range(len(zs)):
-                for j in range(i + 1, len(zs)):
-                    loss += MMD(kernel_type=self.kernel_type)(zs[i], zs[j])
+        Parameters
+        ----------
+        x
+            Counts of shape ``(batch_size, n_features)``.
+        h
+            Hidden state of the decoder of shape ``(batch_size, n_hidden)``.
+        decoder
+            Decoder of the modality.
+        group
+            Group of each cell of shape ``(batch_size,)`` or ``(batch_size, 1)``, selects the dispersion.
+        size_factor
+            Size factors of shape ``(batch_size, 1)``.
+        dispersion
+            Dispersion of each group of shape ``(num_groups, n_features)``.
+
+        Returns
+        -------
+        Estimated log-likelihood of shape ``(batch_size,)``. The means of all features, including the nonzero ones,
+        depend on the softmax normalizer, which is estimated from the sampled features, so all terms are noisy and,
+        as the normalizer enters through its logarithm, biased. The estimate is exact if all features are sampled.
+        """
+        n_features = x.shape[-1]
+        n_samples = min(self.n_negative_samples, n_features)
+        # the sampled features are shared by the minibatch, so that only few extra columns have to be decoded, and
+        # the zeros among them stand in for all zeros of each cell
+        in_sample = torch.zeros(n_features, dtype=torch.bool, device=x.device)
+        in_sample[torch.randperm(n_features, device=x.device)[:n_samples]] = True
+        nonzero = x > 0
+        columns = (nonzero.any(dim=0) | in_sample).nonzero().squeeze(-1)
+        x, nonzero = x[:, columns], nonzero[:, columns]
+        weights = torch.where(nonzero, 1.0, in_sample[columns] * (n_features / n_samples))
+
+        mean_logits, dropout_logits = decoder.column_logits(h, columns)
+        # the softmax normalizer over all features is estimated with the same weights
+        log_normalizer = torch.logsumexp(mean_logits + weights.log(), dim=-1)
+
+        # the likelihood is only evaluated for the nonzero and sampled entries of each cell
+        cells, features = weights.nonzero(as_tuple=True)
+        dec_mean = torch.exp(mean_logits[cells, features] - log_normalizer[cells]) * size_factor[cells, 0]
+        dispersion = dispersion[group.view(-1)[cells].long(), columns[features]]
+        # each entry is passed as a cell with a single feature, so that the log-likelihoods of the entries are returned
+        entries = (x[cells, features].unsqueeze(-1), dec_mean.unsqueeze(-1), dispersion.unsqueeze(-1))
+        if dropout_logits is None:
+            log_prob = nb_log_likelihood(*entries)
+        else:
+            log_prob = zinb_log_likelihood(*entries, dropout_logits[cells, features].unsqueeze(-1))
+        return torch.zeros_like(log_normalizer).index_add(0, cells, weights[cells, features] * log_prob)
+
+    def _calc_integ_loss(self, z, z_marginal, group, masks):
+        """Calculate the MMD integration loss.
+
+        The latent term reads the MMDs between all pairs of groups from one pass over ``z``. The marginal term reads
+        all of its MMDs from one pass over the stacked marginals, with one set of rows per side of each pair of
+        modalities and per group within each modality. The two terms don't share rows, so they are separate passes
+        and no kernel tiles between the joint and the marginal representations are evaluated.
+
+        Parameters
+        ----------
+        z
+            Joint latent representation of shape ``(batch_size, z_dim)``.
+        z_marginal
+            Marginal latent representations of shape ``(batch_size, n_modality, z_dim)``.
+        group
+            Group of each cell of shape ``(batch_size, 1)``.
+        masks
+            Boolean tensor of shape ``(batch_size, n_modality)`` indicating which modalities are present.
+
+        Returns
+        -------
+        Sum of the MMDs between the groups and between the marginals.
+        """
+        groups = nn.functional.one_hot(group.view(-1).long(), self.num_groups).bool()
+        loss = 0
+        if self.mmd == "latent" or self.mmd == "both":
+            loss = loss + self.mmd_loss.between_sets(z, groups, self.integ_pairs)
+        if self.mmd == "marginal" or self.mmd == "both":
+            # rows of the marginals are ordered by modality, i.e. (n_modality * batch_size, z_dim)
+            z_marginal = z_marginal.transpose(0, 1).reshape(-1, z_marginal.shape[-1])
+            sets = self._marginal_sets(groups, masks)
+            loss = loss + self.mmd_loss.between_sets(z_marginal, sets, self.marginal_pairs)
         return loss
 
+    def _marginal_sets(self, groups, masks):
+        n_modality = masks.shape[1]
+        modality = torch.arange(n_modality, device=masks.device)
+        # marginal i and j of the cells where both modalities are present
+        both = masks[:, self.modality_pairs[:, 0]] & masks[:, self.modality_pairs[:, 1]]
+        owner = self.modality_pairs.reshape(-1) == modality.view(-1, 1)  # n_modality x n_pair_sets
+        pair_sets = both.repeat_interleave(2, dim=1).unsqueeze(0) & owner.unsqueeze(1)
+        # groups of the cells where the modality is present, block diagonal over the modalities
+        group_sets = (
+            masks.T.view(n_modality, -1, 1, 1)
+            & (modality.view(-1, 1) == modality).view(n_modality, 1, n_modality, 1)
+            & groups.unsqueeze(0).unsqueeze(2)
+        )
+        group_sets = group_sets.reshape(n_modality, groups.shape[0], -1)
+        return torch.cat([pair_sets, group_sets], dim=-1).reshape(n_modality * groups.shape[0], -1)
+
     def _compute_cont_cov_embeddings(self, covs):
         """Compute embeddings for continuous covariates.
 
@@ -632,7 +1185,9 @@ class MultiVAETorch(BaseModuleClass):
         https://github.com/facebookresearch/CPA/blob/382ff641c588820a453d801e5d0e5bb56642f282/compert/model.py#L342
 
         """
-        if self.cont_cov_type == "mlp":
+        if self._group_cont_covariate_curves:
+            return self._grouped_cont_covariate_curves(covs).sigmoid() @ self.cont_covariate_embeddings.weight
+        elif self.cont_cov_type == "mlp":
             embeddings = []
             for cov in range(covs.size(1)):
                 this_cov = covs[:, cov].view(-1, 1)
@@ -643,6 +1198,22 @@ class MultiVAETorch(BaseModuleClass):
         else:
             return self.cont_covariate_curves(covs) @ self.cont_covariate_embeddings.weight
 
+    def _grouped_cont_covariate_curves(self, covs):
+        # the MLP curves of all continuous covariates at once, of shape (batch_size, n_cont_cov), with the parameters
+        # of the curves stacked along a leading covariate axis
+        curves = list(self.cont_covariate_curves)
+        if self.n_layers_cont_embed == 1:
+            # each curve is a single nn.Linear(1, 1)
+            weight = torch.cat([curve.weight for curve in curves]).view(-1)
+            bias = torch.cat([curve.bias for curve in curves])
+            return torch.addcmul(bias, covs, weight)
+        h = covs.T.unsqueeze(-1)
+        for layers in zip(*[curve[0].mlp.fc_layers for curve in curves], strict=True):
+            h = grouped_fc_layer(h, list(layers))
+        weight = torch.stack([curve[1].weight for curve in curves])
+        bias = torch.stack([curve[1].bias for curve in curves])
+        return torch.baddbmm(bias.unsqueeze(1), h, weight.transpose(1, 2)).squeeze(-1).T
+
     def select_losses_to_plot(self):
         """Select losses to plot.
 
@@ -656,3 +1227,11 @@ class MultiVAETorch(BaseModuleClass):
         if self.loss_coefs["integ"] != 0:
             loss_names.append("integ_loss")
         return loss_names
+
+
+def _select_condition_rows(conditions, rows):
+    # conditions of the cells in rows, see MultiVAETorch._conditions, empty tensors stand for missing covariates
+    if len(conditions) == 3:
+        # only the combination of each cell is given per cell
+        return (*conditions[:2], conditions[2][rows])
+    return tuple(t if t.numel() == 0 else t[rows] for t in conditions)
@@ -1,3 +1,25 @@
-from ._base_components import MLP, Aggregator, Decoder, GeneralizedSigmoid
+from ._base_components import (
+    MLP,
+    Aggregator,
+    Decoder,
+    GeneralizedSigmoid,
+    LowRankLinear,
+    can_group_fc_layers,
+    chunked_attention_pool,
+    fc_layer,
+    grouped_fc_layer,
+    shared_input_fc_layer,
+)
 
-__all__ = ["MLP", "Decoder", "GeneralizedSigmoid", "Aggregator"]
+__all__ = [
+    "MLP",
+    "Decoder",
+    "GeneralizedSigmoid",
+    "LowRankLinear",
+    "Aggregator",
+    "can_group_fc_layers",
+    "chunked_attention_pool",
+    "fc_layer",
+    "grouped_fc_layer",
+    "shared_input_fc_layer",
+]
@@ -5,6 +5,7 @@ from scvi.nn import FCLayers
 from torch import nn
 from torch.nn import functional as F
 
+
 class MLP(nn.Module):
     """A helper class to build blocks of fully-connected, normalization, dropout and activation layers.
 
@@ -57,19 +58,36 @@ class MLP(nn.Module):
             activation_fn=activation,
         )
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self, x: torch.Tensor, covariates: Optional[torch.Tensor] = None, offset: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
         """Forward computation on ``x``.
 
         Parameters
         ----------
         x
-            Tensor of values with shape ``(n_input,)``.
+            Tensor of values with shape ``(n_input,)``, or a sparse COO or CSR tensor of shape
+            ``(batch_size, n_input - n_covariates)``. The first layer of a sparse ``x`` is a sparse-dense matmul.
+        covariates
+            Dense tensor of shape ``(batch_size, n_covariates)`` that is concatenated to ``x`` along the feature axis.
+        offset
+            Tensor of shape ``(batch_size, n_hidden)`` added to the output of the first linear layer, see
+            :func:`fc_layer`.
 
         Returns
         -------
         Tensor of values with shape ``(n_output,)``.
         """
-        return self.mlp(x)
+        if x.layout == torch.strided and offset is None:
+            if covariates is not None:
+                x = torch.cat([x, covariates], dim=-1)
+            return self.mlp(x)
+        first, *rest = self.mlp.fc_layers
+        h = fc_layer(x, first, covariates, offset)
+        for layer in rest:
+            h = fc_layer(h, layer)
+        return h
+
 
 class Decoder(nn.Module):
     """A helper class to build custom decoders depending on which loss was passed.
@@ -92,6 +110,8 @@ class Decoder(nn.Module):
         Activation function to use.
     loss
         Loss function to use. Can be one of ["mse", "nb", "zinb", "bce"].
+    rank
+        If not `None`, the output layers are factorized as n_hidden -> rank -> n_output with :class:`LowRankLinear`.
     """
 
     def __init__(
@@ -104,6 +124,7 @@ class Decoder(nn.Module):
         normalization: str = "layer",
         activation=nn.LeakyReLU,
         loss="mse",
+        rank: Optional[int] = None,
     ):
         super().__init__()
 
@@ -122,13 +143,18 @@ class Decoder(nn.Module):
             activation=activation,
         )
 
+        def output_layer():
+            return nn.Linear(n_hidden, n_output) if rank is None else LowRankLinear(n_hidden, n_output, rank)
+
         if loss == "mse":
-            self.recon_decoder = nn.Linear(n_hidden, n_output)
+            self.recon_decoder = output_layer()
         elif loss == "nb":
-            self.mean_decoder = nn.Sequential(nn.Linear(n_hidden, n_output), nn.Softmax(dim=-1))
+            self.mean_decoder = nn.Sequential(output_layer(), nn.Softmax(dim=-1))
         elif loss == "zinb":
-            self.mean_decoder = nn.Sequential(nn.Linear(n_hidden, n_output), nn.Softmax(dim=-1))
-            self.dropout_decoder = nn.Linear(n_hidden, n_output)
+            self.mean_decoder = nn.Sequential(output_layer(), nn.Softmax(dim=-1))
+            self.dropout_decoder = output_layer()
+        elif loss == "bce" and rank is not None:
+            self.recon_decoder = nn.Sequential(output_layer(), nn.Sigmoid())
         elif loss == "bce":
             self.recon_decoder = FCLayers(
                 n_in=n_hidden,
@@ -152,13 +178,204 @@ class Decoder(nn.Module):
         -------
         Tensor of values with shape ``(n_output,)``.
         """
-        x = self.decoder(x)
+        return self.from_hidden(self.decoder(x))
+
+    def from_hidden(self, h: torch.Tensor) -> torch.Tensor:
+        """Apply the loss-specific output layers to the hidden representation ``h`` of the decoder.
+
+        Parameters
+        ----------
+        h
+            Tensor of values with shape ``(n_hidden,)``.
+
+        Returns
+        -------
+        Tensor of values with shape ``(n_output,)``.
+        """
         if self.loss in ["mse", "bce"]:
-            return self.recon_decoder(x)
+            return self.recon_decoder(h)
         elif self.loss == "nb":
-            return self.mean_decoder(x)
+            return self.mean_decoder(h)
         elif self.loss == "zinb":
-            return self.mean_decoder(x), self.dropout_decoder(x)
+            return self.mean_decoder(h), self.dropout_decoder(h)
+
+    def column_logits(self, h: torch.Tensor, columns: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor | None]:
+        """Compute the output-layer logits of the ``"nb"`` and ``"zinb"`` decoders for a subset of the features.
+
+        Parameters
+        ----------
+        h
+            Hidden representation of the decoder with shape ``(batch_size, n_hidden)``.
+        columns
+            Indices of the features to compute.
+
+        Returns
+        -------
+        Logits of the mean before the softmax over all features and, for ``"zinb"``, logits of the dropout, each with
+        shape ``(batch_size, len(columns))``.
+        """
+        if self.loss not in ["nb", "zinb"]:
+            raise ValueError(f'column_logits is only defined for the "nb" and "zinb" losses, but loss={self.loss}.')
+        mean_logits = _output_columns(self.mean_decoder[0], h, columns)
+        if self.loss == "nb":
+            return mean_logits, None
+        return mean_logits, _output_columns(self.dropout_decoder, h, columns)
+
+
+def _output_columns(layer: nn.Module, h: torch.Tensor, columns: torch.Tensor) -> torch.Tensor:
+    if isinstance(layer, LowRankLinear):
+        layer, h = layer.up, layer.down(h)
+    return F.linear(h, layer.weight[columns], layer.bias[columns])
+
+
+class LowRankLinear(nn.Module):
+    """A linear layer factorized through a bottleneck of size `rank`.
+
+    Uses `rank * (in_features + out_features) + out_features` parameters instead of
+    `(in_features + 1) * out_features`, which is much smaller for wide outputs.
+
+    Parameters
+    ----------
+    in_features
+        Number of input features.
+    out_features
+        Number of output features.
+    rank
+        Size of the bottleneck.
+    """
+
+    def __init__(self, in_features: int, out_features: int, rank: int):
+        super().__init__()
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Forward computation on `x`.
+
+        Parameters
+        ----------
+        x
+            Tensor of values with shape ``(..., in_features)``.
+
+        Returns
+        -------
+        Tensor of values with shape ``(..., out_features)``.
+        """
+        return self.up(self.down(x))
+
+
+def can_group_fc_layers(layers: list[nn.Sequential]) -> bool:
+    """Check if the same layer of several :class:`~scvi.nn.FCLayers` can be evaluated with :func:`grouped_fc_layer`.
+
+    Parameters
+    ----------
+    layers
+        One ``FCLayers`` layer, i.e. ``Sequential(Linear, BatchNorm1d, LayerNorm, activation, Dropout)``, per group.
+
+    Returns
+    -------
+    Whether all layers have linear weights of the same shape with bias and no batch normalization.
+    """
+    return all(
+        layer[0].weight.shape == layers[0][0].weight.shape and layer[0].bias is not None and layer[1] is None
+        for layer in layers
+    )
+
+
+def grouped_fc_layer(x: torch.Tensor, layers: list[nn.Sequential]) -> torch.Tensor:
+    """Evaluate the same layer of several :class:`~scvi.nn.FCLayers` on stacked inputs with one batched matmul.
+
+    Parameters
+    ----------
+    x
+        Tensor of values with shape ``(n_groups, batch_size, n_in)``, one slice per layer.
+    layers
+        Layers for which :func:`can_group_fc_layers` holds. The activation and dropout of the first layer are used for
+        all groups.
+
+    Returns
+    -------
+    Tensor of values with shape ``(n_groups, batch_size, n_out)``.
+    """
+    weight = torch.stack([layer[0].weight for layer in layers])
+    bias = torch.stack([layer[0].bias for layer in layers])
+    return _fc_layer_pointwise(torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2)), layers[0])
+
+
+def shared_input_fc_layer(x: torch.Tensor, layers: list[nn.Sequential]) -> torch.Tensor:
+    """Evaluate the same layer of several :class:`~scvi.nn.FCLayers` on one shared input with one matmul.
+
+    Parameters
+    ----------
+    x
+        Tensor of values with shape ``(batch_size, n_in)``.
+    layers
+        Layers for which :func:`can_group_fc_layers` holds.
+
+    Returns
+    -------
+    Tensor of values with shape ``(n_groups, batch_size, n_out)``.
+    """
+    weight = torch.cat([layer[0].weight for layer in layers])
+    bias = torch.cat([layer[0].bias for layer in layers])
+    h = F.linear(x, weight, bias).view(x.shape[0], len(layers), -1).transpose(0, 1)
+    return _fc_layer_pointwise(h, layers[0])
+
+
+def fc_layer(
+    x: torch.Tensor,
+    layer: nn.Sequential,
+    covariates: Optional[torch.Tensor] = None,
+    offset: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Evaluate a single layer of :class:`~scvi.nn.FCLayers` without covariates.
+
+    Parameters
+    ----------
+    x
+        Tensor of values with shape ``(batch_size, n_in)``. If ``x`` is a sparse COO or CSR tensor, the linear map is a
+        sparse-dense matmul whose cost scales with the number of nonzeros of ``x``.
+    layer
+        ``FCLayers`` layer, modules that are switched off are ``None``.
+    covariates
+        Dense tensor of shape ``(batch_size, n_covariates)`` that is concatenated to ``x`` along the feature axis.
+    offset
+        Tensor of shape ``(batch_size, n_out)`` added to the output of the linear map, e.g. the output of columns of
+        the weight that are neither evaluated for ``x`` nor for ``covariates``. With an offset, ``x`` is multiplied by
+        the first and ``covariates`` by the last columns of the weight.
+
+    Returns
+    -------
+    Tensor of values with shape ``(batch_size, n_out)``.
+    """
+    linear = layer[0]
+    if covariates is not None and covariates.numel() == 0:
+        covariates = None
+    if x.layout == torch.strided and offset is None:
+        if covariates is not None:
+            x = torch.cat([x, covariates], dim=-1)
+        return _fc_layer_pointwise(linear(x), layer)
+    n_x = x.shape[-1]
+    if x.layout == torch.strided:
+        h = torch.mm(x, linear.weight[:, :n_x].T)
+    else:
+        h = torch.sparse.mm(x, linear.weight[:, :n_x].T)
+    if covariates is not None:
+        h = torch.addmm(h, covariates, linear.weight[:, linear.weight.shape[1] - covariates.shape[-1] :].T)
+    if offset is not None:
+        h = h + offset
+    if linear.bias is not None:
+        h = h + linear.bias
+    return _fc_layer_pointwise(h, layer)
+
+
+def _fc_layer_pointwise(x: torch.Tensor, layer: nn.Sequential) -> torch.Tensor:
+    # normalization, activation and dropout after the linear map, the same modules act on each group alike
+    for module in list(layer)[1:]:
+        if module is not None:
+            x = module(x)
+    return x
+
 
 class GeneralizedSigmoid(nn.Module):
     """Sigmoid, log-sigmoid or linear functions for encoding continuous covariates.
@@ -205,6 +422,7 @@ class GeneralizedSigmoid(nn.Module):
         else:
             return x
 
+
 class Aggregator(nn.Module):
     """A helper class to build custom aggregators depending on the scoring function.
 
@@ -289,51 +507,307 @@ class Aggregator(nn.Module):
                     nn.Linear(n_hidden_mlp_attn, 1),
                 )
 
-    def forward(self, x) -> torch.Tensor:
+    def _fused_gated_scores(self, x: torch.Tensor) -> torch.Tensor:
+        """Gated attention scores of shape `(n_cells,)` without autograd.
+
+        Both projections are computed as `(attn_dim, n_cells)` directly from the weights of `attention_V` and
+        `attention_U`, so that the activations and the gate are applied in place on contiguous rows.
+        """
+        V, U = self.attention_V[0], self.attention_U[0]
+        gated = torch.addmm(V.bias.unsqueeze(-1), V.weight, x.T).tanh_()  # (attn_dim, n_cells)
+        gated.mul_(torch.addmm(U.bias.unsqueeze(-1), U.weight, x.T).sigmoid_())
+        return self.attention_weights.weight[0] @ gated
+
+    def _scores(self, x: torch.Tensor) -> torch.Tensor:
+        """Unnormalized attention scores of shape `(n_cells,)`."""
+        # from https://github.com/AMLab-Amsterdam/AttentionDeepMIL/blob/master/model.py (accessed 16.09.2021)
+        if self.scoring == "gated_attn":
+            if torch.is_grad_enabled():
+                A_V = self.attention_V(x)  # (n_cells, attn_dim)
+                A_U = self.attention_U(x)  # (n_cells, attn_dim)
+                return self.attention_weights(A_V * A_U).squeeze(-1)
+            return self._fused_gated_scores(x)
+        return self.attention(x).squeeze(-1)  # "attn" and "mlp"
+
+    def forward(
+        self, x: torch.Tensor, offsets: Optional[torch.Tensor] = None
+    ) -> tuple[torch.Tensor, torch.Tensor | None]:
         """Forward computation on `x`.
 
+        Bags can have different sizes: the cells of all bags are passed as one tensor together with the offsets of
+        the bags, and attention is normalized within each bag. No state is kept between calls, the attention weights
+        are returned together with the pooled output.
+
         Parameters
         ----------
         x : torch.Tensor
-            Input tensor of shape `(batch_size, N, n_input)`.
+            Input tensor of shape `(n_cells, n_input)` with the cells of all bags one after the other, or of shape
+            `(n_bags, bag_size, n_input)` for bags of equal size.
+        offsets : Optional[torch.Tensor]
+            Tensor of shape `(n_bags + 1,)` with the index of the first cell of each bag followed by `n_cells`.
+            Required if `x` is two-dimensional.
 
         Returns
         -------
-        torch.Tensor
-            Aggregated output tensor of shape `(batch_size, n_input)`.
+        tuple[torch.Tensor, torch.Tensor | None]
+            Aggregated output tensor of shape `(n_bags, n_input)` and attention weights of shape `(n_cells,)`, or
+            `(n_bags, 1, bag_size)` for three-dimensional `x`. Attention is `None` for the "sum", "mean" and "max"
+            scoring functions.
         """
+        if x.dim() == 3:
+            n_bags, bag_size, n_input = x.shape
+            offsets = torch.arange(0, n_bags * bag_size + 1, bag_size, device=x.device)
+            pooled, A = self.forward(x.reshape(-1, n_input), offsets)
+            return pooled, None if A is None else A.view(n_bags, 1, bag_size)
+        if offsets is None:
+            raise ValueError("offsets must be given when x has shape (n_cells, n_input).")
+
+        sizes = offsets.diff()
+        n_bags = sizes.shape[0]
+        segments = torch.repeat_interleave(torch.arange(n_bags, device=x.device), sizes, output_size=x.shape[0])
+
         # Apply different pooling strategies based on the scoring method
-        if self.scoring in ["attn", "gated_attn", "mlp", "sum", "mean", "max"]:
-            if self.scoring == "attn":
-                # from https://github.com/AMLab-Amsterdam/AttentionDeepMIL/blob/master/model.py (accessed 16.09.2021)
-                A = self.attention(x)  # (batch_size, N, 1)
-                A = A.transpose(1, 2)  # (batch_size, 1, N)
-                A = F.softmax(A, dim=-1)
-            elif self.scoring == "gated_attn":
-                # from https://github.com/AMLab-Amsterdam/AttentionDeepMIL/blob/master/model.py (accessed 16.09.2021)
-                A_V = self.attention_V(x)  # (batch_size, N, attn_dim)
-                A_U = self.attention_U(x)  # (batch_size, N, attn_dim)
-                A = self.attention_weights(A_V * A_U)  # (batch_size, N, 1)
-                A = A.transpose(1, 2)  # (batch_size, 1, N)
-                A = F.softmax(A, dim=-1)
-            elif self.scoring == "mlp":
-                A = self.attention(x)  # (batch_size, N, 1)
-                A = A.transpose(1, 2)  # (batch_size, 1, N)
-                A = F.softmax(A, dim=-1)
-
-            elif self.scoring == "sum":
-                return torch.sum(x, dim=1)  # (batch_size, n_input)
-            elif self.scoring == "mean":
-                return torch.mean(x, dim=1)  # (batch_size, n_input)
-            elif self.scoring == "max":
-                return torch.max(x, dim=1).values  # (batch_size, n_input)
-            else:
-                raise NotImplementedError(
-                    f'scoring = {self.scoring} is not implemented. Has to be one of ["attn", "gated_attn", "mlp", "sum", "mean", "max"].'
-                    )
-            if self.scale:
-                if self.patient_batch_size is None:
-                    raise ValueError("patient_batch_size must be set when scale is True.")
-                A = A * A.shape[-1] / self.patient_batch_size
-
-            pooled = torch.bmm(A, x).squeeze(dim=1)  # (batch_size, n_input)
+        if self.scoring == "sum":
+            return _segment_sum(x, segments, n_bags), None  # (n_bags, n_input)
+        elif self.scoring == "mean":
+            return _segment_sum(x, segments, n_bags) / sizes.unsqueeze(-1), None  # (n_bags, n_input)
+        elif self.scoring == "max":
+            index = segments.unsqueeze(-1).expand_as(x)
+            return x.new_zeros(n_bags, x.shape[-1]).scatter_reduce(0, index, x, "amax", include_self=False), None
+        elif self.scoring not in ["attn", "gated_attn", "mlp"]:
+            raise NotImplementedError(
+                f'scoring = {self.scoring} is not implemented. Has to be one of ["attn", "gated_attn", "mlp", "sum", "mean", "max"].'
+            )
+
+        A = _segment_softmax(self._scores(x), segments, n_bags)  # (n_cells,)
+        if self.scale:
+            if self.patient_batch_size is None:
+                raise ValueError("patient_batch_size must be set when scale is True.")
+            A = A * (sizes / self.patient_batch_size)[segments]
+
+        pooled = _segment_weighted_sum(A, x, sizes)  # (n_bags, n_input)
+        return pooled, A
+
+    def stream(
+        self,
+        x: torch.Tensor,
+        segments: torch.Tensor,
+        n_segments: int,
+        state: Optional[tuple[torch.Tensor, ...]] = None,
+    ) -> tuple[torch.Tensor | None, tuple[torch.Tensor, ...]]:
+        """Update the pooling of bags whose cells are passed in several chunks.
+
+        For attention, the running maximum of the scores, the softmax denominator and the weighted sum of the cells
+        are kept per bag and rescaled whenever the maximum grows (online softmax), so that the exact pooling of bags of
+        any size is computed in memory bounded by the chunk size. Use :meth:`stream_result` to get the output.
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Input tensor of shape `(n_cells, n_input)` with the cells of a chunk.
+        segments : torch.Tensor
+            Tensor of shape `(n_cells,)` with the bag of each cell in `range(n_segments)`.
+        n_segments : int
+            Total number of bags.
+        state : Optional[tuple[torch.Tensor, ...]]
+            State returned for the previous chunk, `None` for the first chunk.
+
+        Returns
+        -------
+        tuple[torch.Tensor | None, tuple[torch.Tensor, ...]]
+            Unnormalized attention scores of shape `(n_cells,)`, `None` for the "sum", "mean" and "max" scoring
+            functions, and the updated state. The state is kept in fp32.
+        """
+        scores = None if self.scoring in ["sum", "mean", "max"] else self._scores(x).float()
+        x = x.float()
+        if state is None:
+            count = x.new_zeros(n_segments)
+            shift = x.new_full((n_segments,), float("-inf"))
+            denom = x.new_zeros(n_segments)
+            total = x.new_full((n_segments, x.shape[-1]), float("-inf") if self.scoring == "max" else 0.0)
+        else:
+            count, shift, denom, total = state
+        count = count.index_add(0, segments, x.new_ones(segments.shape[0]))
+
+        if self.scoring in ["sum", "mean"]:
+            return None, (count, shift, denom, total.index_add(0, segments, x))
+        elif self.scoring == "max":
+            index = segments.unsqueeze(-1).expand_as(x)
+            return None, (count, shift, denom, total.scatter_reduce(0, index, x, "amax"))
+
+        new_shift = shift.scatter_reduce(0, segments, scores.detach(), "amax")
+        rescale = torch.exp(shift - new_shift).nan_to_num(0.0)  # nan for bags without cells so far
+        exp = torch.exp(scores - new_shift[segments])
+        denom = denom * rescale + _segment_sum(exp, segments, n_segments)
+        total = total * rescale.unsqueeze(-1) + _segment_sum(exp.unsqueeze(-1) * x, segments, n_segments)
+        return scores, (count, new_shift, denom, total)
+
+    def stream_result(
+        self,
+        state: tuple[torch.Tensor, ...],
+        scores: Optional[torch.Tensor] = None,
+        segments: Optional[torch.Tensor] = None,
+    ) -> tuple[torch.Tensor, torch.Tensor | None]:
+        """Pooled output and attention weights of the bags streamed with :meth:`stream`.
+
+        With `scale`, the attention of a bag is scaled by its size relative to `patient_batch_size` as in
+        :meth:`forward`, but at most by 1, so that a whole sample is pooled like a full training bag.
+
+        Parameters
+        ----------
+        state : tuple[torch.Tensor, ...]
+            State returned by :meth:`stream` for the last chunk.
+        scores : Optional[torch.Tensor]
+            Unnormalized attention scores of all cells returned by :meth:`stream`, one chunk after the other.
+        segments : Optional[torch.Tensor]
+            Bag of each cell in `scores`.
+
+        Returns
+        -------
+        tuple[torch.Tensor, torch.Tensor | None]
+            Aggregated output tensor of shape `(n_segments, n_input)` and attention weights of shape `(n_cells,)`,
+            `None` if no scores are given or for the "sum", "mean" and "max" scoring functions.
+        """
+        count, shift, denom, total = state
+        if self.scoring in ["sum", "max"]:
+            return total, None
+        elif self.scoring == "mean":
+            return total / count.unsqueeze(-1), None
+
+        weight = 1 / denom
+        if self.scale:
+            if self.patient_batch_size is None:
+                raise ValueError("patient_batch_size must be set when scale is True.")
+            weight = weight * (count / self.patient_batch_size).clamp(max=1.0)
+        attention = None if scores is None else torch.exp(scores - shift[segments]) * weight[segments]
+        return total * weight.unsqueeze(-1), attention
+
+
+def chunked_attention_pool(
+    x: torch.Tensor, offsets: torch.Tensor, mlp: nn.Module, aggregator: Aggregator, chunk_size: int
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Attention pooling ``aggregator(mlp(x), offsets)`` that recomputes the activations of chunks in backward.
+
+    The forward pass streams chunks of ``chunk_size`` cells through ``mlp`` and the attention scoring without keeping
+    their activations, see :meth:`Aggregator.stream`. The backward pass recomputes one chunk at a time with the same
+    random state and autocast settings and backpropagates the exact gradient of the pooling over the whole bags. The
+    memory for activations therefore depends on ``chunk_size`` but not on the size of the bags. Parameter gradients
+    are accumulated during the backward pass, as with reentrant checkpointing. With batch normalization in ``mlp``,
+    the batch statistics are those of the chunks.
+
+    Parameters
+    ----------
+    x
+        Tensor of values with shape ``(n_cells, n_input)`` with the cells of all bags one after the other.
+    offsets
+        Tensor of shape ``(n_bags + 1,)`` with the index of the first cell of each bag followed by ``n_cells``.
+    mlp
+        Module applied to the cells before the attention, e.g. :class:`MLP`.
+    aggregator
+        Aggregator with the "attn", "gated_attn" or "mlp" scoring function.
+    chunk_size
+        Number of cells per chunk.
+
+    Returns
+    -------
+    Aggregated output tensor of shape ``(n_bags, n_output)`` and attention weights of shape ``(n_cells,)``, which are
+    not differentiable.
+    """
+    if aggregator.scoring not in ["attn", "gated_attn", "mlp"]:
+        raise ValueError(f"Chunked pooling needs an attention scoring function, but scoring is {aggregator.scoring}.")
+    sizes = offsets.diff()
+    segments = torch.repeat_interleave(torch.arange(sizes.shape[0], device=x.device), sizes, output_size=x.shape[0])
+    return _ChunkedAttentionPool.apply(x, segments, sizes.shape[0], mlp, aggregator, chunk_size)
+
+
+class _ChunkedAttentionPool(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, segments, n_segments, mlp, aggregator, chunk_size):
+        device_type = x.device.type
+        ctx.autocast = (device_type, torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type))
+        ctx.rng_states = []
+        state, scores = None, []
+        for start in range(0, x.shape[0], chunk_size):
+            ctx.rng_states.append(_get_rng_state(x.device))
+            chunk = slice(start, start + chunk_size)
+            chunk_scores, state = aggregator.stream(mlp(x[chunk]), segments[chunk], n_segments, state)
+            scores.append(chunk_scores)
+        pooled, attention = aggregator.stream_result(state, torch.cat(scores), segments)
+
+        count, shift, denom, total = state
+        ctx.save_for_backward(x, segments, count, shift, denom, total)
+        ctx.mlp, ctx.aggregator, ctx.chunk_size = mlp, aggregator, chunk_size
+        ctx.mark_non_differentiable(attention)
+        return pooled, attention
+
+    @staticmethod
+    def backward(ctx, grad_pooled, grad_attention):
+        x, segments, count, shift, denom, total = ctx.saved_tensors
+        aggregator = ctx.aggregator
+        # pooled = weight * sum_i exp(s_i - shift) * zs_i, the same weights as in Aggregator.stream_result
+        weight = 1 / denom
+        if aggregator.scale:
+            weight = weight * (count / aggregator.patient_batch_size).clamp(max=1.0)
+        grad_pooled = grad_pooled.float()
+        grad_dot_mean = (grad_pooled * total).sum(dim=-1) / denom  # grad times the softmax-weighted mean of zs
+
+        grad_x = torch.zeros_like(x) if ctx.needs_input_grad[0] else None
+        device_type, autocast_enabled, autocast_dtype = ctx.autocast
+        for start, rng_state in zip(range(0, x.shape[0], ctx.chunk_size), ctx.rng_states, strict=True):
+            chunk = slice(start, start + ctx.chunk_size)
+            x_chunk = x[chunk].detach().requires_grad_(grad_x is not None)
+            with (
+                torch.enable_grad(),
+                torch.random.fork_rng(devices=[x.device] if x.is_cuda else [], device_type=device_type),
+                torch.autocast(device_type, dtype=autocast_dtype, enabled=autocast_enabled),
+            ):
+                _set_rng_state(x.device, rng_state)
+                zs = ctx.mlp(x_chunk)
+                scores = aggregator._scores(zs)
+
+            chunk_segments = segments[chunk]
+            attention = torch.exp(scores.detach().float() - shift[chunk_segments]) * weight[chunk_segments]
+            grad = grad_pooled[chunk_segments]
+            grad_zs = attention.unsqueeze(-1) * grad
+            grad_scores = attention * ((grad * zs.detach().float()).sum(dim=-1) - grad_dot_mean[chunk_segments])
+            torch.autograd.backward([zs, scores], [grad_zs.to(zs.dtype), grad_scores.to(scores.dtype)])
+            if grad_x is not None:
+                grad_x[chunk] = x_chunk.grad
+        return grad_x, None, None, None, None, None
+
+
+def _get_rng_state(device: torch.device) -> torch.Tensor:
+    return torch.cuda.get_rng_state(device) if device.type == "cuda" else torch.get_rng_state()
+
+
+def _set_rng_state(device: torch.device, state: torch.Tensor):
+    if device.type == "cuda":
+        torch.cuda.set_rng_state(state, device)
+    else:
+        torch.set_rng_state(state)
+
+
+def _segment_sum(x: torch.Tensor, segments: torch.Tensor, n_segments: int) -> torch.Tensor:
+    """Sum of the rows of `x` within each segment."""
+    return x.new_zeros(n_segments, *x.shape[1:]).index_add(0, segments, x)
+
+
+def _segment_weighted_sum(weights: torch.Tensor, x: torch.Tensor, sizes: torch.Tensor) -> torch.Tensor:
+    """Sum of the rows of `x` weighted by `weights` within each segment of `sizes` consecutive rows.
+
+    The weighted rows are not materialized, each segment is reduced by a matrix product, batched if all segments have
+    the same size.
+    """
+    sizes = sizes.tolist()
+    if len(set(sizes)) == 1:
+        return torch.bmm(weights.view(len(sizes), 1, -1), x.view(len(sizes), sizes[0], -1)).squeeze(1)
+    return torch.stack([w @ x_segment for w, x_segment in zip(weights.split(sizes), x.split(sizes), strict=True)])
+
+
+def _segment_softmax(scores: torch.Tensor, segments: torch.Tensor, n_segments: int) -> torch.Tensor:
+    """Softmax of `scores` within each segment."""
+    # the shift doesn't change the softmax, so it is taken out of the graph
+    shift = scores.new_full((n_segments,), float("-inf"))
+    shift = shift.scatter_reduce(0, segments, scores.detach(), "amax")
+    exp = torch.exp(scores - shift[segments])
+    return exp / _segment_sum(exp, segments, n_segments)[segments]
@@ -1,13 +1,18 @@
 from ._utils import (
+    autocast_fp32,
     calculate_size_factor,
+    compile_fn,
+    compiled_forward,
     create_df,
     get_bag_info,
     get_predictions,
+    parallel_branches,
     plt_plot_losses,
-    prep_minibatch,
     save_predictions_in_adata,
     select_covariates,
     setup_ordinal_regression,
+    to_fp32,
+    whole_sample_outputs,
 )
 
 __all__ = [
@@ -15,9 +20,14 @@ __all__ = [
     "calculate_size_factor",
     "setup_ordinal_regression",
     "select_covariates",
-    "prep_minibatch",
     "get_predictions",
     "get_bag_info",
     "save_predictions_in_adata",
     "plt_plot_losses",
+    "compile_fn",
+    "compiled_forward",
+    "autocast_fp32",
+    "to_fp32",
+    "parallel_branches",
+    "whole_sample_outputs",
 ]
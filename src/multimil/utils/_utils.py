@@ -1,10 +1,16 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import cache, wraps
 from math import ceil
+
 import numpy as np
 import pandas as pd
 import scipy
 import torch
 from matplotlib import pyplot as plt
 
+
 def create_df(pred, columns=None, index=None) -> pd.DataFrame:
     """Create a pandas DataFrame from a list of predictions.
 
@@ -34,6 +40,7 @@ def create_df(pred, columns=None, index=None) -> pd.DataFrame:
         df.columns = columns
     return df
 
+
 def calculate_size_factor(adata, size_factor_key, rna_indices_end) -> str:
     """Calculate size factors.
 
@@ -69,7 +76,8 @@ def calculate_size_factor(adata, size_factor_key, rna_indices_end) -> str:
             adata.obs.loc[:, "size_factors"] = adata_rna.X.sum(1).T.tolist()
         return "size_factors"
 
-#def calculate_size_factor(adata, size_factor_key, rna_indices_end) -> str:
+
+# def calculate_size_factor(adata, size_factor_key, rna_indices_end) -> str:
 #    """Calculate size factors.
 #
 #    Parameters
@@ -106,6 +114,7 @@ def calculate_size_factor(adata, size_factor_key, rna_indices_end) -> str:
 #    adata.obs["size_factors"] = adata_rna.X.sum(1).A1 if scipy.sparse.issparse(adata_rna.X) else adata_rna.X.sum(1)
 #    return "size_factors"
 
+
 def setup_ordinal_regression(adata, ordinal_regression_order, categorical_covariate_keys):
     """Setup ordinal regression.
 
@@ -131,8 +140,9 @@ def setup_ordinal_regression(adata, ordinal_regression_order, categorical_covari
                 )
             adata.obs[key] = adata.obs[key].cat.reorder_categories(ordinal_regression_order[key], ordered=True)
 
-def select_covariates(covs, prediction_idx, n_samples_in_batch) -> torch.Tensor:
-    """Select prediction covariates from all covariates.
+
+def select_covariates(covs, prediction_idx, bag_offsets) -> torch.Tensor:
+    """Select prediction covariates of each bag from all covariates.
 
     Parameters
     ----------
@@ -140,42 +150,24 @@ def select_covariates(covs, prediction_idx, n_samples_in_batch) -> torch.Tensor:
         Covariates.
     prediction_idx : list
         Index of predictions.
-    n_samples_in_batch : int
-        Number of samples in the batch.
+    bag_offsets : torch.Tensor
+        Index of the first cell of each bag followed by the number of cells.
 
     Returns
     -------
     torch.Tensor
-        Prediction covariates.
+        Prediction covariates of shape ``(n_bags, len(prediction_idx))``.
     """
     if len(prediction_idx) > 0:
-        covs = torch.index_select(covs, 1, torch.tensor(prediction_idx))
-        covs = covs.view(n_samples_in_batch, -1, len(prediction_idx))[:, 0, :]
+        covs = covs[bag_offsets[:-1]]  # the same for all cells in a bag
+        covs = torch.index_select(covs, 1, torch.as_tensor(prediction_idx, device=covs.device))
     else:
         covs = torch.tensor([])
     return covs
 
-def prep_minibatch(covs, sample_batch_size) -> tuple[int, int]:
-    """Prepare minibatch.
-
-    Parameters
-    ----------
-    covs : torch.Tensor
-        Covariates.
-    sample_batch_size : int
-        Sample batch size.
-
-    Returns
-    -------
-    tuple[int, int]
-        Batch size and number of samples in the batch.
-    """
-    batch_size = covs.shape[0]
-    n_samples_in_batch = 1 if batch_size % sample_batch_size != 0 else batch_size // sample_batch_size
-    return batch_size, n_samples_in_batch
 
 def get_predictions(
-    prediction_idx, pred_values, true_values, size, bag_pred, bag_true, full_pred, offset=0
+    prediction_idx, pred_values, true_values, bag_sizes, bag_pred, bag_true, full_pred, offset=0
 ) -> tuple[dict, dict, dict]:
     """Get predictions.
 
@@ -187,8 +179,8 @@ def get_predictions(
         Predicted values.
     true_values : torch.Tensor
         True values.
-    size : int
-        Size of the bag minibatch.
+    bag_sizes : torch.Tensor
+        Number of cells in each bag of the minibatch.
     bag_pred : dict
         Bag predictions.
     bag_true : dict
@@ -206,44 +198,79 @@ def get_predictions(
     for i in range(len(prediction_idx)):
         bag_pred[i] = bag_pred.get(i, []) + [pred_values[offset + i].cpu()]
         bag_true[i] = bag_true.get(i, []) + [true_values[:, i].cpu()]
-        # TODO in ord reg had pred[len(self.mil.class_idx) + i].repeat(1, size).flatten()
-        # in reg had
         # cell level, i.e. prediction for the cell = prediction for the bag
-        full_pred[i] = full_pred.get(i, []) + [pred_values[offset + i].unsqueeze(1).repeat(1, size, 1).flatten(0, 1)]
+        full_pred[i] = full_pred.get(i, []) + [pred_values[offset + i].repeat_interleave(bag_sizes, dim=0)]
     return bag_pred, bag_true, full_pred
 
-def get_bag_info(bags, n_samples_in_batch, minibatch_size, cell_counter, bag_counter, sample_batch_size):
+
+def get_bag_info(bags, bag_sizes, bag_counter):
     """Get bag information.
 
     Parameters
     ----------
     bags : list
         Bags.
-    n_samples_in_batch : int
-        Number of samples in the batch.
-    minibatch_size : int
-        Minibatch size.
-    cell_counter : int
-        Cell counter.
+    bag_sizes : torch.Tensor
+        Number of cells in each bag of the minibatch.
     bag_counter : int
         Bag counter.
-    sample_batch_size : int
-        Sample batch size.
 
     Returns
     -------
-    tuple[list, int, int]
-        Updated bags, cell counter, and bag counter.
+    tuple[list, int]
+        Updated bags and bag counter.
     """
-    if n_samples_in_batch == 1:
-        bags += [[bag_counter] * minibatch_size]
-        cell_counter += minibatch_size
-        bag_counter += 1
-    else:
-        bags += [[bag_counter + i] * sample_batch_size for i in range(n_samples_in_batch)]
-        bag_counter += n_samples_in_batch
-        cell_counter += sample_batch_size * n_samples_in_batch
-    return bags, cell_counter, bag_counter
+    bags += [[bag_counter + i] * size for i, size in enumerate(bag_sizes.tolist())]
+    bag_counter += len(bag_sizes)
+    return bags, bag_counter
+
+
+def whole_sample_outputs(mil_module, chunks, n_samples):
+    """Stream chunks of cells through the attention pooling to get one prediction per whole sample.
+
+    Parameters
+    ----------
+    mil_module : MILClassifierTorch
+        MIL module with :meth:`~multimil.module.MILClassifierTorch.stream_samples`.
+    chunks : iterable
+        Tuples of cell embeddings, categorical and continuous covariates for consecutive chunks of cells. The cells
+        of each sample have to be consecutive.
+    n_samples : int
+        Number of categories of the sample covariate.
+
+    Returns
+    -------
+    tuple[torch.Tensor, torch.Tensor | None, dict]
+        Categorical and continuous covariates of all cells and the inference outputs with one bag per sample, i.e.
+        ``predictions``, ``attention`` and ``bag_offsets``.
+    """
+    state = None
+    scores, cat_covs, cont_covs = [], [], []
+    for z, cat, cont in chunks:
+        samples = cat[:, mil_module.sample_idx].long().to(z.device)
+        chunk_scores, state = mil_module.stream_samples(z, samples, n_samples, state)
+        scores.append(chunk_scores)
+        cat_covs.append(cat)
+        cont_covs.append(cont)
+
+    cat_covs = torch.cat(cat_covs)
+    cont_covs = torch.cat(cont_covs) if cont_covs[0] is not None else None
+    samples = cat_covs[:, mil_module.sample_idx].long()
+    order, sizes = torch.unique_consecutive(samples, return_counts=True)
+    if len(order) != len(samples.unique()):
+        raise ValueError("The cells of each sample have to be consecutive.")
+
+    scores = torch.cat(scores) if scores[0] is not None else None
+    predictions, attention = mil_module.sample_predictions(
+        state, scores, samples.to(scores.device) if scores is not None else None
+    )
+    outputs = {
+        "predictions": [prediction[order.to(prediction.device)] for prediction in predictions],
+        "attention": attention,
+        "bag_offsets": torch.cat([sizes.new_zeros(1), sizes.cumsum(0)]),
+    }
+    return cat_covs, cont_covs, outputs
+
 
 def save_predictions_in_adata(
     adata, idx, predictions, bag_pred, bag_true, cell_pred, class_names, name, clip, reg=False
@@ -304,6 +331,7 @@ def save_predictions_in_adata(
     else:
         adata.uns[f"bag_full_predictions_{name}"] = df_bag.to_numpy()
 
+
 def plt_plot_losses(history, loss_names, save):
     """Plot losses.
 
@@ -336,3 +364,245 @@ def plt_plot_losses(history, loss_names, save):
         plt.legend()
     if save is not None:
         plt.savefig(save, bbox_inches="tight")
+
+
+def compile_fn(fn, **compile_kwargs):
+    """Compile `fn` with :func:`torch.compile` for minibatches of varying size.
+
+    Minibatches differ in the number of cells and, for the MIL modules, in the number and sizes of bags, so shapes are
+    dynamic by default and operations with data-dependent output shapes, e.g. the bag offsets, are captured in the graph
+    instead of breaking it.
+
+    Parameters
+    ----------
+    fn : callable
+        Function or method to compile.
+    **compile_kwargs
+        Keyword args for :func:`torch.compile`.
+
+    Returns
+    -------
+    callable
+        Compiled `fn`.
+    """
+    compile_kwargs.setdefault("dynamic", True)
+    compiled = torch.compile(fn, **compile_kwargs)
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with torch._dynamo.config.patch(capture_dynamic_output_shape_ops=True, capture_scalar_outputs=True):
+            return compiled(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def compiled_forward(module, enabled=True, **compile_kwargs):
+    """Use a compiled forward pass of `module` within the context.
+
+    Parameters
+    ----------
+    module : torch.nn.Module
+        Module to compile, e.g. the module passed to the training plan.
+    enabled : bool
+        Whether to compile, the context does nothing otherwise.
+    **compile_kwargs
+        Keyword args for :func:`torch.compile`.
+    """
+    if not enabled:
+        yield module
+        return
+    module.forward = compile_fn(module.forward, **compile_kwargs)
+    try:
+        yield module
+    finally:
+        del module.forward
+
+
+def to_fp32(obj):
+    """Cast the reduced-precision floating point tensors in `obj` to fp32.
+
+    Parameters
+    ----------
+    obj : torch.Tensor, list, tuple or dict
+        Tensor or (nested) container of tensors, e.g. the outputs of a module's inference.
+
+    Returns
+    -------
+    `obj` with half and bfloat16 tensors cast to fp32, other values are returned as they are.
+    """
+    if torch.is_tensor(obj):
+        return obj.float() if obj.dtype in (torch.float16, torch.bfloat16) else obj
+    if isinstance(obj, list | tuple):
+        return type(obj)(to_fp32(value) for value in obj)
+    if isinstance(obj, dict):
+        return {key: to_fp32(value) for key, value in obj.items()}
+    return obj
+
+
+def autocast_fp32(fn):
+    """Run `fn` in fp32 when autocast is enabled.
+
+    Decorator for numerically sensitive parts of mixed-precision training, e.g. log-likelihoods and kernels. Autocast
+    is disabled within `fn` and its reduced-precision tensor arguments are cast to fp32.
+
+    Parameters
+    ----------
+    fn : callable
+        Function or method to run in fp32.
+
+    Returns
+    -------
+    callable
+        Wrapped `fn`.
+    """
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if torch.is_autocast_enabled("cuda"):
+            device_type = "cuda"
+        elif torch.is_autocast_enabled("cpu"):
+            device_type = "cpu"
+        else:
+            return fn(*args, **kwargs)
+        with torch.autocast(device_type, enabled=False):
+            return fn(*to_fp32(args), **to_fp32(kwargs))
+
+    return wrapper
+
+
+def parallel_branches(branches, inputs=None, shared=()):
+    """Run independent differentiable branches concurrently in threads, in the forward and in the backward pass.
+
+    Each branch runs in its own thread with an equal share of the intra-op threads, and the grad mode, inference
+    mode and autocast settings of the caller. With gradients enabled, each branch records its own autograd graph in
+    forward, and the backward pass of all branches runs concurrently as well. Parameter gradients are accumulated
+    there. Dropout masks depend on the order in which the threads draw random numbers. The graphs of the branches
+    are freed in the backward pass, so it can't be run twice, even with ``retain_graph=True``. Concurrent calls from
+    different threads run one after the other.
+
+    Parameters
+    ----------
+    branches : list[callable]
+        Functions ``branch(input, *shared)``, or ``branch(*shared)`` without `inputs`, that return tuples of tensors.
+        Branches shouldn't share parameters; shared tensors have to be passed in `shared`.
+    inputs : list[torch.Tensor], optional
+        One input per branch.
+    shared : tuple[torch.Tensor], optional
+        Inputs passed to all branches, their gradients are summed over the branches.
+
+    Returns
+    -------
+    list[tuple[torch.Tensor]]
+        Outputs of each branch.
+    """
+    inputs = [None] * len(branches) if inputs is None else list(inputs)
+    spec = {"branches": branches, "has_inputs": inputs[0] is not None, "state": _thread_state()}
+    if not torch.is_grad_enabled():
+        return _map_branches(spec, lambda i: branches[i](*_branch_args(spec, i, inputs, shared)))
+
+    tensors = inputs + list(shared) if spec["has_inputs"] else list(shared)
+    # the outputs only require grad if an input does, the anchor makes sure the parameters of the branches get theirs
+    anchor = torch.empty(0, requires_grad=True)
+    flat = _ParallelBranches.apply(spec, anchor, *tensors)
+    outputs, start = [], 0
+    for count in spec["counts"]:
+        outputs.append(flat[start : start + count])
+        start += count
+    return outputs
+
+
+class _ParallelBranches(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, spec, anchor, *tensors):
+        n_branches = len(spec["branches"])
+        inputs = tensors[:n_branches] if spec["has_inputs"] else [None] * n_branches
+        shared = tensors[n_branches:] if spec["has_inputs"] else tensors
+
+        def run(i):
+            leaves = [
+                t.detach().requires_grad_(t.requires_grad)
+                for t in ([inputs[i]] if spec["has_inputs"] else []) + list(shared)
+            ]
+            with torch.enable_grad():
+                outputs = spec["branches"][i](*leaves)
+            return leaves, outputs
+
+        ctx.graphs = _map_branches(spec, run)
+        ctx.spec = spec
+        spec["counts"] = [len(outputs) for _, outputs in ctx.graphs]
+        return tuple(output.detach() for _, outputs in ctx.graphs for output in outputs)
+
+    @staticmethod
+    def backward(ctx, *grads):
+        spec = ctx.spec
+        if ctx.graphs is None:
+            raise RuntimeError("The graphs of the parallel branches were already freed by an earlier backward pass.")
+        starts = np.cumsum([0] + spec["counts"])
+
+        def run(i):
+            leaves, outputs = ctx.graphs[i]
+            pairs = [
+                (output, grad)
+                for output, grad in zip(outputs, grads[starts[i] : starts[i + 1]], strict=True)
+                if grad is not None and output.requires_grad
+            ]
+            if len(pairs) > 0:
+                torch.autograd.backward(*zip(*pairs, strict=True))
+            return [leaf.grad for leaf in leaves]
+
+        leaf_grads = _map_branches(spec, run)
+        ctx.graphs = None
+        n_shared = len(leaf_grads[0]) - spec["has_inputs"]
+        input_grads = [branch_grads[0] for branch_grads in leaf_grads] if spec["has_inputs"] else []
+        shared_grads = []
+        for j in range(n_shared):
+            branch_grads = [branch_grads[spec["has_inputs"] + j] for branch_grads in leaf_grads]
+            branch_grads = [grad for grad in branch_grads if grad is not None]
+            shared_grads.append(sum(branch_grads) if len(branch_grads) > 0 else None)
+        return None, None, *input_grads, *shared_grads
+
+
+def _branch_args(spec, i, inputs, shared):
+    return ([inputs[i]] if spec["has_inputs"] else []) + list(shared)
+
+
+def _thread_state():
+    # grad mode, inference mode and autocast are thread-local, so they are passed on to the branch threads
+    device_types = ["cpu", "cuda"] if torch.cuda.is_available() else ["cpu"]
+    return {
+        "grad": torch.is_grad_enabled(),
+        "inference": torch.is_inference_mode_enabled(),
+        "autocast": [(d, torch.is_autocast_enabled(d), torch.get_autocast_dtype(d)) for d in device_types],
+    }
+
+
+def _map_branches(spec, fn):
+    state = spec["state"]
+
+    def run(i):
+        with ExitStack() as stack:
+            stack.enter_context(torch.inference_mode(state["inference"]))
+            stack.enter_context(torch.set_grad_enabled(state["grad"]))
+            for device_type, enabled, dtype in state["autocast"]:
+                stack.enter_context(torch.autocast(device_type, dtype=dtype, enabled=enabled))
+            return fn(i)
+
+    # the number of intra-op threads is process-wide, it is split between the branches while they run, the lock
+    # keeps concurrent callers from saving and restoring each other's reduced count
+    n_branches = len(spec["branches"])
+    with _branch_lock:
+        n_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, n_threads // n_branches))
+        try:
+            return list(_branch_pool(n_branches).map(run, range(n_branches)))
+        finally:
+            torch.set_num_threads(n_threads)
+
+
+_branch_lock = threading.Lock()
+
+
+@cache
+def _branch_pool(n_workers):
+    return ThreadPoolExecutor(n_workers, thread_name_prefix="multimil-branch")
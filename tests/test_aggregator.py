@@ -0,0 +1,90 @@
+import pytest
+import torch
+
+from multimil.nn import MLP, Aggregator, chunked_attention_pool
+
+
+@pytest.mark.parametrize("scoring", ["gated_attn", "attn", "mlp", "sum", "mean", "max"])
+def test_ragged_bags_match_single_bags(scoring):
+    torch.manual_seed(0)
+    aggregator = Aggregator(8, scoring=scoring, sample_batch_size=16, scale=True).eval()
+    x = torch.randn(30, 8)
+    offsets = torch.tensor([0, 4, 11, 30])
+
+    pooled, attention = aggregator(x, offsets)
+    for i in range(3):
+        bag = x[offsets[i] : offsets[i + 1]].unsqueeze(0)
+        bag_pooled, bag_attention = aggregator(bag)
+        assert torch.allclose(pooled[i], bag_pooled[0], atol=1e-6)
+        if attention is not None:
+            assert torch.allclose(attention[offsets[i] : offsets[i + 1]], bag_attention.flatten())
+
+
+@pytest.mark.parametrize("scale", [False, True])
+def test_no_grad_gated_attention_matches_autograd(scale):
+    torch.manual_seed(0)
+    aggregator = Aggregator(8, scoring="gated_attn", sample_batch_size=16, scale=scale).eval()
+    x = torch.randn(30, 8)
+    offsets = torch.tensor([0, 4, 11, 30])
+
+    pooled, attention = aggregator(x, offsets)
+    with torch.no_grad():
+        fused_pooled, fused_attention = aggregator(x, offsets)
+    assert torch.allclose(pooled, fused_pooled, atol=1e-6)
+    assert torch.allclose(attention, fused_attention, atol=1e-6)
+
+    with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+        bf16_pooled, _ = aggregator(x, offsets)
+    assert torch.allclose(pooled, bf16_pooled.float(), atol=5e-2)
+
+
+@pytest.mark.parametrize("scoring", ["gated_attn", "attn", "mlp", "sum", "mean", "max"])
+def test_streamed_bags_match_forward(scoring):
+    torch.manual_seed(0)
+    aggregator = Aggregator(8, scoring=scoring, sample_batch_size=16, scale=True).eval()
+    x = torch.randn(30, 8)
+    offsets = torch.tensor([0, 4, 11, 30])
+    segments = torch.tensor([0] * 4 + [1] * 7 + [2] * 19)
+
+    state, scores = None, []
+    for chunk in torch.arange(30).split(7):  # chunks across bag boundaries
+        chunk_scores, state = aggregator.stream(10 * x[chunk], segments[chunk], 3, state)
+        scores.append(chunk_scores)
+    scores = None if scores[0] is None else torch.cat(scores)
+    pooled, attention = aggregator.stream_result(state, scores, segments)
+
+    expected_pooled, expected_attention = aggregator(10 * x, offsets)
+    # bags larger than sample_batch_size are pooled like a full bag
+    if expected_attention is not None:
+        full = torch.tensor([4 / 16, 7 / 16, 1.0]) / torch.tensor([4 / 16, 7 / 16, 19 / 16])
+        expected_pooled = expected_pooled * full.unsqueeze(-1)
+        expected_attention = expected_attention * full[segments]
+        assert torch.allclose(attention, expected_attention, atol=1e-6)
+    assert torch.allclose(pooled, expected_pooled, atol=1e-5)
+
+
+@pytest.mark.parametrize("scoring", ["gated_attn", "attn", "mlp"])
+def test_chunked_attention_pool_matches_autograd(scoring):
+    torch.manual_seed(0)
+    mlp = MLP(8, 8, n_hidden=32, dropout_rate=0.5)
+    aggregator = Aggregator(8, scoring=scoring, sample_batch_size=64, scale=True, dropout=0.0, n_layers_mlp_attn=2)
+    modules = torch.nn.ModuleList([mlp, aggregator]).train()
+    x = torch.randn(100, 8, requires_grad=True)
+    offsets = torch.tensor([0, 10, 64, 100])
+    weights = torch.randn(3, 8)
+
+    grads = []
+    for chunked in [False, True]:
+        torch.manual_seed(1)  # the same dropout masks, as the reference also runs the mlp chunk by chunk
+        if chunked:
+            pooled, _ = chunked_attention_pool(x, offsets, mlp, aggregator, chunk_size=16)
+        else:
+            zs = torch.cat([mlp(chunk) for chunk in x.split(16)])
+            pooled, _ = aggregator(zs, offsets)
+        (pooled * weights).sum().backward()
+        grads.append([x.grad.clone()] + [parameter.grad.clone() for parameter in modules.parameters()])
+        x.grad = None
+        modules.zero_grad()
+
+    for grad, chunked_grad in zip(*grads, strict=True):
+        assert torch.allclose(grad, chunked_grad, atol=1e-5)
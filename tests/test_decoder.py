@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from multimil.nn import Decoder, LowRankLinear
+
+
+def test_low_rank_linear_shape_and_parameters():
+    layer = LowRankLinear(16, 100, rank=4)
+    assert layer(torch.randn(5, 16)).shape == (5, 100)
+    assert layer(torch.randn(2, 5, 16)).shape == (2, 5, 100)
+    assert sum(p.numel() for p in layer.parameters()) == 4 * (16 + 100) + 100
+
+
+@pytest.mark.parametrize("loss", ["mse", "nb", "zinb", "bce"])
+def test_low_rank_decoder_outputs(loss):
+    torch.manual_seed(0)
+    decoder = Decoder(10, 100, n_hidden=16, loss=loss, rank=4)
+    full = Decoder(10, 100, n_hidden=16, loss=loss)
+    outputs = decoder(torch.randn(5, 10))
+    outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+    assert all(output.shape == (5, 100) for output in outputs)
+    if loss in ["nb", "bce"]:
+        assert torch.all((outputs[0] >= 0) & (outputs[0] <= 1))
+
+    # the hidden layers are the same, each output layer has 4 * (16 + 100) + 100 instead of 17 * 100 parameters
+    n_output_layers = 2 if loss == "zinb" else 1
+    n_params, n_full_params = (sum(p.numel() for p in d.parameters()) for d in [decoder, full])
+    assert n_full_params - n_params == n_output_layers * (17 * 100 - (4 * (16 + 100) + 100))
+
+
+@pytest.mark.parametrize("loss", ["nb", "zinb"])
+def test_low_rank_column_logits_match_output_layer(loss):
+    torch.manual_seed(0)
+    decoder = Decoder(10, 100, n_hidden=16, loss=loss, rank=4)
+    h = torch.randn(5, 16)
+    columns = torch.tensor([3, 50, 99])
+    mean_logits, dropout_logits = decoder.column_logits(h, columns)
+    assert torch.allclose(mean_logits, decoder.mean_decoder[0](h)[:, columns], atol=1e-6)
+    if loss == "zinb":
+        assert torch.allclose(dropout_logits, decoder.dropout_decoder(h)[:, columns], atol=1e-6)
+    else:
+        assert dropout_logits is None
@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from multimil.module import MILClassifierTorch
+
+
+def _module(**kwargs):
+    torch.manual_seed(0)
+    return MILClassifierTorch(
+        z_dim=8,
+        num_classification_classes=[3],
+        sample_batch_size=4,
+        class_idx=torch.tensor([1]),
+        ord_idx=torch.tensor([], dtype=torch.long),
+        reg_idx=torch.tensor([], dtype=torch.long),
+        **kwargs,
+    ).eval()
+
+
+@pytest.mark.parametrize(
+    ("sample_idx", "expected"),
+    [
+        # runs of 6, 3 and 5 cells, the first and the last of the same sample
+        (0, [0, 4, 6, 9, 13, 14]),
+        # without samples, the whole batch is one run
+        (None, [0, 4, 8, 12, 14]),
+    ],
+)
+def test_bag_offsets_split_ragged_sample_runs(sample_idx, expected):
+    module = _module(sample_idx=sample_idx)
+    samples = torch.tensor([0] * 6 + [1] * 3 + [0] * 5)
+    cat_covs = torch.stack([samples, torch.zeros_like(samples)], dim=1).float()
+    assert module._bag_offsets(torch.zeros(14, 8), cat_covs).tolist() == expected
+
+
+def test_inference_pools_each_bag_separately():
+    module = _module(sample_idx=0)
+    samples = torch.tensor([0] * 6 + [1] * 3 + [0] * 5)
+    cat_covs = torch.stack([samples, torch.zeros_like(samples)], dim=1).float()
+    z = torch.randn(14, 8)
+
+    outputs = module.inference(z, cat_covs)
+    offsets = outputs["bag_offsets"].tolist()
+    assert offsets == [0, 4, 6, 9, 13, 14]
+    assert outputs["predictions"][0].shape == (5, 3)
+    assert outputs["attention"].shape == (14,)
+    for i, (start, end) in enumerate(zip(offsets[:-1], offsets[1:], strict=True)):
+        bag_outputs = module.inference(z[start:end], cat_covs[start:end])
+        assert bag_outputs["bag_offsets"].tolist() == [0, end - start]
+        assert torch.allclose(outputs["predictions"][0][i], bag_outputs["predictions"][0][0], atol=1e-6)
+        assert torch.allclose(outputs["attention"][start:end], bag_outputs["attention"], atol=1e-6)
+        # the attention of a bag sums to its size relative to sample_batch_size
+        assert torch.isclose(bag_outputs["attention"].sum(), torch.tensor((end - start) / 4))
@@ -0,0 +1,51 @@
+import torch
+
+from multimil.distributions import MMD
+
+
+def test_tiled_gaussian_kernel_mean_matches_dense():
+    torch.manual_seed(0)
+    x = torch.randn(70, 5, dtype=torch.float64, requires_grad=True)
+    y = torch.randn(50, 5, dtype=torch.float64, requires_grad=True)
+    mmd = MMD(block_size=16)
+
+    dense = mmd.gaussian_kernel(x, y).mean()
+    tiled = mmd.gaussian_kernel_mean(x, y)
+    assert torch.allclose(dense, tiled)
+
+    dense_grad = torch.autograd.grad(dense, (x, y))
+    tiled_grad = torch.autograd.grad(tiled, (x, y))
+    for a, b in zip(dense_grad, tiled_grad, strict=True):
+        assert torch.allclose(a, b)
+
+
+def test_between_sets_matches_pairwise_mmd():
+    torch.manual_seed(0)
+    z = torch.randn(200, 4, dtype=torch.float64, requires_grad=True)
+    group = torch.randint(0, 3, (200,))
+    mmd = MMD(block_size=64)
+
+    sets = torch.nn.functional.one_hot(group, 4)  # the last group is empty and skipped
+    pairs = torch.combinations(torch.arange(4), r=2)
+    expected = sum(
+        mmd.gaussian_kernel(z[group == a], z[group == a]).mean()
+        + mmd.gaussian_kernel(z[group == b], z[group == b]).mean()
+        - 2 * mmd.gaussian_kernel(z[group == a], z[group == b]).mean()
+        for a, b in [(0, 1), (0, 2), (1, 2)]
+    )
+    tiled = mmd.between_sets(z, sets, pairs)
+    assert torch.allclose(tiled, expected)
+    assert torch.allclose(torch.autograd.grad(tiled, z)[0], torch.autograd.grad(expected, z)[0])
+
+
+def test_approximate_estimators_match_exact():
+    torch.manual_seed(0)
+    group = torch.randint(0, 3, (3000,))
+    z = torch.randn(3000, 4, dtype=torch.float64) + 0.5 * group.unsqueeze(-1)
+    sets = torch.nn.functional.one_hot(group, 3)
+    pairs = torch.combinations(torch.arange(3), r=2)
+
+    exact = MMD(bandwidth="median").between_sets(z, sets, pairs)
+    for estimator in ["linear", "rff"]:
+        approx = MMD(estimator=estimator, bandwidth="median", n_features=1024).between_sets(z, sets, pairs)
+        assert torch.isclose(approx, exact, rtol=0.1)
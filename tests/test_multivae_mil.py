@@ -0,0 +1,24 @@
+import anndata as ad
+import numpy as np
+
+from multimil.model import MultiVAE_MIL
+
+
+def test_train_passes_device_arguments_to_trainer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    adata = ad.AnnData(rng.poisson(1.0, (120, 30)).astype(np.float32))
+    adata.obs["sample"] = np.repeat([f"sample_{i}" for i in range(6)], 20)
+    adata.obs["condition"] = np.repeat(["a", "b"] * 3, 20)
+    adata.obs["size_factors"] = adata.X.sum(axis=1)
+    adata.uns["modality_lengths"] = {"rna": 30}
+    MultiVAE_MIL.setup_anndata(
+        adata, categorical_covariate_keys=["sample", "condition"], size_factor_key="size_factors"
+    )
+    model = MultiVAE_MIL(
+        adata, sample_key="sample", classification=["condition"], sample_batch_size=8, losses=["nb"], z_dim=8
+    )
+
+    model.train(max_epochs=1, batch_size=10, accelerator="cpu", device=1, early_stopping=False, save_best=False)
+    assert model.is_trained_
+    assert model.trainer.num_devices == 1
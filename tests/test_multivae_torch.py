@@ -0,0 +1,693 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+from scvi.distributions import NegativeBinomial, ZeroInflatedNegativeBinomial
+
+from multimil.module import MultiVAETorch
+from multimil.utils import compile_fn, parallel_branches
+
+
+def _module_pair(option, value=True, **kwargs):
+    # a module and a module with `option` set to `value` that share their parameters
+    module = MultiVAETorch(**kwargs)
+    other = MultiVAETorch(**kwargs, **{option: value})
+    other.load_state_dict(module.state_dict())
+    return module, other
+
+
+def _assert_same_loss_and_grads(module, other, tensors, atol=1e-5):
+    losses = []
+    for m in [module, other]:
+        # the latents are sampled in the same order in both modules
+        torch.manual_seed(0)
+        loss = m(tensors)[2].loss
+        loss.backward()
+        losses.append(loss)
+    assert torch.allclose(losses[0], losses[1], atol=atol)
+    for p, other_p in zip(module.parameters(), other.parameters(), strict=True):
+        assert other_p.grad is not None
+        assert torch.allclose(p.grad, other_p.grad, atol=atol)
+
+
+@pytest.mark.parametrize("normalization", ["layer", "batch"])
+def test_fused_modalities_match_unfused(normalization):
+    torch.manual_seed(0)
+    module, fused = _module_pair(
+        "fuse_modalities",
+        modality_lengths=[30, 20, 10],
+        losses=["nb", "bce", "zinb"],
+        normalization=normalization,
+        condition_encoders=True,
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[1],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([0]),
+    )
+    module.eval()
+    fused.eval()
+
+    x = torch.rand(40, 60)
+    cat_covs = torch.randint(0, 3, (40, 1)).float()
+    cont_covs = torch.rand(40, 1)
+    outputs = module.inference(x, cat_covs, cont_covs)
+    fused_outputs = fused.inference(x, cat_covs, cont_covs)
+    assert torch.allclose(outputs["mu"], fused_outputs["mu"], atol=1e-6)
+    assert torch.allclose(outputs["logvar"], fused_outputs["logvar"], atol=1e-6)
+
+    rs = module.generative(outputs["mu"], cat_covs, cont_covs)["rs"]
+    fused_rs = fused.generative(outputs["mu"], cat_covs, cont_covs)["rs"]
+    for r, fused_r in zip(rs, fused_rs, strict=True):
+        # the zinb decoder returns the mean and the dropout logits
+        for a, b in zip(
+            r if isinstance(r, tuple) else (r,), fused_r if isinstance(fused_r, tuple) else (fused_r,), strict=True
+        ):
+            assert torch.allclose(a, b, atol=1e-6)
+
+
+def _dense_mmd(mmd, x, y):
+    if x.shape[0] < 2 or y.shape[0] < 2:
+        return 0
+    return mmd.gaussian_kernel(x, x).mean() + mmd.gaussian_kernel(y, y).mean() - 2 * mmd.gaussian_kernel(x, y).mean()
+
+
+@pytest.mark.parametrize("mmd", ["latent", "marginal", "both"])
+def test_integ_loss_matches_pairwise_loop(mmd):
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[10, 10, 10],
+        losses=["mse", "mse", "mse"],
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+        num_groups=3,
+        integrate_on_idx=0,
+        mmd=mmd,
+    )
+    z = torch.randn(60, 16, dtype=torch.float64)
+    z_marginal = torch.randn(60, 3, 16, dtype=torch.float64)
+    group = torch.randint(0, 3, (60, 1))
+    masks = torch.rand(60, 3) > 0.3
+
+    expected = 0
+    pairs = [(0, 1), (0, 2), (1, 2)]
+    if mmd in ["latent", "both"]:
+        for a, b in pairs:
+            expected += _dense_mmd(module.mmd_loss, z[group[:, 0] == a], z[group[:, 0] == b])
+    if mmd in ["marginal", "both"]:
+        for i, j in pairs:
+            both = masks[:, i] & masks[:, j]
+            expected += _dense_mmd(module.mmd_loss, z_marginal[both, i], z_marginal[both, j])
+        for i in range(3):
+            for a, b in pairs:
+                rows_a, rows_b = masks[:, i] & (group[:, 0] == a), masks[:, i] & (group[:, 0] == b)
+                expected += _dense_mmd(module.mmd_loss, z_marginal[rows_a, i], z_marginal[rows_b, i])
+    assert torch.allclose(module._calc_integ_loss(z, z_marginal, group, masks), expected)
+
+
+def test_bf16_autocast_matches_fp32():
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[30, 20],
+        losses=["nb", "bce"],
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+        num_groups=3,
+        integrate_on_idx=0,
+        loss_coefs={"integ": 1},
+        mmd="both",
+    ).eval()
+    x = torch.rand(64, 50)
+    x[:, :30] = torch.poisson(5 * x[:, :30])
+    x[:, 30:] = (x[:, 30:] > 0.8).float()
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.randint(0, 3, (64, 1)).float(),
+        "size_factor": x[:, :30].sum(dim=1, keepdim=True),
+    }
+
+    torch.manual_seed(1)
+    losses = module(tensors)[2]
+    torch.manual_seed(1)
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        mixed_losses = module(tensors)[2]
+
+    # the likelihoods, the product of experts and the MMD stay in fp32
+    assert mixed_losses.loss.dtype == torch.float32
+    assert torch.isclose(mixed_losses.loss, losses.loss, rtol=2e-2)
+    assert torch.isclose(mixed_losses.extra_metrics["integ_loss"], losses.extra_metrics["integ_loss"], rtol=5e-2)
+
+
+def _sampled_module_pair(n_features, loss):
+    # 50 features are sampled
+    return _module_pair(
+        "n_negative_samples",
+        50,
+        modality_lengths=[n_features, 20],
+        losses=[loss, "bce"],
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+        num_groups=3,
+        integrate_on_idx=0,
+        dropout=0.0,
+    )
+
+
+def test_sampled_reconstruction_loss_matches_full():
+    torch.manual_seed(0)
+    module, sampled = _sampled_module_pair(n_features=200, loss="nb")
+    x = torch.rand(64, 220)
+    x[:, :200] = torch.poisson(0.3 * x[:, :200])
+    x[:, 200:] = (x[:, 200:] > 0.8).float()
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.randint(0, 3, (64, 1)).float(),
+        "size_factor": x[:, :200].sum(dim=1, keepdim=True) + 1,
+    }
+
+    key = "modality_0_reconstruction_loss"
+    full, estimates = [], []
+    for seed in range(20):
+        torch.manual_seed(seed)
+        full.append(module(tensors)[2].extra_metrics[key])
+        torch.manual_seed(seed)
+        estimates.append(sampled(tensors)[2].extra_metrics[key])
+    assert torch.isclose(torch.stack(estimates).mean(), torch.stack(full).mean(), rtol=1e-2)
+
+    # the full output layer is used outside of training
+    sampled.eval()
+    assert all(r is not None for r in sampled(tensors)[1]["rs"])
+
+
+@pytest.mark.parametrize("loss", ["nb", "zinb"])
+def test_sampled_reconstruction_loss_exact_with_all_features(loss):
+    torch.manual_seed(0)
+    # with all features sampled, the softmax normalizer and the sum over the zeros are exact
+    module, sampled = _sampled_module_pair(n_features=50, loss=loss)
+    x = torch.rand(32, 70)
+    x[:, :50] = torch.poisson(0.3 * x[:, :50])
+    x[:, 50:] = (x[:, 50:] > 0.8).float()
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.randint(0, 3, (32, 1)).float(),
+        "size_factor": x[:, :50].sum(dim=1, keepdim=True) + 1,
+    }
+
+    key = "modality_0_reconstruction_loss"
+    torch.manual_seed(0)
+    full = module(tensors)[2].extra_metrics[key]
+    torch.manual_seed(0)
+    estimate = sampled(tensors)[2].extra_metrics[key]
+    assert torch.allclose(estimate, full, rtol=1e-5)
+
+
+@pytest.mark.parametrize("n_negative_samples", [None, 10])
+def test_low_rank_decoders_train(n_negative_samples):
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[100, 20],
+        losses=["zinb", "bce"],
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+        decoder_ranks=[4, 2],
+        n_negative_samples=n_negative_samples,
+    )
+    x = torch.rand(16, 120)
+    x[:, :100] = torch.poisson(0.3 * x[:, :100])
+    x[:, 100:] = (x[:, 100:] > 0.8).float()
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.randint(0, 3, (16, 1)).float(),
+        "size_factor": x[:, :100].sum(dim=1, keepdim=True) + 1,
+    }
+
+    decoder = module.decoders[0]
+    calls = []
+    column_logits = decoder.column_logits
+    decoder.column_logits = lambda h, columns: calls.append(columns) or column_logits(h, columns)
+
+    inference_outputs, _, losses = module(tensors)
+    # the sampled loss only computes some columns of the factorized output layers
+    assert len(calls) == (n_negative_samples is not None)
+    assert torch.isfinite(losses.loss)
+    losses.loss.backward()
+    for decoder in module.decoders:
+        assert all(p.grad is not None and torch.isfinite(p.grad).all() for p in decoder.parameters())
+
+    module.eval()
+    rs = module.generative(inference_outputs["z"], tensors["extra_categorical_covs"])["rs"]
+    assert [r.shape for r in rs[0]] == [(16, 100), (16, 100)]
+    assert rs[1].shape == (16, 20)
+
+
+@pytest.mark.parametrize("fuse_modalities", [False, True])
+def test_sparse_input_matches_dense(fuse_modalities):
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[30, 20],
+        losses=["nb", "bce"],
+        condition_encoders=True,
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[1],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([0]),
+        fuse_modalities=fuse_modalities,
+    ).eval()
+    x = torch.poisson(3 * torch.rand(40, 50)) * (torch.rand(40, 50) > 0.7)
+    x[:, 30:] = x[:, 30:].clamp(max=1)
+    x[:10, 30:] = 0  # cells without the second modality
+    tensors = {
+        "extra_categorical_covs": torch.randint(0, 3, (40, 1)).float(),
+        "extra_continuous_covs": torch.rand(40, 1),
+        "size_factor": x[:, :30].sum(dim=1, keepdim=True).clamp(min=1),
+    }
+
+    grads = []
+    for batch in [x, x.to_sparse_csr()]:
+        module.zero_grad()
+        torch.manual_seed(1)
+        inference_outputs, _, losses = module({**tensors, "X": batch})
+        losses.loss.backward()
+        grads.append(module.encoders[0].mlp.fc_layers[0][0].weight.grad.clone())
+        if batch.layout == torch.strided:
+            dense_mu, dense_loss = inference_outputs["mu"], losses.loss
+    assert torch.allclose(inference_outputs["mu"], dense_mu, atol=1e-6)
+    assert torch.allclose(losses.loss, dense_loss)
+    assert torch.allclose(grads[1], grads[0], atol=1e-6)
+
+
+@pytest.mark.parametrize("condition_encoders", [False, True])
+def test_parallel_modalities_match_sequential(condition_encoders):
+    module, parallel = _module_pair(
+        "parallel_modalities",
+        modality_lengths=[20, 15, 10],
+        losses=["nb", "bce", "mse"],
+        condition_encoders=condition_encoders,
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+        dropout=0.0,
+    )
+
+    x = torch.cat([torch.poisson(torch.ones(32, 20)), (torch.rand(32, 15) > 0.8).float(), torch.randn(32, 10)], dim=1)
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.randint(0, 3, (32, 1)).float(),
+        "size_factor": x[:, :20].sum(dim=1, keepdim=True),
+    }
+    _assert_same_loss_and_grads(module, parallel, tensors)
+
+
+def test_parallel_branches_restore_thread_count():
+    n_threads = torch.get_num_threads()
+    torch.set_num_threads(4)
+    branch_threads = []
+
+    def branch(x):
+        time.sleep(0.01)
+        branch_threads.append(torch.get_num_threads())
+        return (2 * x,)
+
+    def call(_):
+        x = torch.rand(8, requires_grad=True)
+        outputs = parallel_branches([branch, branch], [x, x])
+        sum(out[0].sum() for out in outputs).backward()
+
+    try:
+        # concurrent callers must not restore each other's reduced thread count
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(call, range(8)))
+        assert torch.get_num_threads() == 4
+        assert set(branch_threads) == {2}
+    finally:
+        torch.set_num_threads(n_threads)
+
+
+def test_encoders_skip_missing_modalities():
+    torch.manual_seed(0)
+    # the fused path runs the encoders on all cells
+    module, fused = _module_pair(
+        "fuse_modalities",
+        modality_lengths=[20, 15, 10],
+        losses=["nb", "bce", "mse"],
+        condition_encoders=True,
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+    )
+    module.eval()
+    fused.eval()
+
+    # a mosaic batch, each cell has one or two of the modalities
+    x = torch.cat([torch.poisson(torch.ones(30, 20)), (torch.rand(30, 15) > 0.8).float(), torch.randn(30, 10)], dim=1)
+    x[:, 20] = 1
+    x[:10, 20:] = 0
+    x[10:20, :20] = 0
+    x[20:, 35:] = 0
+    cat_covs = torch.randint(0, 3, (30, 1)).float()
+    n_rows = []
+    module.encoders[1].register_forward_hook(lambda encoder, args, output: n_rows.append(output.shape[0]))
+    outputs = module.inference(x, cat_covs)
+    fused_outputs = fused.inference(x, cat_covs)
+    assert n_rows == [20]
+    assert torch.allclose(outputs["mu"], fused_outputs["mu"], atol=1e-5)
+    assert torch.allclose(outputs["logvar"], fused_outputs["logvar"], atol=1e-5)
+
+
+@pytest.mark.parametrize("parallel_modalities", [False, True])
+def test_compact_decoding_matches_full(parallel_modalities):
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[20, 15, 10],
+        losses=["nb", "bce", "mse"],
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+        dropout=0.0,
+        parallel_modalities=parallel_modalities,
+    )
+    x = torch.cat([torch.poisson(torch.ones(30, 20)), (torch.rand(30, 15) > 0.8).float(), torch.rand(30, 10)], dim=1)
+    x[:, 20] = 1
+    x[:10, 20:] = 0
+    x[10:20, :20] = 0
+    x[20:, 35:] = 0
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.randint(0, 3, (30, 1)).float(),
+        "size_factor": x[:, :20].sum(dim=1, keepdim=True).clamp(min=1),
+    }
+    with torch.no_grad():
+        inference_outputs = module.inference(**module._get_inference_input(tensors))
+    generative_inputs = module._get_generative_input(tensors, inference_outputs)
+
+    losses, grads = [], []
+    for masks in [inference_outputs["masks"], None]:
+        generative_outputs = module.generative(**{**generative_inputs, "masks": masks})
+        loss = module.loss(tensors, inference_outputs, generative_outputs).loss
+        module.zero_grad()
+        loss.backward()
+        losses.append(loss)
+        grads.append([p.grad.clone() for decoder in module.decoders for p in decoder.parameters()])
+        # only the cells that have the modality are decoded
+        n_decoded = [20, 20, 10] if masks is not None else [30, 30, 30]
+        assert [h.shape[0] for h in generative_outputs["hs"]] == n_decoded
+    assert torch.allclose(losses[0], losses[1], atol=1e-5)
+    for grad, full_grad in zip(*grads, strict=True):
+        assert torch.allclose(grad, full_grad, atol=1e-5)
+
+
+@pytest.mark.parametrize("loss", ["nb", "zinb"])
+def test_compact_decoding_single_cell_modality(loss):
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[20, 15],
+        losses=[loss, "bce"],
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+        dropout=0.0,
+    )
+    x = torch.cat([torch.poisson(torch.ones(8, 20)), (torch.rand(8, 15) > 0.8).float()], dim=1)
+    x[:, 20] = 1
+    # only the first cell has the counts modality
+    x[1:, :20] = 0
+    x[0, 0] = 1
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.randint(0, 3, (8, 1)).float(),
+        "size_factor": x[:, :20].sum(dim=1, keepdim=True).clamp(min=1),
+    }
+    with torch.no_grad():
+        inference_outputs = module.inference(**module._get_inference_input(tensors))
+        generative_inputs = module._get_generative_input(tensors, inference_outputs)
+        losses = []
+        for masks, n_decoded in [(inference_outputs["masks"], 1), (None, 8)]:
+            generative_outputs = module.generative(**{**generative_inputs, "masks": masks})
+            losses.append(module.loss(tensors, inference_outputs, generative_outputs).loss)
+            assert generative_outputs["hs"][0].shape[0] == n_decoded
+    assert torch.allclose(losses[0], losses[1], atol=1e-5)
+
+
+def test_accumulated_experts_match_product_of_experts():
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[20, 15, 10],
+        losses=["mse", "mse", "mse"],
+        cat_covariate_dims=[],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([], dtype=torch.long),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+        num_groups=2,
+        integrate_on_idx=0,
+        mmd="both",
+        loss_coefs={"integ": 1},
+    )
+    masks = torch.rand(40, 3) > 0.4
+    masks[:, 0] = True
+    rows = module._present_rows(masks)
+    mus, logvars = torch.randn(40, 3, module.z_dim), torch.randn(40, 3, module.z_dim)
+    out = [
+        (mus[:, mod], logvars[:, mod]) if rows[mod] is None else (mus[rows[mod], mod], logvars[rows[mod], mod])
+        for mod in range(3)
+    ]
+    mu_joint, logvar_joint = module._accumulate_experts(out, rows, masks)
+    expected_mu, expected_logvar = module._product_of_experts(mus, logvars, masks)
+    assert torch.allclose(mu_joint, expected_mu, atol=1e-6)
+    assert torch.allclose(logvar_joint, expected_logvar, atol=1e-6)
+
+    # the marginals are only sampled for the integration loss on them
+    x = torch.rand(40, 45) * masks.repeat_interleave(torch.tensor([20, 15, 10]), dim=1)
+    assert module.inference(x)["z_marginal"].shape == (40, 3, module.z_dim)
+    module.mmd = "latent"
+    assert module.inference(x)["z_marginal"] is None
+
+
+@pytest.mark.parametrize("fuse_modalities", [False, True])
+def test_folded_cat_covariates_match_concatenated(fuse_modalities):
+    module, folded = _module_pair(
+        "fold_cat_covariates",
+        modality_lengths=[20, 15],
+        losses=["nb", "bce"],
+        condition_encoders=True,
+        condition_decoders=True,
+        cat_covariate_dims=[3, 4],
+        cont_covariate_dims=[1],
+        cat_covs_idx=torch.tensor([0, 1]),
+        cont_covs_idx=torch.tensor([0]),
+        dropout=0.0,
+        fuse_modalities=fuse_modalities,
+    )
+
+    x = torch.cat([torch.poisson(torch.ones(32, 20)), (torch.rand(32, 15) > 0.7).float()], dim=1)
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.stack([torch.randint(0, 3, (32,)), torch.randint(0, 4, (32,))], dim=1).float(),
+        "extra_continuous_covs": torch.rand(32, 1),
+        "size_factor": x[:, :20].sum(dim=1, keepdim=True).clamp(min=1),
+    }
+    _assert_same_loss_and_grads(module, folded, tensors)
+
+
+@pytest.mark.parametrize(
+    ("fold_cat_covariates", "fuse_modalities", "parallel_modalities"),
+    [(False, False, False), (True, False, False), (False, True, False), (True, False, True)],
+)
+def test_dedup_covariates_match_per_cell(fold_cat_covariates, fuse_modalities, parallel_modalities):
+    module, deduped = _module_pair(
+        "dedup_covariates",
+        modality_lengths=[20, 15],
+        losses=["nb", "bce"],
+        condition_encoders=True,
+        condition_decoders=True,
+        cat_covariate_dims=[3, 4],
+        cont_covariate_dims=[1],
+        cat_covs_idx=torch.tensor([0, 1]),
+        cont_covs_idx=torch.tensor([0]),
+        cont_cov_type="mlp",
+        dropout=0.0,
+        fold_cat_covariates=fold_cat_covariates,
+        fuse_modalities=fuse_modalities,
+        parallel_modalities=parallel_modalities,
+    )
+
+    # 4 bags of 8 cells with constant covariates, the second modality is missing in the last 12 cells
+    x = torch.cat([torch.poisson(torch.ones(32, 20)), (torch.rand(32, 15) > 0.7).float()], dim=1)
+    x[20:, 20:] = 0
+    bags = torch.arange(4).repeat_interleave(8)
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.stack([bags % 3, bags % 2], dim=1).float(),
+        "extra_continuous_covs": torch.rand(4, 1)[bags],
+        "size_factor": x[:, :20].sum(dim=1, keepdim=True).clamp(min=1),
+    }
+    assert deduped._conditions(tensors["extra_categorical_covs"], tensors["extra_continuous_covs"])[0].shape[0] == 4
+    _assert_same_loss_and_grads(module, deduped, tensors)
+
+
+@pytest.mark.parametrize("loss", ["nb", "zinb"])
+@pytest.mark.parametrize("num_groups", [1, 3])
+def test_grouped_recon_loss_matches_per_cell_dispersion(loss, num_groups):
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[20],
+        losses=[loss],
+        num_groups=num_groups,
+        integrate_on_idx=0,
+        cat_covariate_dims=[num_groups],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+    )
+    x = torch.poisson(torch.ones(16, 20))
+    group = torch.randint(0, num_groups, (16, 1))
+    size_factor = x.sum(dim=1, keepdim=True).clamp(min=1)
+    mean = torch.softmax(torch.randn(16, 20), dim=-1)
+    r = (mean, torch.randn(16, 20)) if loss == "zinb" else mean
+    recon_loss = module._calc_recon_loss(
+        [x], [r], [None], [loss], group, size_factor, {"0": 1.0}, torch.ones(16, 1), rows=None
+    )[0]
+
+    dispersion = torch.exp(module.theta.T[group.squeeze()])
+    if loss == "zinb":
+        dist = ZeroInflatedNegativeBinomial(mu=mean * size_factor, theta=dispersion, zi_logits=r[1])
+    else:
+        dist = NegativeBinomial(mu=mean * size_factor, theta=dispersion)
+    assert torch.allclose(recon_loss, -dist.log_prob(x).sum(dim=-1), rtol=1e-5)
+
+
+@pytest.mark.parametrize("n_layers_cont_embed", [1, 3])
+def test_grouped_cont_covariate_curves_match_loop(n_layers_cont_embed):
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[10],
+        losses=["mse"],
+        cat_covariate_dims=[],
+        cont_covariate_dims=[1] * 5,
+        cat_covs_idx=torch.tensor([], dtype=torch.long),
+        cont_covs_idx=torch.arange(5),
+        cont_cov_type="mlp",
+        n_layers_cont_embed=n_layers_cont_embed,
+        dropout=0.0,
+    )
+    assert module._group_cont_covariate_curves
+    covs = torch.randn(16, 5)
+    grouped = module._compute_cont_cov_embeddings(covs)
+    grouped_grads = torch.autograd.grad(grouped.sum(), list(module.cont_covariate_curves.parameters()))
+    module._group_cont_covariate_curves = False
+    looped = module._compute_cont_cov_embeddings(covs)
+    looped_grads = torch.autograd.grad(looped.sum(), list(module.cont_covariate_curves.parameters()))
+    assert torch.allclose(grouped, looped, atol=1e-6)
+    for a, b in zip(grouped_grads, looped_grads, strict=True):
+        assert torch.allclose(a, b, atol=1e-6)
+
+
+def _covariate_module(cat_covariate_dims):
+    return MultiVAETorch(
+        modality_lengths=[10],
+        losses=["mse"],
+        condition_encoders=True,
+        cat_covariate_dims=cat_covariate_dims,
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.arange(len(cat_covariate_dims)),
+        cont_covs_idx=[],
+    )
+
+
+def test_packed_cat_covariate_embedding_loads_per_covariate_state_dict():
+    torch.manual_seed(0)
+    module = _covariate_module([3, 4])
+    state_dict = module.state_dict()
+    per_covariate = state_dict.pop("cat_covariate_embedding.weight").split([3, 4])
+    state_dict.update({f"cat_covariate_embedding_{i}.weight": weight for i, weight in enumerate(per_covariate)})
+
+    loaded = _covariate_module([3, 4])
+    loaded.load_state_dict(state_dict)
+    cat_covs = torch.tensor([[0.0, 3.0], [2.0, 1.0]])
+    expected = torch.cat([per_covariate[0][[0, 2]], per_covariate[1][[3, 1]]], dim=-1)
+    assert torch.equal(loaded._embed_cat_covariates(cat_covs), expected)
+
+
+def test_extended_cat_covariate_embedding_trains_only_new_covariates():
+    torch.manual_seed(0)
+    reference = _covariate_module([3, 4])
+    query = _covariate_module([3, 6])
+    weight = query._extend_cat_covariate_embedding(reference.cat_covariate_embedding.weight, [3, 4])
+    assert torch.equal(weight[:7], reference.cat_covariate_embedding.weight)
+    assert torch.equal(weight[7:], query.cat_covariate_embedding.weight[7:])
+
+    query._train_cat_covariate_embeddings([False, True])
+    query._embed_cat_covariates(torch.tensor([[0.0, 5.0], [2.0, 1.0]])).sum().backward()
+    assert query.cat_covariate_embedding.weight.grad is None
+    # the trained parameter holds the rows of the second covariate, 3 to 8 in the packed table
+    grad = query.trained_cat_covariate_embedding.grad
+    assert torch.all(grad[[1, 5]] != 0)
+
+
+def test_frozen_cat_covariate_embeddings_unchanged_by_query_training():
+    torch.manual_seed(0)
+    query = _covariate_module([3, 6])
+    for p in query.parameters():
+        p.requires_grad = False
+    query._train_cat_covariate_embeddings([False, True])
+    reference = query.state_dict()["cat_covariate_embedding.weight"]
+
+    optimizer = torch.optim.AdamW([p for p in query.parameters() if p.requires_grad], lr=1e-2, weight_decay=1e-1)
+    tensors = {"X": torch.rand(16, 10), "extra_categorical_covs": torch.tensor([[0.0, 5.0], [2.0, 1.0]]).repeat(8, 1)}
+    for _ in range(3):
+        loss = query(tensors)[2].loss
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    weight = query.state_dict()["cat_covariate_embedding.weight"]
+    assert "trained_cat_covariate_embedding" not in query.state_dict()
+    assert torch.equal(weight[:3], reference[:3])
+    assert not torch.equal(weight[3:], reference[3:])
+
+    # the merged table loads into frozen and fresh modules alike
+    query.load_state_dict(query.state_dict())
+    loaded = _covariate_module([3, 6])
+    loaded.load_state_dict(query.state_dict())
+    cat_covs = torch.tensor([[1.0, 4.0]])
+    assert torch.equal(loaded._embed_cat_covariates(cat_covs), query._embed_cat_covariates(cat_covs))
+
+
+@pytest.mark.parametrize("loss", ["nb", "zinb"])
+def test_compiled_grouped_recon_loss_matches_eager(loss):
+    torch.manual_seed(0)
+    module = MultiVAETorch(
+        modality_lengths=[20, 15],
+        losses=[loss, "bce"],
+        num_groups=3,
+        integrate_on_idx=0,
+        cat_covariate_dims=[3],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([0]),
+        cont_covs_idx=torch.tensor([], dtype=torch.long),
+        dropout=0.0,
+    )
+    x = torch.cat([torch.poisson(torch.ones(32, 20)), (torch.rand(32, 15) > 0.7).float()], dim=1)
+    tensors = {
+        "X": x,
+        "extra_categorical_covs": torch.randint(0, 3, (32, 1)).float(),
+        "size_factor": x[:, :20].sum(dim=1, keepdim=True).clamp(min=1),
+    }
+    losses = []
+    # the compiled graph draws the same latent samples as eager mode
+    with torch._inductor.config.patch(fallback_random=True):
+        for forward in [module.forward, compile_fn(module.forward)]:
+            torch.manual_seed(0)
+            losses.append(forward(tensors)[2].loss)
+    assert torch.allclose(losses[0], losses[1], rtol=1e-4)
@@ -0,0 +1,30 @@
+import pytest
+import torch
+from scvi.distributions import NegativeBinomial, ZeroInflatedNegativeBinomial
+
+from multimil.distributions import nb_log_likelihood, zinb_log_likelihood
+
+
+@pytest.mark.parametrize("zero_inflated", [False, True])
+@pytest.mark.parametrize("rate", [0.1, 3.0])
+@pytest.mark.parametrize("theta_shape", [(40,), (30, 40)])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_log_likelihood_matches_scvi(zero_inflated, rate, theta_shape, sparse):
+    torch.manual_seed(0)
+    x = torch.poisson(rate * torch.rand(30, 40, dtype=torch.float64))
+    mu = (5 * torch.rand(30, 40, dtype=torch.float64)).requires_grad_()
+    theta = (3 * torch.rand(theta_shape, dtype=torch.float64)).requires_grad_()
+    zi_logits = torch.randn(30, 40, dtype=torch.float64, requires_grad=True)
+    if zero_inflated:
+        fused = zinb_log_likelihood(x, mu, theta, zi_logits, sparse=sparse)
+        dist = ZeroInflatedNegativeBinomial(mu=mu, theta=theta.expand(30, 40), zi_logits=zi_logits)
+        inputs = (mu, theta, zi_logits)
+    else:
+        fused = nb_log_likelihood(x, mu, theta, sparse=sparse)
+        dist = NegativeBinomial(mu=mu, theta=theta.expand(30, 40))
+        inputs = (mu, theta)
+    expected = dist.log_prob(x).sum(dim=-1)
+    assert torch.allclose(fused, expected)
+
+    for a, b in zip(torch.autograd.grad(fused.sum(), inputs), torch.autograd.grad(expected.sum(), inputs), strict=True):
+        assert torch.allclose(a, b)